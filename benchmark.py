@@ -1,46 +1,244 @@
-import touchsim as ts
-import numpy as np
+"""Benchmark suite for touchsim.
+
+Times the individual simulation stages (profile solve, resampling, static and
+dynamic propagation, filtering, and LIF integration) as well as complete
+responses, sweeping over the number of pins, the number of afferents, the
+sampling rate, the stimulus duration, the surface type, and the precision
+(float64 or float32). Numba compilation
+and cache loading are timed separately in a warm-up run. Results are printed
+and optionally written to a JSON file, which can be compared against a
+previous run to catch regressions.
+
+Usage:
+    python benchmark.py [--quick] [--sweep pins afferents ...] [--repeat N]
+        [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import json
+import platform
+import sys
 import time
+import tracemalloc
+import warnings
+from math import isclose
+
+import numpy as np
+import scipy
+import numba
+
+# numba kernels with explicit signatures are compiled (or loaded from the
+# on-disk cache) on import
+_t = time.perf_counter()
+import touchsim as ts
+import_time = time.perf_counter() - _t
+from touchsim.transduction import skin_touch_profile, circ_load_vert_stress,\
+    circ_load_dyn_wave, resample_profile, LIFStream, factor_cache,\
+    profile_cache
+
+stages = ['profile','resample','static','dynamic','filter','lif']
+
+defaults = {'pins': 10, 'afferents': 100, 'fs': 5000., 'duration': 0.5,
+    'surface': 'null', 'dtype': 'float64'}
+
+sweeps = {
+    'pins': [1, 3, 10, 30, 100, 300],
+    'afferents': [1, 10, 100, 1000, 10000],
+    'fs': [500., 1000., 2000., 5000., 10000.],
+    'duration': [0.1, 0.5, 1., 2.],
+    'surface': ['null', 'hand'],
+    'dtype': ['float64', 'float32'],
+    }
+
+quick_sweeps = {
+    'pins': [1, 10, 100],
+    'afferents': [10, 100, 1000],
+    'fs': [1000., 5000.],
+    'duration': [0.1, 0.5],
+    'surface': ['null', 'hand'],
+    'dtype': ['float64', 'float32'],
+    }
+
+def setup(pins,afferents,fs,duration,surface,dtype='float64'):
+    """Builds the stimulus and afferent population for one configuration.
+    """
+    rng = np.random.default_rng(0)
+    if surface=='hand':
+        surf = ts.hand_surface
+        centre = np.mean(surf.sample_uniform('D2d',num=100,seed=0),axis=0)
+        locs = surf.sample_uniform('D2d',num=afferents,seed=0)
+    else:
+        surf = ts.null_surface
+        centre = np.zeros(2)
+        locs = rng.uniform(-10.,10.,(afferents,2))
+
+    # pins on a square grid with 1 mm spacing
+    side = int(np.ceil(np.sqrt(pins)))
+    g = np.arange(side) - (side-1)/2.
+    gx,gy = np.meshgrid(g,g,indexing='ij')
+    ploc = np.column_stack((gx.flatten(),gy.flatten()))[:pins] + centre
+
+    nsamp = int(round(duration*fs))
+    trace = 0.5 + 0.2*rng.standard_normal((pins,nsamp))
+    stim = ts.Stimulus(trace=trace,location=ploc,fs=fs,pin_radius=0.5,
+        profile=False)
+    aff = ts.AfferentPopulation.from_arrays('RA',locs,idx=0,surface=surf,
+        seed=0)
+    return stim, aff
+
+def measure(func,repeat):
+    """Runs func repeat times; returns its last result, the fastest wall time,
+    and the peak memory allocated during a run.
+    """
+    best = np.inf
+    peak = 0
+    for i in range(repeat):
+        tracemalloc.reset_peak()
+        start_mem = tracemalloc.get_traced_memory()[0]
+        t = time.perf_counter()
+        out = func()
+        best = min(best,time.perf_counter()-t)
+        peak = max(peak,tracemalloc.get_traced_memory()[1]-start_mem)
+    return out, best, peak
+
+def run_config(config,repeat=3):
+    """Times all stages and the complete response for one configuration.
+    """
+    stim,aff = setup(**config)
+    dtype = np.dtype(config.get('dtype','float64'))
+    result = {}
+
+    def profile():
+        # time the full solve, not the cached factorizations
+        factor_cache.clear()
+        return skin_touch_profile(stim.trace,stim.location,stim.fs,
+            stim.pin_radius)
+    (P,Pdyn),t,m = measure(profile,repeat)
+    result['profile'] = {'time': t, 'peak_bytes': m}
+
+    fs = LIFStream.srate
+    if not isclose(stim.fs,fs):
+        (P,Pdyn),t,m = measure(lambda: (
+            resample_profile(P,stim.fs,fs,axis=0),
+            resample_profile(Pdyn,stim.fs,fs,axis=1)),repeat)
+    else:
+        t,m = 0., 0
+    result['resample'] = {'time': t, 'peak_bytes': m}
+    P = P.astype(dtype,copy=False)
+    Pdyn = Pdyn.astype(dtype,copy=False)
+
+    strain,t,m = measure(lambda: circ_load_vert_stress(P,stim.location,
+        stim.pin_radius,aff.location,aff.depth),repeat)
+    result['static'] = {'time': t, 'peak_bytes': m}
+
+    udyn,t,m = measure(lambda: circ_load_dyn_wave(Pdyn,stim.location,
+        stim.pin_radius,aff.location,aff.depth,fs,aff.surface),repeat)
+    result['dynamic'] = {'time': t, 'peak_bytes': m}
+
+    # filtering works in place, so filter copies
+    (fstrain,fudyn),t,m = measure(lambda: LIFStream(aff).filter(
+        strain.copy(),udyn.copy()),repeat)
+    result['filter'] = {'time': t, 'peak_bytes': m}
+
+    _,t,m = measure(lambda: LIFStream(aff).integrate(fstrain,fudyn,True),
+        repeat)
+    result['lif'] = {'time': t, 'peak_bytes': m}
 
-pins = [1, 3, 10, 30, 100, 300]
-recs = [1, 3, 10, 30, 100, 300, 1000]
-#sf = [100., 300., 1000., 3000., 10000.]
-sf = [5000.]
+    def response():
+        factor_cache.clear()
+        profile_cache.clear()
+        stim.compute_profile()
+        return aff.response(stim,seed=0,dtype=dtype)
+    r,t,m = measure(response,repeat)
+    result['total'] = {'time': t, 'peak_bytes': m,
+        'spikes': int(sum(len(sp) for sp in r.spikes))}
+    return result
 
-lp = len(pins)
-lr = len(recs)
-lsf = len(sf)
+def warmup():
+    """Times the import and the first simulation, which compile or load the
+    numba kernels, separately from later runs.
+    """
+    t = time.perf_counter()
+    stim,aff = setup(pins=1,afferents=1,fs=5000.,duration=0.01,
+        surface='null')
+    stim.compute_profile()
+    aff.response(stim)
+    first = time.perf_counter()-t
 
-x,y = np.meshgrid(np.linspace(-5.,5.,100),np.linspace(-5.,5.,100))
-x = np.reshape(x,(-1,1))
-y = np.reshape(y,(-1,1))
+    t = time.perf_counter()
+    aff.response(stim)
+    second = time.perf_counter()-t
+    return {'import': import_time, 'first_run': first, 'second_run': second,
+        'jit': import_time + first - second}
 
-t = np.zeros((lp,lr,4))
-tottime = np.zeros((lp,lr,lsf))
+def metadata():
+    return {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0], 'platform': platform.platform(),
+        'numpy': np.__version__, 'scipy': scipy.__version__,
+        'numba': numba.__version__, 'numba_threads': numba.get_num_threads()}
 
-for kk in range(lsf):
-    for ii in range(lp):
-        for jj in range(lr):
-            npin = pins[ii]
-            nrec = recs[jj]
-            trace = np.random.randn(npin,int(sf[kk]))
+def compare(results,baseline,threshold=1.2):
+    """Prints stages that became slower than baseline by more than threshold.
+    """
+    base = {(b['sweep'],json.dumps(b['config'],sort_keys=True)): b['stages']
+        for b in baseline['results']}
+    slower = 0
+    for r in results['results']:
+        b = base.get((r['sweep'],json.dumps(r['config'],sort_keys=True)))
+        if b is None:
+            continue
+        for st,v in r['stages'].items():
+            if st not in b or b[st]['time']<=1e-4:
+                continue
+            ratio = v['time']/b[st]['time']
+            if ratio>threshold:
+                slower += 1
+                print('SLOWER %-10s %-32s %-8s %6.2fx' % (r['sweep'],
+                    json.dumps(r['config'][r['sweep']]),st,ratio))
+    print('%d regression(s) beyond %.0f%%' % (slower,(threshold-1.)*100.))
+    return slower
 
-            timall = time.time()
-            s = ts.Stimulus(trace=trace,
-                location=np.concatenate((x[0:npin],y[0:npin]),axis=1),fs=sf[kk])
-            t[ii,jj,0] = time.time()-timall
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='touchsim benchmark suite')
+    parser.add_argument('--sweep',nargs='+',choices=sorted(sweeps.keys()),
+        default=sorted(sweeps.keys()),help='parameters to sweep')
+    parser.add_argument('--quick',action='store_true',
+        help='use fewer and smaller configurations')
+    parser.add_argument('--repeat',type=int,default=3,
+        help='repetitions per measurement; the fastest is reported')
+    parser.add_argument('--output',help='write results to this JSON file')
+    parser.add_argument('--compare',help='JSON file of a previous run')
+    parser.add_argument('--threshold',type=float,default=1.2,
+        help='slowdown ratio reported as regression (default: 1.2)')
+    opts = parser.parse_args(argv)
 
-            timaffpop = time.time()
-            ap = ts.AfferentPopulation(affclass='RA',
-                location=np.concatenate((x[0:nrec],y[0:nrec]),axis=1))
-            t[ii,jj,1] = time.time() - timaffpop
+    warnings.simplefilter('ignore')
+    tracemalloc.start()
+    results = {'meta': metadata(), 'warmup': warmup(), 'results': []}
+    print('warm-up: import %.3f s, first run %.3f s (JIT/cache load %.3f s)' %
+        (import_time,results['warmup']['first_run'],results['warmup']['jit']))
 
-            timresp = time.time()
-            rc = ap.response(s)
-            t[ii,jj,2] = time.time() - timresp
-            t[ii,jj,3] = time.time() - timall
+    values = quick_sweeps if opts.quick else sweeps
+    print('%-10s %8s ' % ('sweep','value') +
+        ' '.join('%9s' % s for s in stages+['total']) + ' %9s' % 'peak MB')
+    for sw in opts.sweep:
+        for v in values[sw]:
+            config = dict(defaults)
+            config[sw] = v
+            res = run_config(config,opts.repeat)
+            results['results'].append({'sweep': sw,'config': config,
+                'stages': res})
+            print('%-10s %8s ' % (sw,v) +
+                ' '.join('%9.4f' % res[s]['time'] for s in stages+['total']) +
+                ' %9.1f' % (res['total']['peak_bytes']/2.**20))
+    tracemalloc.stop()
 
-tottime[:,:,kk] = t[:,:,3]
+    if opts.output:
+        with open(opts.output,'w') as f:
+            json.dump(results,f,indent=1)
+    if opts.compare:
+        with open(opts.compare) as f:
+            return 1 if compare(results,json.load(f),opts.threshold)>0 else 0
+    return 0
 
-np.set_printoptions(precision=3,suppress=True)
-print(tottime[:,:,0])
+if __name__=='__main__':
+    sys.exit(main())
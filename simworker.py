@@ -0,0 +1,118 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+
+import numpy as np
+import touchsim as ts
+from touchsim.batch import spawn_pool
+from PyQt5.QtCore import QThread, pyqtSignal
+
+# ------------------------------------------------------------
+# Simulation Jobs
+# ------------------------------------------------------------
+
+@dataclass
+class SimJob:
+    label: str          # model label, e.g. "RA3"
+    stim_name: str
+    affclass: object    # afferent class, or one per model
+    idx: object         # model idx (None = random), or an array of them
+    trace: np.ndarray
+    fs: float
+
+def run_job(job: SimJob):
+    """Simulates one job in a worker process. Jobs with an array of model
+    indices simulate all models as one population at the origin, so the
+    stimulus is solved once and all models are integrated in one call."""
+    s = ts.Stimulus(trace=job.trace, fs=job.fs)
+    if np.ndim(job.idx) > 0:
+        a = ts.AfferentPopulation.from_arrays(
+            job.affclass, np.zeros((len(job.idx), 2)), idx=job.idx
+        )
+    else:
+        a = ts.Afferent(affclass=job.affclass, idx=job.idx)
+    return a.response(s)
+
+# ------------------------------------------------------------
+# Background Simulation Thread
+# ------------------------------------------------------------
+
+class SimulationThread(QThread):
+    """Runs simulation jobs in a pool of worker processes, off the Qt event
+    thread. Results are sent back through signals as each job finishes, so
+    canvases can be updated while the rest is still running.
+    """
+    result = pyqtSignal(object, object)     # job, response
+    failed = pyqtSignal(object, str)        # job, error message
+    progress = pyqtSignal(int, int)         # jobs done, jobs total
+    done = pyqtSignal(bool)                 # cancelled
+
+    def __init__(self, jobs, workers=None, parent=None):
+        super().__init__(parent)
+        self.jobs = list(jobs)
+        self.workers = workers or os.cpu_count() or 1
+        self._cancelled = False
+        self._futures = []
+
+    def cancel(self):
+        """Stops handing out jobs; results of running jobs are discarded."""
+        self._cancelled = True
+        for f in self._futures:
+            f.cancel()
+
+    def run(self):
+        total = len(self.jobs)
+        self.progress.emit(0, total)
+        pool = spawn_pool(min(self.workers, max(total, 1)))
+        try:
+            futures = {pool.submit(run_job, job): job for job in self.jobs}
+            self._futures = list(futures)
+            done = 0
+            for f in as_completed(futures):
+                if self._cancelled:
+                    break
+                job = futures[f]
+                if f.cancelled():
+                    continue
+                try:
+                    self.result.emit(job, f.result())
+                except Exception as e:
+                    self.failed.emit(job, str(e))
+                done += 1
+                self.progress.emit(done, total)
+        finally:
+            for f in self._futures:
+                f.cancel()
+            pool.shutdown(wait=False)
+            self.done.emit(self._cancelled)
+
+
+# ------------------------------------------------------------
+# Background Task Thread
+# ------------------------------------------------------------
+
+class TaskThread(QThread):
+    """Runs independent I/O tasks (e.g. writing export files) in a thread pool,
+    off the Qt event thread. Tasks must not touch widgets.
+    """
+    progress = pyqtSignal(int, int)         # tasks done, tasks total
+    done = pyqtSignal(list)                 # task results in order
+
+    def __init__(self, tasks, workers=None, parent=None):
+        super().__init__(parent)
+        self.tasks = list(tasks)
+        self.workers = workers or os.cpu_count() or 1
+
+    def run(self):
+        total = len(self.tasks)
+        results = [None] * total
+        self.progress.emit(0, total)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(task): i for i, task in enumerate(self.tasks)}
+            for n, f in enumerate(as_completed(futures)):
+                try:
+                    results[futures[f]] = f.result()
+                except Exception as e:
+                    results[futures[f]] = e
+                self.progress.emit(n + 1, total)
+        self.done.emit(results)
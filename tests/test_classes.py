@@ -79,6 +79,22 @@ def test_affpop_region_index():
     assert len(a['D2d'])==1
     assert a['D2d'].region[0][0]=='D2d_t'
 
+def test_affpop_region_cache():
+    surf = ts.hand_surface
+    a = ts.affpop_surface(affclass=['SA1','RA'],region='D2',seed=0)
+    ids = surf.locate(a.location)[1]
+    assert np.array_equal(a.region[1],ids)
+    for tag in ['D2','D2d','D2m','P']:
+        rows = np.flatnonzero(np.isin(ids,surf.tag2idx(tag)))
+        assert np.array_equal(a[tag].rows,rows)
+    b = a[::2]
+    assert np.array_equal(b['D2d'].rows,a['D2d'].rows[a['D2d'].rows%2==0])
+
+    # moving an afferent updates its region
+    a[0].location = surf.pixel2hand([[0.,0.]])
+    assert a.region[1][0]==-1
+    assert 0 not in a['D2'].rows
+
 def test_affpop_add():
     a = ts.AfferentPopulation(ts.Afferent('SA1'))
     a2 = ts.Afferent('RA')
@@ -96,6 +112,38 @@ def test_affpop_add():
     assert len(a)==1
     assert len(ap)==2
 
+def test_affpop_shared():
+    p = ts.AfferentPopulation(ts.Afferent('SA1'),ts.Afferent('RA'))
+    x = p[0]
+    p2 = ts.AfferentPopulation(x,ts.Afferent('PC'))
+
+    # rows from different stores are copied; x stays part of p
+    x.location = [1.,2.]
+    assert np.array_equal(p.location[0],[1.,2.])
+    assert np.array_equal(p2.location[0],[0.,0.])
+
+    # afferents of one store are shared
+    p3 = ts.AfferentPopulation(p[1],p[0])
+    p[1].depth = 1.
+    assert p3.depth[0]==1.
+
+def test_afferent_setters():
+    p = ts.AfferentPopulation.from_arrays('RA',np.zeros((2,2)),idx=0)
+    a = p[1]
+    a.idx = 3
+    assert p[1].idx==3
+    assert np.array_equal(p.parameters[1][:12],
+        ts.Afferent.affparams['RA'][3][:12])
+    assert p.parameters[1][12]==0.
+    a.delay = True
+    assert p[1].delay
+    a.parameters = np.ones(13)
+    assert np.all(p.parameters[1]==1.)
+
+    assert type(p.afferents) is tuple
+    with pytest.raises(AttributeError):
+        p.afferents.append(ts.Afferent('PC'))
+
 def test_affpop_iadd():
     a = ts.AfferentPopulation(ts.Afferent('SA1'))
     a2 = ts.Afferent('RA')
@@ -156,3 +204,198 @@ def test_response_index():
     assert len(r[a['PC']]._spikes[0])==4
     assert len(r[a['PC']]._spikes[1])==4
     assert r[a[1]].rate()==a[1].response(s).rate()
+
+def test_response_columnar():
+    a = ts.affpop_grid(dist=2.,max_extent=4.)
+    s = [ts.stim_sine(freq=50.,amp=0.2,len=0.1),ts.stim_ramp(len=0.15)]
+    r = a.response(s,seed=1)
+    sp = r.spikes
+
+    bins = np.r_[0:r.duration+0.01:0.01]
+    psth = r.psth(bin=10.)
+    for i in range(len(a)):
+        assert np.array_equal(psth[i],np.histogram(sp[i],bins=bins)[0])
+        assert np.array_equal(sp[i],np.concatenate(
+            (r._spikes[0][i],r._spikes[1][i]+s[0].duration)))
+
+    c = r.count([[0.,0.1],[0.1,r.duration+1.]])
+    assert np.array_equal(c,r.counts)
+    assert np.array_equal(r.rate(sep=True),r.counts/np.array(r.durations))
+
+    # index by position, slice, class, and population
+    assert np.array_equal(r[3].spikes[0],sp[3])
+    assert all(np.array_equal(x,y) for x,y in zip(r[2:5].spikes,sp[2:5]))
+    pc = a.index(a['PC'])
+    assert all(np.array_equal(x,sp[i]) for x,i in zip(r['PC'].spikes,pc))
+    assert np.array_equal(r[a['PC']].counts,r.counts[pc])
+
+    r2 = ts.Response(a,s,r._spikes)
+    assert np.array_equal(r2.psth(),psth)
+
+def test_affpop_store_views():
+    a = ts.affpop_single_models(affclass=['SA1','RA','PC'])
+    b = a['PC']
+
+    assert b._store is a._store
+    assert a[::-1][0] == a[-1]
+    assert np.all(a.index(b)==np.arange(13,17))
+
+    a[0].noisy = False
+    assert not a.noisy[0]
+    assert not a[0:1].noisy[0]
+
+def test_affpop_from_store():
+    st = ts.AfferentStore(location=np.zeros((3,2)),depth=[.3,1.6,2.],
+        affclass=[0,1,2],idx=[0,0,0],parameters=np.zeros((3,13)))
+    a = ts.AfferentPopulation.from_store(st)
+
+    assert len(a)==3
+    assert a.affclass==['SA1','RA','PC']
+    assert np.all(a.depth==np.array([.3,1.6,2.]))
+    assert len(a[1:])==2
+
+def test_response_seed():
+    a = ts.affpop_single_models(affclass=['SA1','RA'])
+    s = ts.stim_sine(freq=50.,amp=0.1,len=0.2)
+
+    r1 = a.response(s,seed=1)
+    r2 = a[0:4].response(s,seed=1)
+    r3 = a.response(s,seed=2)
+
+    for i in range(4):
+        assert np.array_equal(r1.spikes[i],r2.spikes[i])
+    r4 = a[4:8].response(s,seed=1)
+    for i in range(4):
+        assert np.array_equal(r1.spikes[4+i],r4.spikes[i])
+    r5 = a[[6,2]].response(s,seed=1)
+    assert np.array_equal(r1.spikes[6],r5.spikes[0])
+    assert np.array_equal(r1.spikes[2],r5.spikes[1])
+    assert not all(np.array_equal(x,y) for x,y in zip(r1.spikes,r3.spikes))
+
+def test_response_stream():
+    a = ts.affpop_grid(dist=1.,max_extent=4.)
+    t = np.arange(1000)/5000.
+    trace = np.vstack((0.3+0.3*np.sin(2*np.pi*30*t),0.2+0.2*np.sin(2*np.pi*50*t)))
+    s = ts.Stimulus(trace=trace,location=np.array([[0.,0.],[3.,1.]]),fs=5000.,
+        pin_radius=0.5)
+    r = a.response(s,seed=1)
+
+    for block in [1,333,5000]:
+        parts = list(a.response_stream(s,block=block,seed=1))
+        for i in range(len(a)):
+            sp = np.concatenate([p[i] for p in parts])
+            assert np.allclose(sp,r.spikes[i])
+
+    s = ts.stim_ramp(len=0.1,fs=1000.)
+    r = a.response(s,seed=1)
+    parts = list(a.response_stream(s,block=100,seed=1))
+    for i in range(len(a)):
+        assert np.allclose(np.concatenate([p[i] for p in parts]),r.spikes[i])
+
+def test_response_scratch():
+    from touchsim.transduction import LIFStream
+    a = ts.affpop_grid(dist=1.,max_extent=4.)
+    s = ts.stim_sine(freq=100.,amp=0.5,len=0.5)
+    r = a.response(s,seed=1)
+    assert max(len(sp) for sp in r.spikes)>16
+
+    # spikes that overflow small buffers are rerun in chunks
+    old = LIFStream.scratch_bytes
+    LIFStream.scratch_bytes = 8*len(a)
+    try:
+        r2 = a.response(s,seed=1)
+    finally:
+        LIFStream.scratch_bytes = old
+    for i in range(len(a)):
+        assert np.array_equal(r.spikes[i],r2.spikes[i])
+
+def test_response_batch():
+    a = ts.affpop_single_models(affclass=['SA1','RA','PC'])
+    s = [ts.stim_sine(freq=50.,amp=0.1,len=0.2),ts.stim_ramp(len=0.2)]
+    r = a.response(s,seed=1)
+
+    for ex in ['thread','process']:
+        rb = ts.response_batch(a,s,seed=1,workers=2,executor=ex,
+            max_memory=2**18)
+        for i in range(len(s)):
+            for x,y in zip(r._spikes[i],rb._spikes[i]):
+                assert np.array_equal(x,y)
+
+    pieces = list(ts.iter_responses(a,s,executor='thread',max_memory=2**18))
+    assert [p[0] for p in pieces]==sorted(p[0] for p in pieces)
+    assert sum(len(p[2]) for p in pieces)==2*len(a)
+
+    # threads share the surface distance caches
+    loc = ts.hand_surface.sample_uniform('D2d',num=24,seed=0)
+    a = ts.AfferentPopulation.from_arrays('RA',loc,idx=0,
+        surface=ts.hand_surface)
+    s = [ts.stim_ramp(len=0.1,loc=loc[i]) for i in range(4)]
+    r = a.response(s,seed=1)
+    rb = ts.response_batch(a,s,seed=1,workers=4,executor='thread',
+        max_memory=2**16)
+    for i in range(len(s)):
+        for x,y in zip(r._spikes[i],rb._spikes[i]):
+            assert np.array_equal(x,y)
+
+def test_response_profiler(tmp_path):
+    a = ts.affpop_single_models(affclass='RA')
+    s = ts.stim_sine(freq=50.,amp=0.1,len=0.1,fs=1000.)
+
+    with ts.Profiler(trace=str(tmp_path / 'trace.json')) as prof:
+        a.response(s)
+    stats = prof.summary()
+    for st in ['resample','static','dynamic','filter','lif']:
+        assert stats[st]['count']==1
+    assert (tmp_path / 'trace.json').exists()
+
+    # the resampled profile is kept with the stimulus
+    events = []
+    a.response(s,callback=events.append)
+    assert [e['stage'] for e in events]==['static','dynamic','filter','lif']
+    a.response(s)
+    assert len(events)==4
+
+    # callbacks only see stages of their own call
+    from concurrent.futures import ThreadPoolExecutor
+    def run(i):
+        events = []
+        a.response(s,callback=events.append)
+        return {e['thread'] for e in events}, len(events)
+    with ThreadPoolExecutor(4) as pool:
+        for threads,n in pool.map(run,range(8)):
+            assert len(threads)==1 and n==4
+
+def test_response_export(tmp_path):
+    a = ts.affpop_grid(dist=2.,max_extent=4.)
+    s = [ts.stim_sine(freq=50.,amp=0.2,len=0.1),ts.stim_ramp(len=0.15)]
+    r = a.response(s,seed=1)
+    r1 = a['RA'].response(s[1],seed=1)
+
+    path = str(tmp_path / 'out.tsr')
+    with ts.ResponseWriter(path,bin_size=10.) as w:
+        w.write('all',r,stimuli=['sine','ramp'],model='grid')
+        # readable while still writing
+        assert list(ts.load_responses(path).keys())==['all']
+        w.write('RA',r1)
+
+    loaded = ts.load_responses(path)
+    assert list(loaded.keys())==['all','RA']
+    l = loaded['all']
+    assert l.attrs=={'model': 'grid'}
+    assert [x.name for x in l.stim]==['sine','ramp']
+    assert np.allclose(l.durations,r.durations)
+    assert np.array_equal(l.aff.parameters,a.parameters)
+    assert l.aff.affclass==a.affclass
+    assert np.array_equal(l.psth(),r.psth())
+    for x,y in zip(l.spikes,r.spikes):
+        assert np.array_equal(x,y)
+    assert np.array_equal(loaded['RA'].rate(),r1.rate())
+    assert np.array_equal(l['PC'].counts,r['PC'].counts)
+
+    l2 = ts.load_responses(path,mmap=False)
+    assert np.array_equal(l2['all']._times,r._times)
+
+    # cancelled before the first entry
+    with ts.ResponseWriter(str(tmp_path / 'empty.tsr')) as w:
+        pass
+    assert ts.load_responses(str(tmp_path / 'empty.tsr'))=={}
@@ -58,3 +58,25 @@ def test_shape_bar_nohdiff():
     assert shape.shape[1]==3
     assert np.min(shape[:,2])==0.
     assert np.max(shape[:,2])==0.
+
+def test_affpop_from_arrays_seed():
+    locs = np.zeros((100,2))
+    a = ts.AfferentPopulation.from_arrays('RA',locs,seed=1)
+    a2 = ts.AfferentPopulation.from_arrays('RA',locs,seed=1)
+
+    assert len(a)==100
+    assert np.all(a.gid==a2.gid)
+    assert np.all(a.parameters[:,12]==0.)
+
+    a = ts.AfferentPopulation.from_arrays(['SA1','PC'],locs[:2],idx=[1,2])
+    assert np.all(a.gid==np.array([[0,1],[2,2]]))
+
+    with pytest.raises(IndexError):
+        ts.AfferentPopulation.from_arrays('SA1',locs[:1],idx=4)
+
+def test_affpop_grid_idx():
+    a = ts.affpop_grid(max_extent=1.,affclass=['SA1','RA'],idx=0)
+
+    assert len(a)==8
+    assert a.affclass[:2]==['SA1','RA']
+    assert np.all(a.location[:2]==np.array([[-.5,-.5],[-.5,-.5]]))
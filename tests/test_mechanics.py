@@ -1,3 +1,4 @@
+import pytest
 import touchsim as ts
 import numpy as np
 
@@ -242,3 +243,71 @@ def test_stim_ramp():
     assert s.location[0,0] == 0.
     assert s.location[0,1] == 0.
     assert s.fs == 5000.
+
+def test_profile_factor_cache():
+    from touchsim.transduction import factor_cache
+    from touchsim.transduction import skin_touch_profile
+    loc = np.array([[0.,0.],[1.,0.],[0.,1.5]])
+    trace = np.vstack((np.linspace(0.,1.,50),np.linspace(0.,-.5,50),
+        np.linspace(0.,.5,50)))
+    s1 = ts.Stimulus(trace=trace,location=loc,pin_radius=0.2)
+    hits = factor_cache.hits
+    s2 = ts.Stimulus(trace=trace**2,location=loc,pin_radius=0.2)
+    assert factor_cache.hits>hits
+
+    P,Pdyn = skin_touch_profile(s2.trace,s2.location,s2.fs,s2.pin_radius)
+    assert np.allclose(s2._profile,P)
+
+def test_profile_scaled():
+    from touchsim.transduction import skin_touch_profile, profile_cache
+    t = np.linspace(0.,0.2,200)
+    s1 = ts.Stimulus(trace=np.vstack((np.sin(2*np.pi*10*t),np.cos(2*np.pi*10*t))),
+        location=[[0.,0.],[1.,0.]],pin_radius=0.3)
+    hits = profile_cache.hits
+    s2 = ts.Stimulus(trace=3.*s1.trace,location=s1.location,fs=s1.fs,
+        pin_radius=s1.pin_radius)
+    assert profile_cache.hits>hits
+
+    P,Pdyn = skin_touch_profile(s2.trace,s2.location,s2.fs,s2.pin_radius)
+    assert np.allclose(P,s2._profile)
+    assert np.allclose(Pdyn,s2._profiledyn)
+
+    # long traces are not kept
+    n = len(profile_cache)
+    ts.Stimulus(trace=np.tile(s1.trace,(1,11000)),location=s1.location,
+        fs=s1.fs,pin_radius=s1.pin_radius)
+    assert len(profile_cache)==n
+    assert profile_cache.nbytes<=profile_cache.maxbytes
+
+def test_profile_iadd():
+    from touchsim.transduction import skin_touch_profile
+    s = ts.Stimulus(trace=np.r_[np.linspace(0.,1.,50),np.zeros(50)],
+        location=[[0.,0.]],pin_radius=0.3)
+    s += ts.Stimulus(trace=np.r_[np.zeros(30),np.linspace(0.,1.,70)],
+        location=[[1.,0.]],pin_radius=0.3)
+
+    P,Pdyn = skin_touch_profile(s.trace,s.location,s.fs,s.pin_radius)
+    assert np.allclose(P,s._profile)
+    assert np.allclose(Pdyn,s._profiledyn)
+
+def test_resample_profile():
+    from touchsim.transduction import resample_profile
+    t = np.arange(1000)/1000.
+    x = np.column_stack((np.sin(2*np.pi*5*t),np.cos(2*np.pi*3*t)))
+    t5 = np.arange(5000)/5000.
+    y = np.column_stack((np.sin(2*np.pi*5*t5),np.cos(2*np.pi*3*t5)))
+    for q in ['fast','default','high','fft']:
+        xr = resample_profile(x,1000.,5000.,q)
+        assert xr.shape==(5000,2)
+        assert np.max(np.abs(xr-y)[500:4500])<1e-2
+
+    with pytest.raises(ValueError):
+        resample_profile(x,1000.,5000.,'best')
+
+    # rates without a small integer ratio are resampled exactly
+    t = np.arange(4999)/4999.
+    x = np.sin(2*np.pi*5*t)[:,None]
+    xr = resample_profile(x,4999.,5000.)
+    assert xr.shape==(5000,1)
+    assert np.allclose(xr,resample_profile(x,4999.,5000.,'fft'))
+    assert np.max(np.abs(xr[:,0]-np.sin(2*np.pi*5*t5))[500:4500])<1e-3
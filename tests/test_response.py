@@ -1,4 +1,6 @@
 import touchsim as ts
+import numpy as np
+import pytest
 
 rate_slack = 1.
 timing_slack = 0.00025
@@ -137,3 +139,85 @@ def test_PC_sine_resample():
     assert r.rate()[0,0]<=246.+rate_slack
     assert r.spikes[0][0]>=0.0042-timing_slack
     assert r.spikes[0][0]<=0.0042+timing_slack
+
+def test_sos_filter():
+    from scipy import signal
+    from touchsim.transduction import sos_filter, model_filter
+    sos = model_filter(ts.constants.affparams['RA'][0,0])
+    x = np.random.default_rng(0).standard_normal((3,500))
+    y,_ = signal.sosfilt(sos,x,axis=1,zi=np.zeros((sos.shape[0],3,2)))
+
+    # filter in place in two blocks, carrying the state
+    zi = np.zeros((3,sos.shape[0],2))
+    for b in [slice(0,200),slice(200,500)]:
+        xb = np.ascontiguousarray(x[:,b])
+        sos_filter(xb,sos,zi,xb,zi)
+        assert np.allclose(xb,y[:,b])
+
+def test_response_order():
+    a = ts.affpop_grid(dist=2.,max_extent=4.,noisy=False)
+    s = ts.stim_sine(freq=50.,amp=0.2,len=0.1)
+    perm = np.random.default_rng(0).permutation(len(a))
+    r = a.response(s)
+    rp = a[perm].response(s)
+    for i,j in enumerate(perm):
+        assert np.array_equal(rp.spikes[i],r.spikes[j])
+
+def test_lif_spikes_csr():
+    from touchsim.transduction import LIFStream
+    a = ts.affpop_grid(dist=2.,max_extent=4.,noisy=False)
+    s = ts.stim_sine(freq=200.,amp=1.,len=0.2)
+    strain,udyn,_ = s.propagate(a)
+    lif = LIFStream(a)
+    fs,fd = lif.filter(strain,udyn)
+    sp = LIFStream(a).integrate(fs.copy(),fd.copy(),final=True)
+    offsets,times = LIFStream(a).integrate(fs,fd,final=True,csr=True)
+
+    assert offsets.size==len(a)+1
+    assert offsets[-1]==times.size
+    # more spikes than fit the initial buffer for some afferents
+    assert max(len(x) for x in sp)>fs.shape[1]//32
+    for i in range(len(a)):
+        assert np.array_equal(times[offsets[i]:offsets[i+1]],sp[i])
+
+def test_noise_philox():
+    from touchsim.transduction import philox4x32, philox_normals
+    # known-answer test of Random123
+    u = np.uint64
+    out = philox4x32(u(0x243f6a88),u(0x85a308d3),u(0x13198a2e),u(0x03707344),
+        u(0xa4093822),u(0x299f31d0))
+    assert [int(x) for x in out]==[0xd16cfe09,0x94fdcceb,0x5001e420,0x24126ea1]
+
+    z = np.array([philox_normals(np.array([1,0,0]),t) for t in range(5000)])
+    assert abs(z.mean())<0.05
+    assert abs(z.std()-1.)<0.05
+
+def test_noise_threads():
+    import numba
+    a = ts.affpop_grid(dist=2.,max_extent=4.)
+    s = ts.stim_sine(freq=50.,amp=0.2,len=0.1)
+    threads = numba.get_num_threads()
+    try:
+        numba.set_num_threads(1)
+        r1 = a.response(s,seed=7)
+    finally:
+        numba.set_num_threads(threads)
+    r = a.response(s,seed=7)
+    for x,y in zip(r.spikes,r1.spikes):
+        assert np.array_equal(x,y)
+
+def test_response_float32():
+    a = ts.affpop_grid(dist=2.,max_extent=4.,noisy=False)
+    for s in [ts.stim_sine(freq=50.,amp=0.2,len=0.1),ts.stim_ramp(len=0.1),
+        ts.stim_noise(len=0.1,seed=0)]:
+        strain,udyn,_ = s.propagate(a,dtype=np.float32)
+        assert strain.dtype==np.float32 and udyn.dtype==np.float32
+
+        r = a.response(s)
+        r32 = a.response(s,dtype=np.float32)
+        for x,y in zip(r.spikes,r32.spikes):
+            assert len(x)==len(y)
+            assert np.allclose(x,y,atol=timing_slack)
+
+    with pytest.raises(ValueError):
+        a.response(s,dtype=np.int32)
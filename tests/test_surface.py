@@ -1,5 +1,6 @@
 import pytest
 import touchsim as ts
+import numpy as np
 from matplotlib import path
 
 def test_tags2idx():
@@ -23,6 +24,23 @@ def test_tags2idx():
 def test_locate():
     assert ts.hand_surface.locate([0.,0.])[0][0]=='D2d_t'
 
+def test_locate_raster():
+    # raster lookup must agree with exact boundary tests, also on boundaries
+    surf = ts.hand_surface
+    rng = np.random.default_rng(0)
+    b = np.concatenate(surf.boundary)
+    xy = np.vstack((rng.uniform(0.,620.,(20000,2)),b,
+        b + rng.normal(0.,0.3,b.shape),np.floor(b)))
+    loc = surf.pixel2hand(xy)
+    xy = surf.hand2pixel(loc)
+    regions = -np.ones((xy.shape[0],),dtype=np.int8)
+    for i in range(surf.num):
+        regions[path.Path(surf.boundary[i]).contains_points(xy)] = i
+    tags,idx = surf.locate(loc)
+    assert np.array_equal(idx,regions)
+    assert tags[np.flatnonzero(idx>=0)[0]]==surf.tags[idx[idx>=0][0]]
+    assert ts.null_surface.locate([0.,0.])[1][0]==-1
+
 def test_sample_uniform():
     loc = ts.hand_surface.sample_uniform('D2d',num=1,seed=1)
     assert path.Path(ts.hand_surface.pixel2hand(
@@ -43,6 +61,18 @@ def test_sample_uniform():
         ts.hand_surface.boundary[ts.hand_surface.tag2idx('D2d')[0]])
         ).contains_points(loc)[0]
 
+def test_sample_afferents():
+    surf = ts.hand_surface
+    xy,t,r = surf.sample_afferents(['SA1','PC'],'D2',seed=1)
+    assert xy.shape==(t.size,2) and r.size==t.size
+    assert set(t)=={'SA1','PC'} and set(r)<=set(surf.tag2idx('D2'))
+    assert np.array_equal(surf.locate(xy)[1],r)
+    # PC afferents are sparser than SA1 afferents
+    assert np.sum(t=='PC')<np.sum(t=='SA1')
+
+    xy2,_,_ = surf.sample_afferents(['SA1','PC'],'D2',seed=1)
+    assert np.array_equal(xy,xy2)
+
 def test_distance():
     s = ts.stim_ramp(loc=[0.,10.])
     a = ts.Afferent('SA1',surface=ts.hand_surface)
@@ -72,3 +102,136 @@ def test_distance_outside_outline():
     with pytest.warns(Warning):
         r = a.response(s)
     assert r.rate()[0,0]==0.
+
+def test_distance_cache(tmp_path):
+    from touchsim import cache
+    old_dir = cache.get_cache_dir()
+    cache.set_cache_dir(str(tmp_path))
+    try:
+        outline = np.zeros((40,40),dtype=bool)
+        outline[[0,-1],:] = True
+        outline[:,[0,-1]] = True
+        s = ts.Surface(outline=outline,orig=np.array([20.,20.]))
+        xy1 = np.array([[0.,0.],[5.,5.]])
+        xy2 = np.array([[10.,0.],[0.,-10.],[3.,4.]])
+
+        D = s.distance(xy1,xy2)
+        assert len(s._distance_lru)==1
+        assert np.allclose(s.distance(xy1,xy2),D)
+        assert s._distance_lru.hits==1
+        assert np.isclose(D[0,0],10.)
+
+        s2 = ts.Surface(outline=outline,orig=np.array([20.,20.]))
+        assert (tmp_path / s._cache_key / 'graph_indptr.npy').exists()
+        assert np.allclose(s2.distance(xy1,xy2),D)
+
+        # full fields of repeated sources stay in memory, within budget
+        s3 = ts.Surface(outline=outline,orig=np.array([20.,20.]),
+            max_field_memory=2*outline.size*8)
+        px = s3.pixel_index(np.array([[0.,0.],[5.,5.],[-5.,5.]]))
+        for i in range(2):
+            d = s3.geodesic(px,px[::-1])
+        assert len(s3._fields)==2
+        assert s3._fields.nbytes<=s3.max_field_memory
+        assert np.allclose(s3.geodesic(px,px[::-1]),d)
+        assert not any(p.name.startswith('field') for p in tmp_path.rglob('*'))
+
+        # use counts are only kept for recent sources
+        s3._source_hits.maxsize = 4
+        s3.geodesic(s3.pixel_index(np.array([[x,0.] for x in range(-8,9)])),
+            np.repeat(px[:1],17))
+        assert len(s3._source_hits)==4
+    finally:
+        cache.set_cache_dir(old_dir)
+
+def test_distance_limit(tmp_path):
+    from touchsim import cache
+    from scipy.sparse.csgraph import dijkstra
+    old_dir = cache.get_cache_dir()
+    cache.set_cache_dir(str(tmp_path))
+    try:
+        outline = np.zeros((40,40),dtype=bool)
+        outline[[0,-1],:] = True
+        outline[:,[0,-1]] = True
+        outline[10:,20] = True
+        s = ts.Surface(outline=outline,orig=np.array([20.,20.]))
+        rng = np.random.default_rng(0)
+        xy1 = rng.uniform(-15.,15.,(6,2))
+        xy2 = rng.uniform(-15.,15.,(50,2))
+
+        F = dijkstra(s.D,directed=False,indices=s.pixel_index(xy1))
+        ref = F[:,s.pixel_index(xy2)]
+        assert np.allclose(s.distance(xy1,xy2),ref)
+
+        D = s.distance(xy1,xy2,limit=12.)
+        assert np.array_equal(np.isinf(D),ref>12.)
+        assert np.allclose(D[ref<=12.],ref[ref<=12.])
+
+        i1 = rng.integers(0,6,200)
+        i2 = rng.integers(0,50,200)
+        d = s.pair_distance(xy1[i1],xy2[i2],limit=12.)
+        assert np.array_equal(d,D[i1,i2])
+        d = s.geodesic(s.pixel_index(xy1)[i1],s.pixel_index(xy2)[i2],workers=3)
+        assert np.allclose(d,ref[i1,i2])
+    finally:
+        cache.set_cache_dir(old_dir)
+
+def test_distance_fmm():
+    outline = np.zeros((120,120),dtype=bool)
+    outline[[0,-1],:] = True
+    outline[:,[0,-1]] = True
+    s = ts.Surface(outline=outline,orig=np.array([60.,60.]),pxl_per_mm=2.,
+        distance_method='fmm')
+    assert s.D is None
+    rng = np.random.default_rng(0)
+    xy1 = rng.uniform(-20.,20.,(4,2))
+    xy2 = rng.uniform(-20.,20.,(300,2))
+    E = np.sqrt(np.sum((xy1[:,None]-xy2[None])**2,axis=2))
+
+    # straight lines on an open surface, off pixel centres and off axis
+    D = s.distance(xy1,xy2)
+    assert np.allclose(D,E,rtol=0.03,atol=0.15)
+    assert np.mean(np.abs(D-E)/E)<0.005
+
+    D2 = s.distance(xy1,xy2,limit=10.)
+    assert np.all(np.isinf(D2[D>10.]))
+    assert np.allclose(D2[D<=10.],D[D<=10.])
+    d = s.pair_distance(xy1[[0,1,2]],xy2[[5,6,7]])
+    assert np.allclose(d,D[[0,1,2],[5,6,7]])
+
+    F = s.distance_field(xy1[0])
+    assert F.shape==s.outline.T.shape
+    p = np.rint(s.hand2pixel(xy1[:1])[0]).astype(int)
+    assert F[p[0],p[1]]<0.5
+
+def test_lazy_surface(tmp_path):
+    from touchsim.surface import LazySurface
+    outline = np.zeros((40,40),dtype=bool)
+    outline[[0,-1],:] = True
+    outline[:,[0,-1]] = True
+    outline[:,20] = True
+
+    s = LazySurface(outline=outline)
+    assert '_lazy_args' in s.__dict__
+    assert s.num==2
+    assert type(s) is ts.Surface
+
+    s.save_bundle(str(tmp_path / 'bundle.npz'))
+    s2 = ts.Surface(bundle=str(tmp_path / 'bundle.npz'))
+    assert s2.num==2
+    assert np.all(s2.outline==s.outline)
+    assert np.allclose(s2.boundary[1],s.boundary[1])
+
+    # bundles of an edited outline are ignored
+    outline[20,:] = True
+    with pytest.warns(Warning):
+        s3 = ts.Surface(outline=outline,bundle=str(tmp_path / 'bundle.npz'))
+    assert s3.num==4
+
+    # concurrent first use waits for construction
+    from concurrent.futures import ThreadPoolExecutor
+    s = LazySurface(outline=outline)
+    with ThreadPoolExecutor(4) as pool:
+        num = list(pool.map(lambda i: s.num,range(8)))
+    assert num==[4]*8
+    assert '_lazy_lock' in s.__dict__
@@ -1,4 +1,5 @@
 import touchsim as ts
+import numpy as np
 
 rate_slack = 1.
 timing_slack = 0.00025
@@ -32,3 +33,16 @@ def test_PC_waveprop2():
     assert r.rate()[0,0]<=29.+rate_slack
     assert r.spikes[0][0]>=0.043-timing_slack
     assert r.spikes[0][0]<=0.043+timing_slack
+
+def test_sparse_propagation():
+    s = ts.stim_indent_shape(ts.shape_circle(hdiff=0.5,pins_per_mm=2,radius=2),
+        ts.stim_ramp(len=0.1,amp=0.5))
+    a = ts.affpop_grid(dist=2.,max_extent=40.)
+
+    stat,dyn,_ = s.propagate(a)
+    stat_sp,dyn_sp,_ = s.propagate(a,tol=1e-6)
+    assert np.allclose(stat,stat_sp,atol=1e-4*np.max(np.abs(stat)))
+    assert np.allclose(dyn,dyn_sp)
+
+    r = a.response(s,tol=1e-3,seed=1)
+    assert len(r.spikes)==len(a)
@@ -1,3 +1,6 @@
 from .classes import *
 from .generators import *
 from .surface import Surface,null_surface,hand_surface
+from .batch import response_batch,iter_responses
+from .instrument import Profiler,add_listener,remove_listener
+from .export import ResponseWriter,save_responses,load_responses
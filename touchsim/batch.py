@@ -0,0 +1,195 @@
+import numpy as np
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
+
+from .classes import AfferentPopulation, AfferentStore, Response, Stimulus,\
+    noise_seeds
+
+default_max_memory = 2**30
+
+# state of worker processes, set up by _init_worker
+_worker = {}
+
+def _share_store(store):
+    """Copies the arrays of an AfferentStore into shared memory blocks.
+    """
+    blocks = []
+    spec = {}
+    for f in AfferentStore.fields:
+        arr = getattr(store,f)
+        shm = shared_memory.SharedMemory(create=True,size=max(arr.nbytes,1))
+        np.ndarray(arr.shape,dtype=arr.dtype,buffer=shm.buf)[...] = arr
+        blocks.append(shm)
+        spec[f] = (shm.name,arr.shape,arr.dtype.str)
+    return blocks, spec
+
+def _init_worker(spec,surface,threads):
+    if threads is not None:
+        import numba
+        numba.set_num_threads(threads)
+    blocks = []
+    arrays = {}
+    for f,(name,shape,dtype) in spec.items():
+        shm = shared_memory.SharedMemory(name=name)
+        blocks.append(shm)
+        arrays[f] = np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+    _worker['blocks'] = blocks    # keep shared memory mapped
+    _worker['store'] = AfferentStore(**arrays)
+    _worker['surface'] = surface
+
+def spawn_pool(workers,**args):
+    """Creates a process pool whose workers start fresh interpreters, since
+    numba's threading layer is not fork-safe.
+
+    Args:
+        workers (int): Number of worker processes.
+
+    Kwargs:
+        All kwargs (e.g. initializer, initargs) are passed on to
+        ProcessPoolExecutor.
+
+    Returns:
+        ProcessPoolExecutor object.
+    """
+    return ProcessPoolExecutor(max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),**args)
+
+def _run_unit(stim,stim_idx,rows,keys,seed,opts,pop=None):
+    # keys are the rows of the afferents in the original store, which seed
+    # their noise streams
+    if pop is None:
+        pop = AfferentPopulation.from_store(_worker['store'],rows,
+            surface=_worker['surface'])
+    return pop.spikes(stim,seed=noise_seeds(seed,stim_idx,keys),**opts)
+
+def chunk_size(stim,**args):
+    """Number of afferents that can be simulated in one work unit without
+    exceeding the memory limit.
+
+    Args:
+        stim (Stimulus object): The tactile stimulus.
+
+    Kwargs:
+        max_memory (int): Memory limit per work unit in bytes
+            (default: 1 GB).
+        dtype: Simulation precision (default: np.float64).
+
+    Returns:
+        Number of afferents per work unit.
+    """
+    max_memory = args.get('max_memory',default_max_memory)
+    nsamp = int(round(stim.trace.shape[1]/stim.fs*5000.)) + stim.trace.shape[1]
+    itemsize = np.dtype(args.get('dtype',np.float64)).itemsize
+    # strain, udyn, and their transposed copies that are filtered in place;
+    # spikes are kept in compact form
+    return max(1,int(max_memory//(nsamp*itemsize*4)))
+
+def iter_responses(affpop,stim,**args):
+    """Simulates the responses of an afferent population to many stimuli in
+    parallel. Work is split into units of one stimulus and a chunk of afferents,
+    which are distributed over a pool of worker processes or threads. Pieces
+    are returned in order as soon as they are done.
+
+    Args:
+        affpop (AfferentPopulation object): The responding afferents.
+        stim (Stimulus object or list): The tactile stimulus or stimuli.
+
+    Kwargs:
+        workers (int): Number of workers (default: number of CPUs).
+        executor (str): 'process' or 'thread' (default: 'process'). Threads
+            share the population's surface and its distance caches, which
+            are thread-safe.
+        max_memory (int): Memory limit per work unit in bytes, which sets the
+            number of afferents per unit (default: 1 GB).
+        seed (int): Random number seed for membrane noise. Noise is seeded per
+            stimulus and afferent, so results do not depend on the number of
+            workers or threads or on chunking (default: None).
+        tol (float): Relative tolerance for sparse propagation, see
+            Stimulus.propagate() (default: None).
+        resample (str): Resampling quality, see Stimulus.propagate()
+            (default: 'default').
+        dtype: Simulation precision, np.float64 or np.float32; single
+            precision allows twice as many afferents per work unit
+            (default: np.float64).
+
+    Yields:
+        Tuples containing the stimulus index, the range of afferent positions in
+        the population, and a list of spike time arrays for those afferents.
+    """
+    if type(stim) is Stimulus:
+        stim = [stim]
+    workers = args.get('workers',None) or os.cpu_count()
+    executor = args.get('executor','process')
+    seed = args.get('seed',None)
+    opts = {'tol': args.get('tol',None),
+        'resample': args.get('resample','default'),
+        'dtype': args.get('dtype',np.float64)}
+    n = len(affpop)
+
+    units = []
+    for i,s in enumerate(stim):
+        # resample the surface profile once, before shipping to workers
+        s.resampled_profile(5000.,opts['resample'])
+        cs = chunk_size(s,**args)
+        for start in range(0,n,cs):
+            units.append((s,i,range(start,min(start+cs,n))))
+
+    rows = affpop.rows
+    blocks = []
+    if executor=='process':
+        # only ship the rows of this population to the workers
+        blocks,spec = _share_store(affpop._store.take(rows))
+        pool = spawn_pool(workers,initializer=_init_worker,
+            initargs=(spec,affpop.surface,max(1,os.cpu_count()//workers)))
+        submit = lambda s,i,r: pool.submit(_run_unit,s,i,
+            slice(r.start,r.stop),rows[r.start:r.stop],seed,opts)
+    elif executor=='thread':
+        pool = ThreadPoolExecutor(max_workers=workers)
+        submit = lambda s,i,r: pool.submit(_run_unit,s,i,None,
+            rows[r.start:r.stop],seed,opts,affpop[r.start:r.stop])
+    else:
+        raise ValueError("executor must be 'process' or 'thread'.")
+
+    pending = deque()
+    try:
+        for s,i,r in units:
+            pending.append((i,r,submit(s,i,r)))
+            # bound the number of units in flight to limit memory use
+            if len(pending)>=2*workers:
+                i0,r0,f = pending.popleft()
+                yield i0, r0, f.result()
+        while len(pending)>0:
+            i0,r0,f = pending.popleft()
+            yield i0, r0, f.result()
+    finally:
+        # drop units not started yet, e.g. if the caller stops iterating
+        for i0,r0,f in pending:
+            f.cancel()
+        pool.shutdown()
+        for b in blocks:
+            b.close()
+            b.unlink()
+
+def response_batch(affpop,stim,**args):
+    """Calculates an afferent population's spiking response to many stimuli in
+    parallel, see iter_responses() for details.
+
+    Args:
+        affpop (AfferentPopulation object): The responding afferents.
+        stim (Stimulus object or list): The tactile stimulus or stimuli.
+
+    Kwargs:
+        All kwargs are passed on to iter_responses().
+
+    Returns:
+        Response object.
+    """
+    if type(stim) is Stimulus:
+        stim = [stim]
+    r = [[] for s in stim]
+    for i,_,sp in iter_responses(affpop,stim,**args):
+        r[i].extend(sp)
+    return Response(affpop,stim,r)
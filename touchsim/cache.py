@@ -0,0 +1,160 @@
+import numpy as np
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+# disk caching is opt-in
+_cache_dir = os.environ.get('TOUCHSIM_CACHE',None)
+
+def get_cache_dir():
+    """Returns the directory used for persistent caches, or None if disk caching
+    is disabled.
+    """
+    return _cache_dir if _cache_dir else None
+
+def set_cache_dir(path):
+    """Sets the directory used for persistent caches, which enables disk
+    caching, e.g. set_cache_dir(os.path.expanduser('~/.cache/touchsim')).
+
+    Args:
+        path (str): Cache directory; None disables disk caching (the default).
+            The directory can also be set through the TOUCHSIM_CACHE
+            environment variable.
+    """
+    global _cache_dir
+    _cache_dir = path
+
+def array_key(*arrays,**args):
+    """Hashes arrays (and optional scalar settings) into a short hex key.
+    """
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str((a.dtype.str,a.shape)).encode())
+        h.update(a.tobytes())
+    for k in sorted(args.keys()):
+        h.update(('%s=%r' % (k,args[k])).encode())
+    return h.hexdigest()[:20]
+
+
+def nbytes(value):
+    """Memory held by an array, or by a tuple or list of arrays.
+    """
+    if isinstance(value,(tuple,list)):
+        return sum(nbytes(v) for v in value)
+    return getattr(value,'nbytes',0)
+
+
+class LRUCache(object):
+    """A small in-process least-recently-used cache, which is safe to use from
+    several threads.
+    """
+
+    def __init__(self,maxsize=32,maxbytes=None):
+        """Initializes an LRUCache object.
+
+        Args:
+            maxsize (int): Maximum number of entries; None for no limit
+                (default: 32).
+            maxbytes (int): Maximum memory held by the cached arrays in bytes;
+                larger values are not cached (default: None, no limit).
+        """
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # locks cannot be pickled; cached values are not worth shipping
+        return {'maxsize': self.maxsize,'maxbytes': self.maxbytes}
+
+    def __setstate__(self,state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self,key):
+        return key in self._data
+
+    def get(self,key,default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][0]
+            self.misses += 1
+            return default
+
+    def put(self,key,value):
+        size = nbytes(value)
+        if self.maxbytes is not None and size>self.maxbytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data[key][1]
+            self._data[key] = (value,size)
+            self._data.move_to_end(key)
+            self.nbytes += size
+            while (self.maxsize is not None and len(self._data)>self.maxsize)\
+                or (self.maxbytes is not None and self.nbytes>self.maxbytes):
+                self.nbytes -= self._data.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+
+def cache_path(key,*parts):
+    """Returns the path of an entry in the disk cache, or None if disk caching
+    is disabled.
+    """
+    d = get_cache_dir()
+    if d is None:
+        return None
+    return os.path.join(d,key,*parts)
+
+def save_array(key,name,arr):
+    """Atomically stores an array in the disk cache. Failures (e.g. read-only
+    cache directory) are ignored.
+
+    Args:
+        key (str): Cache key, e.g. from array_key().
+        name (str): Name of the array within the key's directory.
+        arr (array): Array to store.
+    """
+    path = cache_path(key,name + '.npy')
+    if path is None:
+        return
+    try:
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        tmp = path + '.%d.tmp' % os.getpid()
+        with open(tmp,'wb') as f:
+            np.save(f,arr)
+        os.replace(tmp,path)
+    except OSError:
+        pass
+
+def load_array(key,name):
+    """Loads an array from the disk cache, memory-mapped read-only so that
+    several processes share a single copy.
+
+    Args:
+        key (str): Cache key.
+        name (str): Name of the array within the key's directory.
+
+    Returns:
+        Memory-mapped array, or None if not cached.
+    """
+    path = cache_path(key,name + '.npy')
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        return np.load(path,mmap_mode='r')
+    except (OSError,ValueError):
+        return None
@@ -1,14 +1,125 @@
 import numpy as np
-import random
 import warnings
 from math import isclose
-from scipy.signal import resample
 
-from .transduction import skin_touch_profile, circ_load_vert_stress,\
-    circ_load_dyn_wave, lif_neuron, check_pin_radius
+from .transduction import skin_touch_profile, scaled_skin_touch_profile,\
+    circ_load_vert_stress, circ_load_dyn_wave, lif_neuron, check_pin_radius,\
+    max_delay, LIFStream, factor_cache, profile_cache, resample_profile,\
+    check_dtype, csr_take
 from . import constants
+from .instrument import stage, cache_counts, add_listener, remove_listener
 from .surface import null_surface
 
+class AfferentStore(object):
+    """Columnar storage backing Afferent and AfferentPopulation objects. All
+    per-afferent properties are held in contiguous arrays with one row per
+    afferent.
+    """
+
+    fields = ('location','depth','affclass','idx','parameters','noisy','delay',
+        'region')
+
+    def __init__(self,**args):
+        """Initializes an AfferentStore object.
+
+        Kwargs:
+            location (Nx2 array): Afferent locations (default: empty).
+            depth (array): Afferent depths (default: empty).
+            affclass (array): Afferent class ids, indexing into
+                constants.affclasses (default: empty).
+            idx (array): Neuron model ids (default: empty).
+            parameters (NxP array): Neuron model parameters (default: empty).
+            noisy (array): Noise flags (default: empty).
+            delay (array): Delay flags (default: empty).
+            region (array): Region ids on region_surface, or -2 where not
+                known yet (default: all -2).
+            region_surface (Surface object): The surface that region ids refer
+                to (default: None).
+        """
+        self.location = np.ascontiguousarray(np.reshape(
+            args.get('location',np.zeros((0,2))),(-1,2)),dtype=np.float64)
+        n = self.location.shape[0]
+        self.depth = np.ascontiguousarray(np.reshape(
+            args.get('depth',np.zeros(n)),(n,)),dtype=np.float64)
+        self.affclass = np.ascontiguousarray(np.reshape(
+            args.get('affclass',np.zeros(n)),(n,)),dtype=np.int8)
+        self.idx = np.ascontiguousarray(np.reshape(
+            args.get('idx',np.zeros(n)),(n,)),dtype=np.int64)
+        self.parameters = np.ascontiguousarray(np.reshape(
+            args.get('parameters',np.zeros((n,13))),(n,13)),dtype=np.float64)
+        self.noisy = np.ascontiguousarray(np.reshape(
+            args.get('noisy',np.ones(n)),(n,)),dtype=np.bool_)
+        self.delay = np.ascontiguousarray(np.reshape(
+            args.get('delay',np.zeros(n)),(n,)),dtype=np.bool_)
+        self.region = np.ascontiguousarray(np.reshape(
+            args.get('region',-2*np.ones(n)),(n,)),dtype=np.int8)
+        self.region_surface = args.get('region_surface',None)
+        self.region_version = 0
+
+    def __len__(self):
+        return self.location.shape[0]
+
+    def take(self,rows):
+        """Copies selected rows into a new AfferentStore.
+
+        Args:
+            rows (slice or array): Rows to copy.
+
+        Returns:
+            AfferentStore object.
+        """
+        return AfferentStore(region_surface=self.region_surface,
+            **{f:getattr(self,f)[rows] for f in self.fields})
+
+    @staticmethod
+    def concatenate(parts):
+        """Concatenates rows from several stores into a new AfferentStore.
+
+        Args:
+            parts (list): List of (AfferentStore, rows) tuples.
+
+        Returns:
+            AfferentStore object.
+        """
+        if len(parts)==0:
+            return AfferentStore()
+        store = AfferentStore(**{f:np.concatenate(
+            [getattr(s,f)[r] for s,r in parts]) for f in AfferentStore.fields})
+        # keep region ids only if they all refer to the same surface
+        surface = parts[0][0].region_surface
+        if all(s.region_surface is surface for s,r in parts):
+            store.region_surface = surface
+        else:
+            store.region[:] = -2
+        return store
+
+    def regions(self,rows,surface):
+        """Region ids of selected rows on a surface. Ids are located on first
+        use and kept in the region column; they are located again if the
+        surface changes.
+
+        Args:
+            rows (slice or array): Rows to look up.
+            surface (Surface object): The surface.
+
+        Returns:
+            Array of region ids (-1 outside all regions).
+        """
+        if surface is not self.region_surface:
+            self.region = -2*np.ones(len(self),dtype=np.int8)
+            self.region_surface = surface
+            self.region_version += 1
+        ids = self.region[rows]
+        unknown = ids==-2
+        if np.any(unknown):
+            ids = ids.copy()
+            ids[unknown] = surface.locate(self.location[rows][unknown])[1]
+            if not self.region.flags.writeable:
+                self.region = self.region.copy()
+            self.region[rows] = ids
+        return ids.copy()
+
+
 class Afferent(object):
     """A single afferent, which can be placed on a surface and respond to tactile
     stimuli.
@@ -34,25 +145,42 @@ class Afferent(object):
             depth (float) = Depth of afferent in the skin (default: standard depth
                 depening on afferent class).
             idx (int): ID number of neuron model (default: randomly chosen).
+            seed (int): Random number seed for choosing the neuron model
+                (default: None).
         """
-        self.affclass = affclass
-        self.location = np.atleast_2d(args.get('location',np.array([[0., 0.]])))
-        self.depth = args.get('depth',None)
-        self.idx = args.get('idx',None)
-        self.noisy = args.get('noisy',True)
-        self.delay = args.get('delay',False)
+        check_affclass(affclass)
+        depth = args.get('depth',None)
+        idx = args.get('idx',None)
+        delay = args.get('delay',False)
+
+        if depth is None:   # Set afferent depth
+            depth = Afferent.affdepths.get(affclass)
+
+        p = Afferent.affparams.get(affclass)      # Set afferent parameters
+        if idx is None:
+            idx = int(np.random.default_rng(args.get('seed',None)).integers(
+                p.shape[0]))
+        parameters = p[idx].copy()
+
+        if not delay:
+            parameters[12] = 0.;
+
+        self._store = AfferentStore(
+            location=np.atleast_2d(args.get('location',np.array([[0., 0.]]))),
+            depth=depth,affclass=Afferent.affclasses.index(affclass),idx=idx,
+            parameters=parameters,noisy=args.get('noisy',True),delay=delay)
+        self._row = 0
         self.surface = args.get('surface',null_surface)
 
-        if self.depth is None:   # Set afferent depth
-            self.depth = Afferent.affdepths.get(self.affclass)
-
-        p = Afferent.affparams.get(self.affclass)      # Set afferent parameters
-        if self.idx is None:
-            self.idx = random.randint(0,p.shape[0]-1)
-        self.parameters = p[self.idx].copy()
-
-        if not self.delay:
-            self.parameters[12] = 0.;
+    @classmethod
+    def _view(cls,store,row,surface):
+        """Creates an Afferent object referring to a row of an existing store.
+        """
+        a = cls.__new__(cls)
+        a._store = store
+        a._row = int(row)
+        a.surface = surface
+        return a
 
     def __str__(self):
         return 'Afferent of class ' + self.affclass + ' (gid: ' +\
@@ -61,46 +189,128 @@ class Afferent(object):
     def __len__(self):
         return 1
 
+    def __eq__(self,other):
+        return type(other) is Afferent and self._store is other._store and\
+            self._row==other._row
+
+    def __hash__(self):
+        return hash((id(self._store),self._row))
+
     @property
     def affclass(self):
-        return self._affclass
+        return Afferent.affclasses[self._store.affclass[self._row]]
 
     @affclass.setter
     def affclass(self,affclass):
-        if not affclass in Afferent.affclasses:
-            raise IOError("Afferent class must be one of " + \
-                ", ".join(Afferent.affclasses) + ".")
-        self._affclass = affclass
+        check_affclass(affclass)
+        self._store.affclass[self._row] = Afferent.affclasses.index(affclass)
+
+    @property
+    def location(self):
+        return self._store.location[self._row:self._row+1]
+
+    @location.setter
+    def location(self,location):
+        self._store.location[self._row] = np.reshape(location,(2,))
+        self._store.region[self._row] = -2
+        self._store.region_version += 1
+
+    @property
+    def depth(self):
+        return self._store.depth[self._row]
+
+    @depth.setter
+    def depth(self,depth):
+        self._store.depth[self._row] = depth
+
+    @property
+    def idx(self):
+        return int(self._store.idx[self._row])
+
+    @idx.setter
+    def idx(self,idx):
+        # switching the neuron model also switches its parameters
+        parameters = Afferent.affparams[self.affclass][idx].copy()
+        if not self.delay:
+            parameters[12] = 0.
+        self._store.idx[self._row] = idx
+        self._store.parameters[self._row] = parameters
+
+    @property
+    def parameters(self):
+        return self._store.parameters[self._row]
+
+    @parameters.setter
+    def parameters(self,parameters):
+        self._store.parameters[self._row] = parameters
+
+    @property
+    def noisy(self):
+        return bool(self._store.noisy[self._row])
+
+    @noisy.setter
+    def noisy(self,noisy):
+        self._store.noisy[self._row] = noisy
+
+    @property
+    def delay(self):
+        return bool(self._store.delay[self._row])
+
+    @delay.setter
+    def delay(self,delay):
+        self._store.delay[self._row] = delay
 
     @property
     def gid(self):
-        return np.asarray([Afferent.affclasses.index(self.affclass), self.idx])
+        return np.asarray([self._store.affclass[self._row], self.idx])
 
     @property
     def region(self):
-        return self.surface.locate(self.location)
+        ids = self._store.regions(slice(self._row,self._row+1),self.surface)
+        return self.surface.idx2tag(ids), ids
 
     def __add__(self,other):
         if type(other) is Afferent:
             return AfferentPopulation(self,other)
         elif type(other) is AfferentPopulation:
-            return AfferentPopulation(self,*other.afferents)
+            return AfferentPopulation(self) + other
         else:
             RuntimeError("Can only add elements of type Afferent or AfferentPopulation.")
         return self
 
-    def response(self,stim):
+    def response(self,stim,**args):
         """Calculates the afferent's spiking response to a tactile stimulus.
 
         Args:
             stim (Stimulus object): The tactile stimulus.
 
+        Kwargs:
+            All kwargs are passed on to AfferentPopulation.response.
+
         Returns:
             Response object.
         """
-        return AfferentPopulation(self).response(stim)
+        return AfferentPopulation(self).response(stim,**args)
+
+
+def check_affclass(affclass):
+    if not affclass in Afferent.affclasses:
+        raise IOError("Afferent class must be one of " + \
+            ", ".join(Afferent.affclasses) + ".")
 
 
+def affparam_table():
+    """Stacks the parameters of all neuron models into a single table.
+
+    Returns:
+        Tuple containing the number of models per afferent class, the row offset
+        of each class within the table, and the table itself.
+    """
+    nmodels = np.array([Afferent.affparams[c].shape[0] for c in Afferent.affclasses])
+    offsets = np.concatenate(([0],np.cumsum(nmodels)[:-1]))
+    table = np.concatenate([Afferent.affparams[c] for c in Afferent.affclasses])
+    return nmodels, offsets, table
+
 class AfferentPopulation(object):
     """A population of afferents.
     """
@@ -109,112 +319,274 @@ class AfferentPopulation(object):
         """Initializes an AfferentPopulation object.
 
         Args:
-            a1, a2, ... (Afferent): Afferent objects.
+            a1, a2, ... (Afferent): Afferent objects. If they all belong to the
+                same AfferentStore (e.g. they were taken from one population),
+                the population refers to their rows, so that changes to them
+                are shared. Otherwise their rows are copied into a new store,
+                and the Afferent objects passed in remain unchanged.
 
         Kwargs:
             surface (Surface object): The surface on which Afferent is located
                 (default: a1.surface if set, otherwise null_surface).
         """
-        self.afferents = list(afferents)
-        if len(self.afferents)==0:
+        if len(afferents)==0:
             sur = null_surface
         else:
-            sur = self.afferents[0].surface
+            sur = afferents[0].surface
         self.surface = args.get('surface',sur)
-        for a in self.afferents:
+
+        if len(afferents)>0 and\
+            all(a._store is afferents[0]._store for a in afferents):
+            # all afferents live in the same store, so just select their rows
+            self._store = afferents[0]._store
+            self._sel = np.array([a._row for a in afferents],dtype=np.int64)
+        else:
+            self._store = AfferentStore.concatenate(
+                [(a._store,slice(a._row,a._row+1)) for a in afferents])
+            self._sel = slice(None)
+        for a in afferents:
             a.surface = self.surface
 
+    @classmethod
+    def from_store(cls,store,rows=slice(None),**args):
+        """Creates an AfferentPopulation referring to rows of an AfferentStore,
+        without copying.
+
+        Args:
+            store (AfferentStore): Columnar afferent storage.
+            rows (slice or array): Rows of store making up the population
+                (default: all).
+
+        Kwargs:
+            surface (Surface object): The surface on which afferents are located
+                (default: null_surface).
+
+        Returns:
+            AfferentPopulation object.
+        """
+        a = cls.__new__(cls)
+        a.surface = args.get('surface',null_surface)
+        a._store = store
+        a._sel = rows
+        return a
+
+    @classmethod
+    def from_arrays(cls,affclass,location,**args):
+        """Creates an AfferentPopulation from arrays of afferent classes and
+        locations in one vectorized step, without constructing individual
+        Afferent objects.
+
+        Args:
+            affclass (str or array): Afferent class for each afferent, or a single
+                class used for all afferents.
+            location (Nx2 array): Afferent locations.
+
+        Kwargs:
+            idx (int or array): ID number(s) of neuron models (default: randomly
+                chosen).
+            seed (int): Random number seed used for choosing neuron models
+                (default: None).
+            noisy (bool or array): Injects noise into membrane potential
+                (default: True).
+            delay (bool or array): Adds delays to mimic travel to neural recording
+                site (default: False).
+            depth (float or array): Depth of afferents in the skin (default:
+                standard depth depending on afferent class).
+            surface (Surface object): The surface on which afferents are located
+                (default: null_surface).
+            region (array): Region ids of the afferents on surface, as
+                returned by Surface.locate(); if known, e.g. from sampling,
+                they need not be located later (default: None).
+
+        Returns:
+            AfferentPopulation object.
+        """
+        location = np.reshape(np.asarray(location,dtype=np.float64),(-1,2))
+        n = location.shape[0]
+
+        uq,affclass = np.unique(np.broadcast_to(np.asarray(affclass),(n,)),
+            return_inverse=True)
+        for c in uq:
+            check_affclass(c)
+        affclass = np.array([Afferent.affclasses.index(c) for c in uq],
+            dtype=np.int8)[affclass.reshape(-1)]
+
+        nmodels,offsets,table = affparam_table()
+        idx = args.get('idx',None)
+        if idx is None:
+            rng = np.random.default_rng(args.get('seed',None))
+            idx = rng.integers(0,nmodels[affclass])
+        else:
+            idx = np.broadcast_to(np.asarray(idx,dtype=np.int64),(n,))
+            if np.any(idx>=nmodels[affclass]) or np.any(idx<0):
+                raise IndexError("Neuron model index out of range.")
+
+        delay = np.broadcast_to(np.asarray(args.get('delay',False)),(n,))
+        parameters = table[offsets[affclass]+idx]
+        parameters[~delay,12] = 0.
+
+        depth = args.get('depth',None)
+        if depth is None:
+            depth = np.array([Afferent.affdepths[c]
+                for c in Afferent.affclasses])[affclass]
+
+        surface = args.get('surface',null_surface)
+        region = args.get('region',None)
+        store = AfferentStore(location=location,
+            depth=np.broadcast_to(depth,(n,)),affclass=affclass,idx=idx,
+            parameters=parameters,
+            noisy=np.broadcast_to(args.get('noisy',True),(n,)),delay=delay,
+            region=np.broadcast_to(-2 if region is None else region,(n,)).copy(),
+            region_surface=None if region is None else surface)
+        return cls.from_store(store,surface=surface)
+
     def __str__(self):
         return 'AfferentPopulation with ' + str(len(self)) + ' afferent(s): ' +\
                 str(sum(self.find('SA1'))) + ' SA1, ' + str(sum(self.find('RA'))) +\
                  ' RA, ' + str(sum(self.find('PC'))) + ' PC.'
 
     def __len__(self):
-        return len(self.afferents)
+        if type(self._sel) is slice:
+            return len(range(*self._sel.indices(len(self._store))))
+        return self._sel.size
+
+    @property
+    def rows(self):
+        """Rows of the underlying AfferentStore belonging to this population."""
+        if type(self._sel) is slice:
+            return np.arange(*self._sel.indices(len(self._store)))
+        return self._sel
+
+    def _subset(self,rows):
+        return AfferentPopulation.from_store(self._store,rows,
+            surface=self.surface)
 
     def __getitem__(self,idx):
-        if type(idx) is int:
-            return self.afferents[idx]
+        if type(idx) is int or type(idx) is np.int64:
+            if type(self._sel) is slice:
+                row = range(*self._sel.indices(len(self._store)))[idx]
+            else:
+                row = self._sel[idx]
+            return Afferent._view(self._store,row,self.surface)
         elif type(idx) is slice:
-            return AfferentPopulation(*self.afferents[idx],surface=self.surface)
+            if type(self._sel) is slice:
+                r = range(*self._sel.indices(len(self._store)))[idx]
+                return self._subset(slice(r.start,
+                    r.stop if r.stop>=0 else None,r.step))
+            return self._subset(self._sel[idx])
         elif (type(idx) is list and len(idx)>0) or (type(idx) is np.ndarray and idx.size>0):
             if type(idx[0]) is bool or type(idx[0]) is np.bool_:
                 idx, = np.nonzero(idx)
-            if type(idx) is np.ndarray:
-                idx = idx.tolist()
-            return AfferentPopulation(*[self.afferents[i] for i in idx],surface=self.surface)
+            return self._subset(self.rows[np.asarray(idx,dtype=np.int64)])
         elif idx in Afferent.affclasses:
             return self[self.find(idx)]
         elif type(idx) is str:
-            ridx = self.surface.tag2idx(idx)
-            rr = self.region[1]
-            bidx = np.zeros((len(self,)),dtype=np.bool_)
-            for r in ridx:
-                bidx = np.logical_or(bidx,np.array([rr_sub==r for rr_sub in rr]))
-            return self[bidx]
+            return self._subset(self.rows[self.region_members(
+                self.surface.tag2idx(idx))])
         else:
             raise TypeError(
                 "Indices must be integers, slices, lists, affclass, or surface region.")
 
+    def _combine(self,other):
+        if self._store is other._store:
+            return self._store, np.concatenate((self.rows,other.rows))
+        return AfferentStore.concatenate(
+            [(self._store,self._sel),(other._store,other._sel)]), slice(None)
+
     def __add__(self,other):
-        a = AfferentPopulation()
-        a.afferents = list(self.afferents)
         if type(other) is Afferent:
-            return AfferentPopulation(*self.afferents,other)
-        elif type(other) is AfferentPopulation:
-            return AfferentPopulation(*self.afferents,*other.afferents)            
-        else:
+            other = AfferentPopulation.from_store(other._store,
+                np.array([other._row]),surface=self.surface)
+        elif type(other) is not AfferentPopulation:
             raise TypeError(
                 "Can only add elements of type Afferent or AfferentPopulation.")
-        return a
+        store,rows = self._combine(other)
+        return AfferentPopulation.from_store(store,rows,surface=self.surface)
 
     def __iadd__(self,other):
         if type(other) is Afferent:
-            self.afferents.append(other)
-        elif type(other) is AfferentPopulation:
-            self.afferents.extend(other.afferents)
-        else:
+            other = AfferentPopulation.from_store(other._store,
+                np.array([other._row]),surface=self.surface)
+        elif type(other) is not AfferentPopulation:
             raise TypeError(
                 "Can only add elements of type Afferent or AfferentPopulation.")
+        self._store,self._sel = self._combine(other)
+        self._region_index = None
         return self
 
+    @property
+    def afferents(self):
+        """Tuple of Afferent objects referring to the rows of this population;
+        use += to add afferents.
+        """
+        return tuple(Afferent._view(self._store,r,self.surface)
+            for r in self.rows)
+
     @property
     def affclass(self):
-        return list(map(lambda x:x.affclass,self.afferents))
+        return [Afferent.affclasses[c] for c in self._store.affclass[self._sel]]
 
     @affclass.setter
     def affclass(self,affclass):
         if len(affclass)!=len(self):
             raise RuntimeError(
                 "Length of affclass vector must match number of afferents")
-        for i,a in enumerate(self.afferents):
-            a.affclass=affclass[i]
+        for a in affclass:
+            check_affclass(a)
+        self._store.affclass[self._sel] =\
+            [Afferent.affclasses.index(a) for a in affclass]
 
     @property
     def gid(self):
-        return np.asarray(list(map(lambda x:x.gid,self.afferents)))
+        return np.column_stack((self._store.affclass[self._sel],
+            self._store.idx[self._sel]))
 
     @property
     def region(self):
-        return self.surface.locate(self.location)
+        ids = self._store.regions(self._sel,self.surface)
+        return self.surface.idx2tag(ids), ids
+
+    def region_members(self,ridx):
+        """Finds afferents in the population located in given regions, using
+        an index from region ids to positions that is built on first use.
+
+        Args:
+            ridx (list): Region ids.
+
+        Returns:
+            Sorted array of positions.
+        """
+        key = (self.surface,self._store.region_version)
+        cache = getattr(self,'_region_index',None)
+        if cache is None or cache[0][0] is not key[0] or cache[0][1]!=key[1]:
+            ids = self._store.regions(self._sel,self.surface)
+            key = (self.surface,self._store.region_version)
+            order = np.argsort(ids,kind='stable')
+            bounds = np.searchsorted(ids[order],np.arange(self.surface.num+1))
+            cache = (key,order,bounds)
+            self._region_index = cache
+        _,order,bounds = cache
+        ridx = [r for r in ridx if 0<=r<bounds.size-1]
+        if len(ridx)==0:
+            return np.zeros((0,),dtype=np.int64)
+        return np.sort(np.concatenate(
+            [order[bounds[r]:bounds[r+1]] for r in ridx]))
 
     @property
     def location(self):
-        return np.asarray(list(map(lambda x:x.location.flatten(),
-            self.afferents)))
+        return self._store.location[self._sel]
 
     @property
     def depth(self):
-        return np.asarray(list(map(lambda x:x.depth,self.afferents)))
+        return self._store.depth[self._sel]
 
     @property
     def parameters(self):
-        return np.asarray(list(map(lambda x:x.parameters.flatten(),
-            self.afferents)))
+        return self._store.parameters[self._sel]
 
     @property
     def noisy(self):
-        return np.asarray(list(map(lambda x:x.noisy,self.afferents)))
+        return self._store.noisy[self._sel]
 
     def find(self,affclass):
         """Finds afferents in the population of a given class.
@@ -223,20 +595,70 @@ class AfferentPopulation(object):
             affclass (string): Afferent class (e.g. 'SA1').
 
         Returns:
-            List of True/False values.
+            Boolean array.
         """
-        return list(map(lambda x:x.affclass==affclass,self.afferents))
+        return self._store.affclass[self._sel]==Afferent.affclasses.index(affclass)
+
+    def index(self,other):
+        """Finds the positions of afferents within the population.
+
+        Args:
+            other (Afferent or AfferentPopulation): Afferent(s) sharing storage
+                with this population.
 
-    def response(self,stim):
+        Returns:
+            Array of positions.
+        """
+        if type(other) is Afferent:
+            rows = np.array([other._row])
+        else:
+            rows = other.rows
+        if other._store is not self._store:
+            raise ValueError("Afferents are not part of this population.")
+        pos = -np.ones(len(self._store),dtype=np.int64)
+        pos[self.rows] = np.arange(len(self))
+        pos = pos[rows]
+        if np.any(pos<0):
+            raise ValueError("Afferents are not part of this population.")
+        return pos
+
+    def response(self,stim,**args):
         """Calculates the afferent population's spiking response to a tactile
         stimulus.
 
         Args:
             stim (Stimulus object): The tactile stimulus.
 
+        Kwargs:
+            seed (int): Random number seed for membrane noise; noise is drawn
+                from a separate stream for each stimulus and afferent, keyed by
+                the afferent's row in the AfferentStore, so responses do not
+                depend on how the population is split up or sliced
+                (default: None).
+            tol (float): Relative tolerance for sparse propagation; pin-afferent
+                pairs whose coupling falls below tol times its maximum are
+                skipped. None propagates between all pairs (default: None).
+            resample (str): Quality of resampling stimuli to 5000 Hz: 'fast',
+                'default', 'high', or 'fft' (default: 'default').
+            dtype: Precision of propagation, filtering, and integration,
+                np.float64 or np.float32; the surface profile is always
+                computed in double precision (default: np.float64).
+            callback (callable): Receives an event dict for every simulation
+                stage of this call, which runs in the calling thread, see
+                touchsim.instrument (default: None).
+
         Returns:
             Response object.
         """
+        callback = args.get('callback',None)
+        if callback is not None:
+            add_listener(callback,local=True)
+            try:
+                return self.response(stim,**{k: v for k,v in args.items()
+                    if k!='callback'})
+            finally:
+                remove_listener(callback,local=True)
+
         assert type(stim) is Stimulus or type(stim[0]) is Stimulus,\
             "Argument needs to be Stimulus object or an iterable over Stimulus objects."
 
@@ -245,16 +667,133 @@ class AfferentPopulation(object):
         except:
             stim = [stim]
             s_iter = iter(stim)
+        seed = args.get('seed',None)
         r = list()
-        for s in s_iter:
-            strain, udyn, fs = s.propagate(self)
-            if not isclose(fs,5000.):
-                strain = resample(strain,int(round(strain.shape[0]/fs*5000.)))
-                udyn = resample(udyn,int(round(udyn.shape[0]/fs*5000.)))
+        for i,s in enumerate(s_iter):
+            r.append(self.spikes(s,seed=noise_seeds(seed,i,self.rows),
+                tol=args.get('tol',None),
+                resample=args.get('resample','default'),
+                dtype=args.get('dtype',np.float64),csr=True))
+        return Response.from_csr(self,stim,*stack_csr(r))
+
+    def spikes(self,stim,**args):
+        """Calculates spike times of all afferents in response to a single
+        stimulus.
+
+        Args:
+            stim (Stimulus object): The tactile stimulus.
+
+        Kwargs:
+            seed (2D array): Per-afferent random number seeds for membrane noise,
+                see noise_seeds() (default: None).
+            tol (float): Relative tolerance for sparse propagation, see
+                Stimulus.propagate() (default: None).
+            resample (str): Resampling quality, see Stimulus.propagate()
+                (default: 'default').
+            dtype: Simulation precision, see response() (default: np.float64).
+            csr (bool): Return spikes in compressed form, see
+                LIFStream.integrate() (default: False).
+
+        Returns:
+            List of arrays containing the spike times for each afferent, or a
+            tuple of offsets and concatenated spike times if csr is True.
+        """
+        lif = LIFStream(self,seed=args.get('seed',None))
+        # the surface profile is resampled per pin before propagation, which
+        # targets the afferents in the order they are filtered in
+        strain, udyn, fs = stim.propagate(lif.sorted(self),
+            tol=args.get('tol',None),fs=LIFStream.srate,
+            resample=args.get('resample','default'),
+            dtype=args.get('dtype',np.float64))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore") # suppress underflow warnings
+            return lif.process(strain,udyn,final=True,presorted=True,
+                csr=args.get('csr',False))
+
+    def response_stream(self,stim,**args):
+        """Simulates the response to a long stimulus block by block, so that
+        memory use is bounded by the block size rather than the stimulus
+        duration. Filter states, membrane voltages, and the tail of the
+        propagating waves are carried across blocks; the concatenated output
+        equals that of spikes().
+
+        Args:
+            stim (Stimulus object): The tactile stimulus. At sampling rates
+                other than 5000 Hz, the surface profile is computed and
+                resampled in full (pins x samples) before streaming.
+
+        Kwargs:
+            block (int): Number of samples per block (default: 5000).
+            seed (int): Random number seed for membrane noise (default: None).
+            tol (float): Relative tolerance for sparse propagation, see
+                Stimulus.propagate() (default: None).
+            resample (str): Resampling quality, see Stimulus.propagate()
+                (default: 'default').
+            dtype: Simulation precision, see response() (default: np.float64).
+
+        Yields:
+            Lists of arrays containing the spike times for each afferent
+            within each block.
+        """
+        block = int(args.get('block',5000))
+        tol = args.get('tol',None)
+        dtype = check_dtype(args.get('dtype',np.float64))
+        if block<1:
+            raise ValueError("Block size must be positive.")
+        lif = LIFStream(self,seed=noise_seeds(args.get('seed',None),0,
+            self.rows))
+        aff = lif.sorted(self)
+
+        fs = LIFStream.srate
+        if isclose(stim.fs,fs):
+            T = stim.trace.shape[1]
+            profile = stim.profile_block
+        else:
+            Pall,Pdynall = stim.resampled_profile(fs,
+                args.get('resample','default'))
+            T = Pall.shape[0]
+            profile = lambda a,b: (Pall[a:b],Pdynall[:,a:b])
+
+        # samples of the dynamic profile that waves may still travel over
+        nhist = max_delay(stim.location,stim.pin_radius,aff.location,fs,
+            aff.surface)
+        hist = np.zeros((stim.location.shape[0],nhist),dtype=dtype)\
+            if nhist>0 else None
+
+        for start in range(0,T,block):
+            stop = min(start+block,T)
+            P,Pdyn = profile(start,stop)
+            P = P.astype(dtype,copy=False)
+            Pdyn = Pdyn.astype(dtype,copy=False)
+            strain = circ_load_vert_stress(P,stim.location,stim.pin_radius,
+                aff.location,aff.depth,tol=tol)
+            udyn = circ_load_dyn_wave(Pdyn,stim.location,stim.pin_radius,
+                aff.location,aff.depth,fs,aff.surface,history=hist,tol=tol)
+            if hist is not None:
+                hist = np.concatenate((hist,Pdyn),axis=1)[:,-nhist:]
             with warnings.catch_warnings():
-                warnings.simplefilter("ignore") # suppress underflow warnings
-                r.append(lif_neuron(self,strain,udyn))
-        return Response(self,stim,r)
+                warnings.simplefilter("ignore")
+                yield lif.process(strain,udyn,final=stop==T,presorted=True)
+
+
+def noise_seeds(seed,stim_idx,aff_idx):
+    """Derives per-afferent noise seeds for one stimulus.
+
+    Args:
+        seed (int): Base random number seed; None disables seeding.
+        stim_idx (int): Index of the stimulus.
+        aff_idx (array): Rows of the afferents in their AfferentStore, which
+            identify them independent of the population they are simulated
+            in.
+
+    Returns:
+        Nx3 array of seeds, or None if seed is None.
+    """
+    if seed is None:
+        return None
+    aff_idx = np.asarray(aff_idx,dtype=np.int64)
+    return np.column_stack((np.full(aff_idx.size,seed,dtype=np.int64),
+        np.full(aff_idx.size,stim_idx,dtype=np.int64),aff_idx))
 
 
 class Stimulus(object):
@@ -269,12 +808,18 @@ class Stimulus(object):
             location (Nx2 array) = np.atleast_2d(args.get('location',np.array([[0., 0.]])))
             fs (float): Sampling frequency (default: 1000.).
             pin_radius (float): Pin radius in mm (default: 0.05).
+            profile (bool): Whether to compute the surface profile right away;
+                otherwise it is computed on first use, which streamed responses
+                never need (default: True).
         """
         self.trace = np.atleast_2d(args.get('trace',np.array([[]])))
         self.location = np.atleast_2d(args.get('location',np.array([[0., 0.]])))
         self.fs = args.get('fs',1000.)
         self.pin_radius = args.get('pin_radius',.05)
-        self.compute_profile()
+        if args.get('profile',True):
+            self.compute_profile()
+        else:
+            self.check_radius()
 
     def __str__(self):
         return 'Stimulus with ' + str(self.location.shape[0]) +\
@@ -301,14 +846,32 @@ class Stimulus(object):
         if self.duration!=other.duration:
             raise RuntimeError("Stimulus durations must be the same.")
 
+        old = (self.trace,self.pin_radius,getattr(self,'_profile',None))
         self.trace = np.concatenate([self.trace,other.trace])
         self.location = np.concatenate([self.location,other.location])
-        self.compute_profile()
+        if old[2] is None:
+            self.check_radius()
+            return self
+
+        self.check_radius()
+        # reuse the solution at samples where only one set of pins is
+        # indenting, as long as the pin radius did not change
+        n = old[0].shape[0]
+        rows = np.zeros(self.trace.shape[1],dtype=bool)
+        Pk = np.zeros((self.trace.shape[1],self.trace.shape[0]))
+        if old[1]==self.pin_radius:
+            r = np.all(other.trace==0.,axis=0)
+            Pk[r,:n] = old[2][r]
+            rows |= r
+        if other.pin_radius==self.pin_radius and hasattr(other,'_profile'):
+            r = np.all(old[0]==0.,axis=0)
+            Pk[r,n:] = other._profile[r]
+            rows |= r
+        self.compute_profile(known=(rows,Pk[rows]))
         return self
 
-    def compute_profile(self):
-        """Computes surface profile over time. This method is executed
-        automatically whenever the 'trace' property changes.
+    def check_radius(self):
+        """Shrinks the pin radius if pins would overlap.
         """
         new_radius = check_pin_radius(self.location,self.pin_radius)
         if self.pin_radius>new_radius:
@@ -316,30 +879,145 @@ class Stimulus(object):
                 "Pin radius too big and has been adjusted to %.1f" % new_radius)
             self.pin_radius = new_radius
 
-        self._profile, self._profiledyn = skin_touch_profile(
-            self.trace,self.location,self.fs,self.pin_radius)
+    def compute_profile(self,known=None):
+        """Computes surface profile over time. This method is executed
+        automatically whenever the 'trace' property changes. Profiles are
+        cached, so that stimuli differing only in amplitude are solved once.
+
+        Args:
+            known (tuple): Boolean mask of samples with known solution and the
+                static profile at those samples (default: None).
+        """
+        self.check_radius()
+        self._resampled = {}
+        h0 = cache_counts(profile_cache,factor_cache)
+        with stage('profile',shape=self.trace.shape) as ev:
+            self._profile, self._profiledyn = scaled_skin_touch_profile(
+                self.trace,self.location,self.fs,self.pin_radius,known)
+            h1 = cache_counts(profile_cache,factor_cache)
+            ev['cache_hits'],ev['cache_misses'] = h1[0]-h0[0],h1[1]-h0[1]
+            ev['bytes'] = self._profile.nbytes + self._profiledyn.nbytes
+
+    def resampled_profile(self,fs,quality='default'):
+        """Returns the surface profile resampled to another sampling rate.
+        Resampled profiles are kept with the stimulus, so that they are
+        computed only once for all afferents.
+
+        Args:
+            fs (float): Target sampling frequency.
+            quality (str): 'fast', 'default', 'high' (rational polyphase
+                filters of increasing length), or 'fft' (default: 'default').
+
+        Returns:
+            Tuple consisting of the static and dynamic profile.
+        """
+        if not hasattr(self,'_profile'):
+            self.compute_profile()
+        if isclose(fs,self.fs):
+            return self._profile, self._profiledyn
+        key = (float(fs),quality)
+        if key not in self._resampled:
+            with stage('resample',fs=self.fs,shape=self._profile.shape) as ev:
+                P = resample_profile(self._profile,self.fs,fs,quality,axis=0)
+                Pdyn = resample_profile(self._profiledyn,self.fs,fs,quality,
+                    axis=1)
+                ev['bytes'] = P.nbytes + Pdyn.nbytes
+            self._resampled[key] = (P,Pdyn)
+        return self._resampled[key]
+
+    def profile_block(self,start,stop):
+        """Computes the surface profile for a range of samples only. Each
+        sample's profile depends on its immediate neighbours alone, so blocks
+        are computed with a margin of two samples on either side.
+
+        Args:
+            start (int): First sample.
+            stop (int): Sample after the last one.
+
+        Returns:
+            Tuple consisting of the static and dynamic profile of the block.
+        """
+        a = max(start-2,0)
+        b = min(stop+2,self.trace.shape[1])
+        P,Pdyn = skin_touch_profile(
+            self.trace[:,a:b],self.location,self.fs,self.pin_radius)
+        return P[start-a:stop-a], Pdyn[:,start-a:stop-a]
 
-    def propagate(self,aff):
+    def propagate(self,aff,**args):
         """Propagates the stimulus to specific afferent locations.
 
         Args:
             aff (Afferent or AfferentPopulation object): The afferent location(s)
                 the stimulus is propagated to.
 
+        Kwargs:
+            tol (float): Relative tolerance for sparse propagation. Pin-afferent
+                pairs are found with a KD-tree, and pairs whose static stress or
+                wave amplitude falls below tol times its value under the pin are
+                skipped, which saves time for large stimuli on large
+                populations. None propagates between all pairs (default: None).
+            fs (float): Sampling frequency of the output; the surface profile
+                is resampled per pin before propagation (default: fs of the
+                stimulus).
+            resample (str): Resampling quality, see resampled_profile()
+                (default: 'default').
+            dtype: Precision of the output, np.float64 or np.float32; the
+                profile is computed in double precision and converted
+                (default: np.float64).
+
         Returns:
             Tuple consisting of the static mechanical component, the dynamic
             mechanical component, and the sampling rate.
         """
-        stat_comp = circ_load_vert_stress(
-            self._profile,self.location,self.pin_radius,aff.location,aff.depth)
-        dyn_comp = circ_load_dyn_wave(
-            self._profiledyn,self.location,self.pin_radius,aff.location,
-                aff.depth,self.fs,aff.surface)
-        return stat_comp, dyn_comp, self.fs
+        fs = args.get('fs',self.fs)
+        dtype = check_dtype(args.get('dtype',np.float64))
+        P,Pdyn = self.resampled_profile(fs,args.get('resample','default'))
+        P = P.astype(dtype,copy=False)
+        Pdyn = Pdyn.astype(dtype,copy=False)
+        tol = args.get('tol',None)
+        with stage('static',pins=len(self),afferents=len(aff),
+            tol=tol) as ev:
+            stat_comp = circ_load_vert_stress(
+                P,self.location,self.pin_radius,aff.location,
+                    aff.depth,tol=tol)
+            ev['bytes'] = stat_comp.nbytes
+
+        h0 = cache_counts(getattr(aff.surface,'_distance_lru',None))
+        with stage('dynamic',pins=len(self),afferents=len(aff),
+            tol=tol) as ev:
+            dyn_comp = circ_load_dyn_wave(
+                Pdyn,self.location,self.pin_radius,aff.location,
+                    aff.depth,fs,aff.surface,tol=tol)
+            h1 = cache_counts(getattr(aff.surface,'_distance_lru',None))
+            ev['cache_hits'],ev['cache_misses'] = h1[0]-h0[0],h1[1]-h0[1]
+            ev['bytes'] = dyn_comp.nbytes
+        return stat_comp, dyn_comp, fs
+
+
+def stack_csr(parts):
+    """Stacks compressed spike lists, e.g. of several stimuli.
+
+    Args:
+        parts (list): Tuples of offsets and concatenated spike times.
+
+    Returns:
+        Tuple of offsets and spike times of all parts.
+    """
+    offsets = [np.zeros(1,dtype=np.int64)]
+    base = 0
+    for o,_ in parts:
+        offsets.append(o[1:]+base)
+        base += o[-1]
+    times = np.concatenate([t for _,t in parts]) if len(parts)>0 else\
+        np.zeros(0)
+    return np.concatenate(offsets), times
 
 
 class Response(object):
-    """A Response by an AfferentPopulation to a Stimulus.
+    """A Response by an AfferentPopulation to a Stimulus. Spikes are stored in
+    columnar form: one array of spike times, ordered by stimulus and then by
+    afferent, and an array of offsets into it, where the spikes of afferent i
+    to stimulus s are times[offsets[s*N+i]:offsets[s*N+i+1]].
     """
 
     def __init__(self,a,s,r):
@@ -360,9 +1038,38 @@ class Response(object):
         assert len(s)==len(r)
         assert len(a)==len(r[0])
 
+        counts = np.array([len(x) for ri in r for x in ri],dtype=np.int64)
+        offsets = np.zeros(counts.size+1,dtype=np.int64)
+        np.cumsum(counts,out=offsets[1:])
+        times = np.concatenate([np.asarray(x,dtype=float) for ri in r
+            for x in ri]) if counts.size>0 else np.zeros(0)
+        self._init(a,s,offsets,times)
+
+    @classmethod
+    def from_csr(cls,a,s,offsets,times):
+        """Creates a Response from spikes in columnar form.
+
+        Args:
+            a (AfferentPopulation): The population of responding afferents.
+            s (list): The Stimuli that the afferents are responding to.
+            offsets (1D array): Offsets into times (stimuli*afferents+1).
+            times (1D array): Spike times ordered by stimulus, then afferent.
+
+        Returns:
+            Response object.
+        """
+        assert len(offsets)==len(s)*len(a)+1
+        assert offsets[-1]==len(times)
+        r = cls.__new__(cls)
+        r._init(a,s,np.asarray(offsets,dtype=np.int64),np.asarray(times))
+        return r
+
+    def _init(self,a,s,offsets,times):
         self.aff = a
         self.stim = s
-        self._spikes = r
+        self._offsets = offsets
+        self._times = times
+        self._pos = None
 
     def __str__(self):
         return 'Response consisting of:\n* ' + self.aff.__str__() + '\n* ' +\
@@ -373,21 +1080,51 @@ class Response(object):
     def __len__(self):
         return len(self.aff)
 
+    def _positions(self,other):
+        # positions of afferents sharing storage with this population; the
+        # lookup table is built once, so that indexing costs O(k)
+        if type(other) is Afferent:
+            rows = np.array([other._row])
+        else:
+            rows = other.rows
+        if other._store is not self.aff._store:
+            raise ValueError("Afferents are not part of this population.")
+        if self._pos is None:
+            self._pos = -np.ones(len(self.aff._store),dtype=np.int64)
+            self._pos[self.aff.rows] = np.arange(len(self.aff))
+        pos = self._pos[rows]
+        if np.any(pos<0):
+            raise ValueError("Afferents are not part of this population.")
+        return pos
+
     def __getitem__(self,idx):
+        """Selects the response of some afferents.
+
+        Args:
+            idx: Afferent or AfferentPopulation object sharing storage with
+                the responding population, or any index of
+                AfferentPopulation.__getitem__ (positions, slices, boolean
+                masks, affclass, or surface region).
+
+        Returns:
+            Response object.
+        """
         if type(idx) is Afferent:
             a = AfferentPopulation(idx)
-            ii = [self.aff.afferents.index(idx)]
+            ii = self._positions(idx)
         elif type(idx) is AfferentPopulation:
             a = idx
-            ii = [self.aff.afferents.index(a) for a in idx]
+            ii = self._positions(idx)
         else:
-            raise TypeError("Index must be Afferent or AfferentPopulation.")
+            if type(idx) is int or type(idx) is np.int64:
+                idx = [idx]
+            a = self.aff[idx]
+            ii = self._positions(a)
 
-        r = list()
-        for i in range(len(self.stim)):
-            r_new = [self._spikes[i][iii] for iii in ii]
-            r.append(r_new)
-        return Response(a,self.stim,r)
+        n = len(self.aff)
+        rows = (np.arange(len(self.stim))[:,None]*n + ii).ravel()
+        offsets,times = csr_take(self._offsets,self._times,rows)
+        return Response.from_csr(a,self.stim,offsets,times)
 
     @property
     def duration(self):
@@ -400,17 +1137,41 @@ class Response(object):
     def durations(self):
         return [s.duration for s in iter(self.stim)]
 
+    @property
+    def counts(self):
+        """Number of spikes per afferent and stimulus (NxS array)."""
+        return np.diff(self._offsets).reshape(len(self.stim),-1).T
+
+    @property
+    def _spikes(self):
+        n = len(self.aff)
+        sp = np.split(self._times,self._offsets[1:-1])
+        return [sp[i*n:(i+1)*n] for i in range(len(self.stim))]
+
+    def columns(self):
+        """Returns all spikes on the concatenated time line of all stimuli in
+        columnar form, ordered by afferent.
+
+        Returns:
+            Tuple of offsets (N+1) and spike times, where the spikes of
+            afferent i are times[offsets[i]:offsets[i+1]].
+        """
+        ns = len(self.stim)
+        if ns==1:
+            return self._offsets, self._times
+        n = len(self.aff)
+        start = np.concatenate(([0.],np.cumsum(self.durations)[:-1]))
+        counts = np.diff(self._offsets)
+        times = self._times +\
+            np.repeat(np.repeat(start,n),counts)
+        rows = np.arange(ns*n).reshape(ns,n).T.ravel()
+        offsets,times = csr_take(self._offsets,times,rows)
+        return offsets[::ns], times
+
     @property
     def spikes(self):
-        if len(self.stim)==1:
-            return self._spikes[0]
-        else:
-            sp = [np.array([]) for i in range(len(self._spikes[0]))]
-            cum_dur = 0.
-            for s in range(len(self._spikes)):
-                sp = [np.concatenate((sp[i],self._spikes[s][i]+cum_dur)) for i in range(len(self._spikes[0]))]
-                cum_dur += self.stim[s].duration
-            return sp
+        offsets,times = self.columns()
+        return np.split(times,offsets[1:-1])
 
     def rate(self,sep=False):
         """Calculates the firing rate (in Hz) for each afferent.
@@ -422,22 +1183,49 @@ class Response(object):
         Returns:
             Nx1 array of firing rates (NxS is sep is True).
         """
-        r = np.zeros((len(self.aff),len(self.stim)))
-        for i,s in enumerate(self._spikes):
-            r[:,i:i+1] = (np.atleast_2d(np.array(list(map(lambda x:x.size, s)))) \
-                /self.durations[i]).T
+        r = self.counts/np.array(self.durations)
         if not sep:
             r = np.atleast_2d(np.mean(r,axis=1)).T
         return r
 
+    def count(self,window):
+        """Counts spikes of each afferent within time windows on the
+        concatenated time line of all stimuli.
+
+        Args:
+            window (array): Start and end of a window in s, or Wx2 array of
+                windows; windows include their start but not their end.
+
+        Returns:
+            NxW array of spike counts.
+        """
+        window = np.atleast_2d(window)
+        offsets,times = self.columns()
+        aff = np.repeat(np.arange(len(self.aff)),np.diff(offsets))
+        out = np.zeros((len(self.aff),window.shape[0]),dtype=np.int64)
+        for w,(a,b) in enumerate(window):
+            out[:,w] = np.bincount(aff[(times>=a) & (times<b)],
+                minlength=len(self.aff))
+        return out
+
     def psth(self,bin=10.,**args):
         """Calculates the time-varying response (psth) for each afferent.
 
         Kwargs:
             bin (float): Length of the time bins in ms (default: 10.).
+            bins (array): Bin edges in s, overriding bin (default: None).
 
         Returns:
-            NxB array of firing rates (N: number of afferents, B: number of bins).
+            NxB array of spike counts (N: number of afferents, B: number of bins).
         """
         bins = args.get('bins', np.r_[0:self.duration+bin/1000.:bin/1000.])
-        return np.array(list(map(lambda x:np.histogram(x,bins=bins)[0],self.spikes)))
+        bins = np.asarray(bins)
+        nb = bins.size-1
+        offsets,times = self.columns()
+        aff = np.repeat(np.arange(len(self.aff)),np.diff(offsets))
+        # same bins as np.histogram: half-open, apart from the last one
+        b = np.searchsorted(bins,times,side='right')-1
+        b[times==bins[-1]] = nb-1
+        keep = (b>=0) & (b<nb)
+        return np.bincount(aff[keep]*nb+b[keep],
+            minlength=len(self.aff)*nb).reshape(len(self.aff),nb)
@@ -0,0 +1,197 @@
+import numpy as np
+import json
+import os
+
+from .classes import AfferentPopulation, AfferentStore, Response
+from .surface import null_surface
+
+format_name = 'touchsim-response'
+format_version = 1
+
+class StimulusInfo(object):
+    """Stands in for the stimuli of loaded responses, which only keep the name,
+    sampling frequency, and duration of each stimulus.
+    """
+
+    def __init__(self,name,fs,duration):
+        self.name = name
+        self.fs = fs
+        self.duration = duration
+
+    def __str__(self):
+        return 'Stimulus ' + str(self.name) + ' with ' + str(self.duration) +\
+            ' s duration at ' + str(self.fs) + ' Hz.'
+
+
+class ResponseWriter(object):
+    """Writes responses into a binary file as they are generated, e.g.
+
+        with ResponseWriter('out.tsr',bin_size=10.) as w:
+            for label,a in models.items():
+                w.write(label,a.response(s),stimuli=['ramp'],model=label)
+
+    Each response is appended to the data file as flat arrays: spike times
+    ordered by stimulus and afferent, spike counts per stimulus and afferent,
+    and the columns of the afferents' AfferentStore (except region ids, which
+    are located again on the surface given on load). A JSON file next to it
+    (path + '.json') lists the entries with their byte offsets, stimulus names,
+    sampling frequencies and durations, and user attributes. It is rewritten
+    after every entry, so that the file stays readable if writing stops
+    midway. Use load_responses() to read it back.
+    """
+
+    def __init__(self,path,**attrs):
+        """Initializes a ResponseWriter object, replacing existing files.
+
+        Args:
+            path (str): Data file.
+
+        Kwargs:
+            All kwargs are stored as file attributes (JSON serializable).
+        """
+        self.path = path
+        self.meta = {'format': format_name,'version': format_version,
+            'attrs': attrs,'entries': []}
+        self._file = open(path,'wb')
+        self._write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+        return False
+
+    def _append(self,arr):
+        arr = np.ascontiguousarray(arr)
+        offset = self._file.tell()
+        self._file.write(arr.tobytes())
+        # keep every array 8-byte aligned for memory mapping
+        self._file.write(b'\0'*(-arr.nbytes % 8))
+        return {'offset': offset,'dtype': arr.dtype.str,'shape': arr.shape}
+
+    def _write_meta(self):
+        tmp = self.path + '.json.tmp'
+        with open(tmp,'w') as f:
+            json.dump(self.meta,f)
+        os.replace(tmp,self.path + '.json')
+
+    def write(self,name,response,**args):
+        """Appends a response.
+
+        Args:
+            name (str): Name of the entry.
+            response (Response object): The response.
+
+        Kwargs:
+            stimuli (list): Names of the stimuli (default: their positions).
+            All other kwargs are stored as entry attributes (JSON
+            serializable).
+        """
+        names = args.pop('stimuli',None)
+        if names is None:
+            names = [str(i) for i in range(len(response.stim))]
+        if len(names)!=len(response.stim):
+            raise ValueError("Need one name per stimulus.")
+
+        a = response.aff
+        store = a._store
+        arrays = {'times': self._append(response._times.astype(np.float64)),
+            'counts': self._append(np.diff(response._offsets))}
+        # region ids are only valid for the surface object they were located
+        # on, so they are not stored
+        for f in AfferentStore.fields:
+            if f!='region':
+                arrays[f] = self._append(getattr(store,f)[a._sel])
+        self._file.flush()
+
+        self.meta['entries'].append({'name': name,'attrs': args,
+            'afferents': len(a),'arrays': arrays,
+            'stimuli': [{'name': str(n),'fs': float(getattr(s,'fs',np.nan)),
+                'duration': float(s.duration)}
+                for n,s in zip(names,response.stim)]})
+        self._write_meta()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+def save_responses(path,responses,**attrs):
+    """Writes several responses at once, see ResponseWriter.
+
+    Args:
+        path (str): Data file.
+        responses (dict): Responses by entry name.
+
+    Kwargs:
+        All kwargs are stored as file attributes.
+    """
+    with ResponseWriter(path,**attrs) as w:
+        for name,r in responses.items():
+            w.write(name,r)
+
+def load_meta(path):
+    """Reads the entry list of a response file.
+
+    Returns:
+        Dict with format, version, attrs, and entries.
+    """
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    if meta.get('format')!=format_name:
+        raise ValueError("Not a touchsim response file.")
+    if meta.get('version',0)>format_version:
+        raise ValueError("Response file version %d is not supported." %
+            meta['version'])
+    return meta
+
+def load_responses(path,**args):
+    """Reads responses written by ResponseWriter.
+
+    Args:
+        path (str): Data file.
+
+    Kwargs:
+        mmap (bool): Memory-maps the data file instead of reading it, so that
+            spike times are only loaded when accessed (default: True).
+        surface (Surface object): Surface of the afferents (default:
+            null_surface).
+
+    Returns:
+        Dict of Response objects by entry name, in the order they were written.
+        Their stimuli are StimulusInfo objects; entry attributes are available
+        as the attrs attribute of each response.
+    """
+    meta = load_meta(path)
+    if len(meta['entries'])==0:
+        # e.g. writing was stopped before the first entry
+        return {}
+    # empty files cannot be memory-mapped
+    if args.get('mmap',True) and os.path.getsize(path)>0:
+        data = np.memmap(path,dtype=np.uint8,mode='r')
+    else:
+        data = np.fromfile(path,dtype=np.uint8)
+
+    def view(spec):
+        dtype = np.dtype(spec['dtype'])
+        n = int(np.prod(spec['shape']))
+        return data[spec['offset']:spec['offset']+n*dtype.itemsize].view(
+            dtype).reshape(spec['shape'])
+
+    out = {}
+    for e in meta['entries']:
+        arr = e['arrays']
+        store = AfferentStore(**{f: view(arr[f])
+            for f in AfferentStore.fields if f in arr})
+        a = AfferentPopulation.from_store(store,
+            surface=args.get('surface',null_surface))
+        counts = view(arr['counts'])
+        offsets = np.zeros(counts.size+1,dtype=np.int64)
+        np.cumsum(counts,out=offsets[1:])
+        stim = [StimulusInfo(s['name'],s['fs'],s['duration'])
+            for s in e['stimuli']]
+        r = Response.from_csr(a,stim,offsets,view(arr['times']))
+        r.attrs = e['attrs']
+        out[e['name']] = r
+    return out
@@ -1,6 +1,5 @@
 import numpy as np
 from scipy import signal
-import random
 
 from .classes import Afferent,AfferentPopulation,Stimulus
 from .surface import Surface, hand_surface
@@ -24,7 +23,7 @@ def affpop_single_models(**args):
 
     Kwargs:
         affclass: Single affclass or list, e.g. ['SA1','RA'] (default: all).
-        args: All other kwargs will be passed on to Afferent constructor.
+        args: All other kwargs will be passed on to AfferentPopulation.from_arrays.
 
     Returns:
         AfferentPopulation object.
@@ -32,11 +31,36 @@ def affpop_single_models(**args):
     affclass = args.pop('affclass',default_params['affclass'])
     if type(affclass) is not list:
         affclass = [affclass]
-    a = AfferentPopulation()
-    for t in affclass:
-        for i in range(Afferent.affparams.get(t).shape[0]):
-            a.afferents.append(Afferent(t,idx=i,**args))
-    return a
+    location = args.pop('location',np.array([0., 0.]))
+    t,idx = single_models(affclass)
+    return AfferentPopulation.from_arrays(t,
+        np.tile(np.reshape(location,(1,2)),(t.size,1)),idx=idx,**args)
+
+
+def single_models(affclass):
+    """Enumerates all neuron models of the given afferent classes.
+
+    Args:
+        affclass (list): Afferent classes.
+
+    Returns:
+        Tuple containing an array of afferent classes and an array of model ids.
+    """
+    n = [Afferent.affparams.get(t).shape[0] for t in affclass]
+    return np.repeat(affclass,n), np.concatenate([np.arange(k) for k in n])
+
+
+def affpop_locations(locs,affclass,idx,**args):
+    """Places afferents at each of the given locations, either one per afferent
+    class with model idx, or one per single neuron model if idx is None.
+    """
+    if idx is None:
+        t,idx = single_models(affclass)
+    else:
+        t = np.array(affclass)
+        idx = np.tile(idx,len(affclass))
+    return AfferentPopulation.from_arrays(np.tile(t,locs.shape[0]),
+        np.repeat(locs,t.size,axis=0),idx=np.tile(idx,locs.shape[0]),**args)
 
 
 def affpop_linear(**args):
@@ -48,7 +72,7 @@ def affpop_linear(**args):
         max_extent (float): distance of farthest afferent in mm (default: 10.).
         affclass (str or list): Single affclass or list (default: ['SA1','RA','PC']).
         idx (int): Afferent model index; None (default) picks all available.
-        args: All other kwargs will be passed on to Afferent constructor.
+        args: All other kwargs will be passed on to AfferentPopulation.from_arrays.
 
     Returns:
         AfferentPopulation object.
@@ -61,18 +85,9 @@ def affpop_linear(**args):
     idx = args.pop('idx',default_params['idx'])
 
     locs = np.r_[0.:max_extent+dist:dist]
+    locs = np.column_stack((locs,np.zeros(locs.shape)))
 
-    a = AfferentPopulation()
-
-    for l in np.nditer(locs):
-        if idx is None:
-            a_sub = affpop_single_models(location=np.array([l,0]),**args)
-            a.afferents.extend(a_sub.afferents)
-        else:
-            for t in affclass:
-                a.afferents.append(
-                    Afferent(t,location=np.array([l,0]),idx=idx,**args))
-    return a
+    return affpop_locations(locs,affclass,idx,**args)
 
 
 def affpop_grid(**args):
@@ -84,7 +99,7 @@ def affpop_grid(**args):
         max_extent (float): length of square in mm (default: 10.).
         affclass (str or list): Single affclass or list (default: ['SA1','RA','PC']).
         idx (int): Afferent model index; None (default) picks all available.
-        args: All other kwargs will be passed on to Afferent constructor.
+        args: All other kwargs will be passed on to AfferentPopulation.from_arrays.
 
     Returns:
         AfferentPopulation object.
@@ -97,20 +112,10 @@ def affpop_grid(**args):
     idx = args.pop('idx',default_params['idx'])
 
     locs = np.r_[-max_extent/2:max_extent/2+dist:dist]
+    l1,l2 = np.meshgrid(locs,locs,indexing='ij')
+    locs = np.column_stack((l1.flatten(),l2.flatten()))
 
-    a = AfferentPopulation()
-
-    for l1 in np.nditer(locs):
-        for l2 in np.nditer(locs):
-            if idx is None:
-                a_sub = affpop_single_models(
-                    location=np.array([l1,l2]),**args)
-                a.afferents.extend(a_sub.afferents)
-            else:
-                for t in affclass:
-                    a.afferents.append(
-                        Afferent(t,location=np.array([l1,l2]),idx=idx,**args))
-    return a
+    return affpop_locations(locs,affclass,idx,**args)
 
 
 def affpop_hand(**args):
@@ -126,7 +131,9 @@ def affpop_hand(**args):
             (default: hand_surface.density).
         density_multiplier (float): Allows proportional scaling of densities
             (default: 1.).
-        args: All other kwargs will be passed on to Afferent constructor.
+        seed (int): Random number seed for afferent placement and model choice
+            (default: None).
+        args: All other kwargs will be passed on to AfferentPopulation.from_arrays.
 
     Returns:
         AfferentPopulation object.
@@ -144,22 +151,15 @@ def affpop_surface(**args):
     if type(affclass) is not list:
         affclass = [affclass]
     region = args.pop('region',None)
-    seed = args.pop('seed',None)
-
-    if seed is not None:
-        random.seed(seed)
+    # independent streams for placement and for choosing neuron models
+    place_seed,model_seed = np.random.SeedSequence(args.pop('seed',None)).spawn(2)
 
-    idx = surface.tag2idx(region)
+    xy,t,r = surface.sample_afferents(affclass,region,density=density,
+        density_multiplier=density_multiplier,seed=place_seed)
 
-    afferents = list()
-    for a in affclass:
-        for i in idx:
-            dens = density_multiplier*density[(a,i)]
-            xy = surface.sample_uniform(i,density=dens,seed=seed)
-            for l in range(xy.shape[0]):
-                afferents.append(Afferent(a,location=xy[l,:],**args))
-    affpop = AfferentPopulation(surface=surface,*afferents)
-    return affpop
+    # the sampled region of each afferent is known, so it need not be located
+    return AfferentPopulation.from_arrays(t,xy,seed=model_seed,surface=surface,
+        region=r,**args)
 
 def stim_sine(**args):
     """Generates indenting complex sine stimulus.
@@ -234,12 +234,9 @@ def stim_noise(**args):
     pin_radius = args.get('pin_radius',default_params['pin_radius'])
     pre_indent = args.get('pre_indent',default_params['pre_indent'])
     pad_len = args.get('pad_len',default_params['pad_len'])
-    seed = args.get('seed',None)
-
-    if seed is not None:
-        np.random.seed(seed)
+    rng = np.random.RandomState(args.get('seed',None))
 
-    trace = np.random.randn(int(fs*len))
+    trace = rng.randn(int(fs*len))
 
     bfilt,afilt = signal.butter(3,np.array(freq)/fs/2.,btype='bandpass')
     trace = signal.lfilter(bfilt,afilt,trace)
@@ -0,0 +1,185 @@
+import numpy as np
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+_listeners = []
+_lock = threading.Lock()
+# listeners that only receive events of the thread that registered them
+_local = threading.local()
+
+def _local_listeners():
+    if not hasattr(_local,'listeners'):
+        _local.listeners = []
+    return _local.listeners
+
+def add_listener(callback,local=False):
+    """Registers a callback that receives an event dict for every completed
+    simulation stage.
+
+    Args:
+        callback (callable): Function taking a single event dict with keys
+            'stage', 'start', 'time', 'thread', and stage-specific entries such
+            as array shapes, 'bytes', and 'cache_hits'.
+        local (bool): Only report stages run by the calling thread, rather than
+            by all threads (default: False).
+    """
+    if local:
+        _local_listeners().append(callback)
+        return
+    with _lock:
+        _listeners.append(callback)
+
+def remove_listener(callback,local=False):
+    """Unregisters a callback added with add_listener().
+    """
+    if local:
+        listeners = _local_listeners()
+        if callback in listeners:
+            listeners.remove(callback)
+        return
+    with _lock:
+        if callback in _listeners:
+            _listeners.remove(callback)
+
+def enabled():
+    """Returns whether any listener is registered for the calling thread.
+    """
+    return len(_listeners)>0 or len(getattr(_local,'listeners',()))>0
+
+@contextmanager
+def stage(name,**info):
+    """Times a simulation stage and reports it to all listeners. The yielded
+    dict can be filled with further details while the stage runs.
+
+    Args:
+        name (str): Stage name.
+
+    Kwargs:
+        All kwargs are added to the event.
+    """
+    ev = dict(info)
+    if not enabled():
+        yield ev
+        return
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        mem = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield ev
+    finally:
+        ev['time'] = time.perf_counter() - start
+        ev['start'] = start
+        ev['stage'] = name
+        ev['thread'] = threading.get_ident()
+        if tracing:
+            ev['bytes_allocated'] = tracemalloc.get_traced_memory()[0] - mem
+        with _lock:
+            listeners = list(_listeners)
+        listeners += getattr(_local,'listeners',[])
+        for l in listeners:
+            l(ev)
+
+def cache_counts(*caches):
+    """Returns the summed hit and miss counters of LRU caches, skipping None.
+    """
+    hits = sum(c.hits for c in caches if c is not None)
+    misses = sum(c.misses for c in caches if c is not None)
+    return hits, misses
+
+
+class Profiler(object):
+    """Collects stage events while active, e.g.
+
+        with ts.Profiler(trace='run.json') as prof:
+            r = a.response(s)
+        print(prof)
+
+    Events are only collected in the current process, so batch simulations
+    should use executor='thread' when profiled.
+    """
+
+    def __init__(self,**args):
+        """Initializes a Profiler object.
+
+        Kwargs:
+            trace (str): File that events are written to on exit, in the Chrome
+                trace event format (default: None).
+            memory (bool): Tracks bytes allocated per stage with tracemalloc,
+                which slows down the simulation (default: False).
+        """
+        self.trace = args.get('trace',None)
+        self.memory = args.get('memory',False)
+        self.events = []
+        self._started_tracing = False
+        self._t0 = time.perf_counter()
+
+    def __call__(self,ev):
+        self.events.append(ev)
+
+    def __enter__(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._t0 = time.perf_counter()
+        add_listener(self)
+        return self
+
+    def __exit__(self,*exc):
+        remove_listener(self)
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        if self.trace is not None:
+            self.dump(self.trace)
+        return False
+
+    def __str__(self):
+        s = '%-12s %6s %10s %12s %10s' % ('stage','count','time [s]','bytes',
+            'cache hits')
+        for k,v in self.summary().items():
+            s += '\n%-12s %6d %10.4f %12d %10d' % (k,v['count'],v['time'],
+                v['bytes'],v['cache_hits'])
+        return s
+
+    def summary(self):
+        """Aggregates events by stage.
+
+        Returns:
+            Dict mapping stage names to dicts with event count, total time,
+            total output bytes, total bytes allocated, and cache hits and
+            misses.
+        """
+        out = {}
+        for ev in self.events:
+            s = out.setdefault(ev['stage'],{'count': 0,'time': 0.,'bytes': 0,
+                'bytes_allocated': 0,'cache_hits': 0,'cache_misses': 0})
+            s['count'] += 1
+            s['time'] += ev['time']
+            s['bytes'] += ev.get('bytes',0)
+            s['bytes_allocated'] += ev.get('bytes_allocated',0)
+            s['cache_hits'] += ev.get('cache_hits',0)
+            s['cache_misses'] += ev.get('cache_misses',0)
+        return out
+
+    def dump(self,filename):
+        """Writes events in the Chrome trace event format, which can be viewed
+        in chrome://tracing or Perfetto.
+
+        Args:
+            filename (str): Output file.
+        """
+        trace = []
+        for ev in self.events:
+            args = {k: (v.tolist() if isinstance(v,np.ndarray) else v)
+                for k,v in ev.items()
+                if k not in ('stage','start','time','thread')}
+            trace.append({'name': ev['stage'],'ph': 'X','pid': 0,
+                'tid': ev['thread'],'ts': (ev['start']-self._t0)*1e6,
+                'dur': ev['time']*1e6,'args': args})
+        with open(filename,'w') as f:
+            json.dump({'traceEvents': trace},f)
@@ -50,7 +50,7 @@ def plot(obj=hand_surface,**args):
             return plot_stimulus(obj,**args)
         elif type(obj) is Response:
             return plot_response(obj,**args)
-        elif type(obj) is Surface:
+        elif isinstance(obj,Surface):
             return plot_surface(obj,**args)
     raise RuntimeError("Plotting of " + str(type(obj)) + " objects not supported.")
 
@@ -89,10 +89,11 @@ def plot_stimulus(obj, **args):
 def plot_response(obj, **args):
     spatial = args.get('spatial', False)
     bin = args.get('bin', [0, obj.duration])
+    affclass = obj.aff.affclass
     if not spatial:
         for i, spikes in enumerate(obj.spikes):
             if len(spikes) > 0:
-                plt.vlines(spikes, i, i + 0.5, color=Afferent.affcol[obj.aff.afferents[i].affclass])
+                plt.vlines(spikes, i, i + 0.5, color=Afferent.affcol[affclass[i]])
         plt.gca().set_xlabel("Time (s)")
         plt.gca().set_ylabel("Neuron Index")
         plt.xlim(bin[0], bin[1])
@@ -103,7 +104,7 @@ def plot_response(obj, **args):
         rates = obj.psth(bins=bin)
         locs = obj.aff.surface.hand2pixel(obj.aff.location)
         for i, rate in enumerate(rates):
-            plt.scatter(locs[i, 0], locs[i, 1], s=rate * scaling_factor, c=Afferent.affcol[obj.aff.afferents[i].affclass])
+            plt.scatter(locs[i, 0], locs[i, 1], s=rate * scaling_factor, c=Afferent.affcol[affclass[i]])
         plt.gca().set_aspect('equal')
 
 def plot_surface(obj, **args):
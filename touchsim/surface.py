@@ -2,6 +2,9 @@ import numpy as np
 import re
 import os.path
 import warnings
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
 from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import dijkstra
 from scipy.ndimage import distance_transform_edt
@@ -12,6 +15,7 @@ from matplotlib import path
 from PIL import Image
 
 from .constants import hand_tags,hand_orig,hand_pxl_per_mm,hand_theta,hand_density
+from .cache import LRUCache,array_key,load_array,save_array,cache_path
 
 default_density = {('SA1',''):10., ('RA',''):10., ('PC',''):10.}
 
@@ -40,8 +44,26 @@ class Surface(object):
             density (dict): Mapping between tuples containing 1) string denoting
                 afferent class and 2) string denoting density tag, and float
                 denoting afferent density in cm^2 (default: 10. for each mapping).
+            bundle (string): Filename of a region bundle written by save_bundle();
+                if the file exists, outline and regions are loaded from it instead
+                of being segmented (default: None). Segmented regions are also
+                cached automatically in the disk cache.
+            distance_method (string): How geodesic distances are computed;
+                'graph' finds shortest paths on the 8-neighbour pixel graph
+                between the pixels nearest to each location, 'fmm' solves the
+                eikonal equation on the pixel grid by fast marching and
+                interpolates between pixels, which is more accurate and needs
+                no graph, so that it suits high resolution outlines
+                (default: 'graph').
+            max_field_memory (int): Memory in bytes for full distance fields of
+                repeatedly used source pixels, which are kept in memory and
+                evicted least recently used first (default: 256 MB).
         """
         self.orig = args.get('orig',np.array([0., 0.]))
+        self.max_field_memory = args.get('max_field_memory',2**28)
+        self.distance_method = args.get('distance_method','graph')
+        if self.distance_method not in ('graph','fmm'):
+            raise ValueError("distance_method must be 'graph' or 'fmm'.")
         self.pxl_per_mm = args.get('pxl_per_mm',1.)
         self.theta = args.get('theta',0.)
         self.rot2hand = np.array([[np.cos(self.theta), -np.sin(self.theta)],
@@ -50,37 +72,42 @@ class Surface(object):
             [np.sin(-self.theta), np.cos(-self.theta)]])
 
         im = args.get('filename',None)
+        bundle = args.get('bundle',None)
         if im is None:
             self.outline = args.get('outline',None)
         else:
             self.outline = image2outline(im,args.get('thres',250))
+        # regions are keyed by the outline they were segmented from
+        self._source_key = None if self.outline is None else\
+            array_key(self.outline,bundle='regions')
+        if bundle is not None and os.path.exists(bundle):
+            if self._source_key is None or\
+                bundle_source(bundle)==self._source_key:
+                self.load_bundle(bundle)
+            else:
+                warnings.warn("Region bundle " + str(bundle) + " does not " +
+                    "match the outline and is ignored.",stacklevel=2)
 
         if self.outline is None:
             self.num = 0
             self.density = {}
             self.tags = []
         else:
-            self.outline = np.int64(thin(self.outline))
-            labels,self.num = label(self.outline,connectivity=1,background=1,\
-                return_num=True)
-            regions = regionprops(np.flipud(labels))
-            self.num -= 1
-            self.boundary = []
-            self._centers = []
-            self._coords = []
-            self._area = []
-            for i in range(self.num):
-                dd = distance_transform_edt(np.flipud(labels==(i+2)))
-                xy = find_contours(dd,1)
-                if len(xy)==0:
-                    continue
-                self.boundary.append(xy[0][:,::-1])
-                self._centers.append(np.mean(xy[0][:,::-1],axis=0))
-                self._area.append(regions[i+1].area)
-                self._coords.append(regions[i+1].coords[:,::-1])
-            self.num = len(self.boundary)
-            self._centers = np.array(self._centers)
-            self._area = np.array(self._area)
+            if not hasattr(self,'boundary'):
+                path = cache_path(self._source_key,'regions.npz')
+                if path is not None and os.path.exists(path):
+                    self.load_bundle(path)
+                else:
+                    self.segment()
+                    if path is not None:
+                        try:
+                            os.makedirs(os.path.dirname(path),exist_ok=True)
+                            tmp = path + '.%d.tmp' % os.getpid()
+                            with open(tmp,'wb') as f:
+                                self.save_bundle(f)
+                            os.replace(tmp,path)
+                        except OSError:
+                            pass
 
             self.bbox_min = np.zeros((self.num,2))
             self.bbox_max = np.zeros((self.num,2))
@@ -88,12 +115,203 @@ class Surface(object):
                 bb = bbox(self.boundary[i])
                 self.bbox_min[i] = bb[0]
                 self.bbox_max[i] = bb[1]
+            self.rasterize()
 
             self.tags = args.get('tags',['' for i in range(self.num)])
             self.density = args.get('density',default_density)
 
         self.construct_dist_matrix()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_cache_lock',None)
+        state.pop('_lazy_lock',None)
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._cache_lock = threading.Lock()
+
+    def segment(self):
+        """Thins the outline and segments it into separate regions, computing
+        boundaries, centers, areas, and pixel coordinates of each region.
+        """
+        self.outline = np.int64(thin(self.outline))
+        labels,self.num = label(self.outline,connectivity=1,background=1,\
+            return_num=True)
+        regions = regionprops(np.flipud(labels))
+        self.num -= 1
+        self.boundary = []
+        self._centers = []
+        self._coords = []
+        self._area = []
+        for i in range(self.num):
+            dd = distance_transform_edt(np.flipud(labels==(i+2)))
+            xy = find_contours(dd,1)
+            if len(xy)==0:
+                continue
+            self.boundary.append(xy[0][:,::-1])
+            self._centers.append(np.mean(xy[0][:,::-1],axis=0))
+            self._area.append(regions[i+1].area)
+            self._coords.append(regions[i+1].coords[:,::-1])
+        self.num = len(self.boundary)
+        self._centers = np.array(self._centers)
+        self._area = np.array(self._area)
+
+    def save_bundle(self,filename):
+        """Saves the segmented outline and regions, so that they can be loaded
+        quickly using the bundle keyword. The bundle records a hash of the
+        outline it was segmented from, and is only used for that outline.
+
+        Args:
+            filename (string or file): Filename of the bundle (.npz).
+        """
+        source = {} if self._source_key is None else\
+            {'source': np.array(self._source_key)}
+        np.savez(filename,outline=self.outline.astype(np.uint8),**source,
+            boundary=np.concatenate(self.boundary),
+            boundary_len=[b.shape[0] for b in self.boundary],
+            coords=np.concatenate(self._coords),
+            coords_len=[c.shape[0] for c in self._coords],
+            centers=self._centers,area=self._area)
+
+    def load_bundle(self,filename):
+        """Loads segmented outline and regions saved by save_bundle().
+
+        Args:
+            filename (string): Filename of the bundle (.npz).
+        """
+        with np.load(filename) as b:
+            if 'source' in b.files:
+                self._source_key = str(b['source'])
+            self.outline = b['outline'].astype(np.int64)
+            self.boundary = np.split(b['boundary'],np.cumsum(b['boundary_len'])[:-1])
+            self._coords = np.split(b['coords'],np.cumsum(b['coords_len'])[:-1])
+            self._centers = b['centers']
+            self._area = b['area']
+        self.num = len(self.boundary)
+
+    def rasterize(self):
+        """Builds a raster of region ids with one-pixel cells, which lets
+        locate() look up regions instead of testing every boundary. Cells near
+        a boundary are marked with -2; points falling into them are tested
+        against the exact boundaries. This method is executed automatically
+        during construction of the Surface object.
+        """
+        if self.num==0:
+            self._raster = None
+            self._overlap = False
+            return
+        lo = np.floor(np.min(self.bbox_min,axis=0)) - 2.
+        hi = np.ceil(np.max(self.bbox_max,axis=0)) + 2.
+        shape = tuple((hi-lo).astype(np.int64))
+
+        # mark cells that boundaries pass through, sampling each edge densely
+        # enough that every cell it touches is next to a sampled one
+        near = np.zeros(shape,dtype=bool)
+        for b in self.boundary:
+            b = b - lo
+            seg = np.diff(np.vstack((b,b[:1])),axis=0)
+            n = np.ceil(np.linalg.norm(seg,axis=1)*4.).astype(np.int64) + 1
+            k = np.repeat(np.arange(b.shape[0]),n)
+            t = (np.arange(k.size) - np.repeat(np.cumsum(n)-n,n))/np.repeat(n,n)
+            cells = np.floor(b[k] + seg[k]*t[:,None]).astype(np.int64)
+            near[cells[:,0],cells[:,1]] = True
+        near = binary_dilation(near,np.ones((3,3),dtype=bool))
+
+        # the remaining cells form patches that no boundary crosses, so one
+        # exact test per patch labels all of its cells
+        patches,num = label(~near,connectivity=1,background=0,return_num=True)
+        _,first = np.unique(patches.ravel(),return_index=True)
+        centers = np.column_stack(np.unravel_index(first[1:],shape)) + lo + 0.5
+        ids = -np.ones((num+1,),dtype=np.int16)
+        count = np.zeros((num,),dtype=np.int64)
+        for i in range(self.num):
+            ind = path.Path(self.boundary[i]).contains_points(centers)
+            ids[1:][ind] = i
+            count += ind
+        ids[0] = -2
+        self._raster = ids[patches]
+        self._raster_orig = lo
+        # with overlapping regions, the raster only holds the last region
+        self._overlap = bool(np.any(count>1))
+
+    def _raster_lookup(self,xy):
+        """Looks up raster values of locations in pixel space (-1 outside the
+        raster).
+        """
+        cell = np.floor(xy - self._raster_orig)
+        inside = np.all((cell>=0) & (cell<self._raster.shape),axis=1)
+        cell = cell[inside].astype(np.int64)
+        out = -np.ones((xy.shape[0],),dtype=np.int16)
+        out[inside] = self._raster[cell[:,0],cell[:,1]]
+        return out
+
+    def _contains(self,xy,regions):
+        """Tests whether locations in pixel space lie within given regions.
+
+        Args:
+            xy (2D array): Locations in pixel space.
+            regions (array): Region id for each location.
+
+        Returns:
+            Boolean array.
+        """
+        if self._overlap:
+            exact = np.arange(xy.shape[0])
+            ind = np.zeros((xy.shape[0],),dtype=bool)
+        else:
+            val = self._raster_lookup(xy)
+            exact = np.flatnonzero(val==-2)
+            ind = val==regions
+        for i in np.unique(regions[exact]):
+            sel = exact[regions[exact]==i]
+            ind[sel] = path.Path(self.boundary[i]).contains_points(xy[sel])
+        return ind
+
+    def _sample_grid(self,regions,density,rng):
+        """Samples jittered grids of locations within regions.
+
+        Args:
+            regions (array): Region id of each grid.
+            density (array): Density of each grid in locations per cm^2.
+            rng (Generator): Random number generator.
+
+        Returns:
+            Tuple containing a 2D array of locations in pixel space and the
+            grid each location belongs to.
+        """
+        regions = np.asarray(regions,dtype=np.int64)
+        step = 1./(np.sqrt(np.asarray(density,dtype=np.float64))/10./
+            self.pxl_per_mm)
+        lo = self.bbox_min[regions]
+        n = np.ceil((self.bbox_max[regions]-lo)/step[:,None]+1.).astype(np.int64)
+        size = n[:,0]*n[:,1]
+
+        # all grid points of all grids at once
+        grid = np.repeat(np.arange(regions.size),size)
+        k = np.arange(grid.size) - np.repeat(np.cumsum(size)-size,size)
+        ij = np.column_stack((k//n[grid,1],k%n[grid,1]))
+        xy = lo[grid] + ij*step[grid,None]
+        xy += rng.standard_normal(xy.shape)*step[grid,None]/5.
+
+        ind = self._contains(xy,regions[grid])
+        return xy[ind], grid[ind]
+
+    def _sample_pixels(self,idx,num,rng):
+        """Samples pixels of regions uniformly.
+        """
+        coords = np.concatenate([self._coords[i] for i in idx])
+        return coords[rng.integers(coords.shape[0],size=num)].astype(np.float64)
+
+    @property
+    def tags(self):
+        return self._tags
+
+    @tags.setter
+    def tags(self,tags):
+        self._tags = tags
+        self._tag_idx = {}
 
     @property
     def density(self):
@@ -156,7 +374,8 @@ class Surface(object):
         return np.dot((locs-self.orig)/self.pxl_per_mm,self.rot2hand)
 
     def tag2idx(self,tag):
-        """Maps from surface tags to region ID numbers.
+        """Maps from surface tags to region ID numbers. Matches are cached per
+        tag until the tags are reassigned.
 
         Args:
             tag (str): Region tag.
@@ -168,9 +387,23 @@ class Surface(object):
             raise RuntimeError("No tags set for this surface.")
         if tag is None:
             return list(range(self.num))
-        else:
-            idx = [i for i in range(self.num) if len(re.findall(tag,self.tags[i]))>0]
-            return idx
+        idx = self._tag_idx.get(tag)
+        if idx is None:
+            pattern = re.compile(tag)
+            idx = [i for i in range(self.num) if pattern.search(self.tags[i])]
+            self._tag_idx[tag] = idx
+        return list(idx)
+
+    def idx2tag(self,idx):
+        """Maps from region ID numbers to surface tags.
+
+        Args:
+            idx (array): Region ID numbers (-1 outside all regions).
+
+        Returns:
+            List of region tags ('' outside all regions).
+        """
+        return [(self.tags[i] if i>=0 else '') for i in idx]
 
     def locate(self,locs):
         """Maps from coordinates on a surface to region tags and ids.
@@ -184,19 +417,19 @@ class Surface(object):
         locs = np.atleast_2d(self.hand2pixel(locs))
         regions = -np.ones((locs.shape[0],),dtype=np.int8)
 
-        for b in range(self.num):
-            p = path.Path(self.boundary[b])
-            ind = p.contains_points(locs)
-            regions[ind] = b
+        if self.num>0:
+            # locations outside the raster lie outside all regions
+            regions[:] = self._raster_lookup(locs)
 
-        tags = []
-        for l in range(locs.shape[0]):
-            if regions[l]<0:
-                tags.append('')
-            else:
-                tags.append(self.tags[regions[l]])
+            # exact tests for locations close to a boundary
+            near = np.flatnonzero(regions==-2)
+            regions[near] = -1
+            for b in range(self.num):
+                p = path.Path(self.boundary[b])
+                ind = p.contains_points(locs[near])
+                regions[near[ind]] = b
 
-        return tags, regions
+        return self.idx2tag(regions), regions
 
     def sample_uniform(self,id_or_tag,**args):
         """Samples locations from within specified region.
@@ -218,9 +451,8 @@ class Surface(object):
         if self.outline is None:
             raise RuntimeError("Cannot sample from surface without border.")
 
-        seed = args.get('seed',None)
-        if seed is not None:
-            np.random.seed(seed)
+        # local generator, so that sampling leaves the global state alone
+        rng = np.random.default_rng(args.get('seed',None))
 
         if type(id_or_tag) is str or id_or_tag is None:
             idx = self.tag2idx(id_or_tag)
@@ -231,40 +463,92 @@ class Surface(object):
 
         num = args.get('num',None)
         if num is None:
-            xy_list = []
-            for i in idx:
-                dens = args.get('density',self.density[('SA1',i)])
-                dist = np.sqrt(dens)/10./self.pxl_per_mm
-                b = bbox(self.boundary[i])
-                xy = np.mgrid[b[0,0]:b[1,0]+1./dist:1./dist,b[0,1]:b[1,1]+1./dist:1./dist]
-                xy = xy.reshape(2,xy.shape[1]*xy.shape[2]).T
-                xy += np.random.randn(xy.shape[0],xy.shape[1])/dist/5.
-                p = path.Path(self.boundary[i])
-                ind = p.contains_points(xy);
-                xy = xy[ind,:]
-                xy_list.append(xy)
-            xy = np.concatenate(xy_list)
-
+            density = [args.get('density',self.density[('SA1',i)]) for i in idx]
+            xy,_ = self._sample_grid(idx,density,rng)
         else:
-            xy = np.zeros((num,2))
-            coords = np.concatenate([self._coords[i] for i in idx])
-            for i in range(num):
-                xy[i] = coords[np.random.randint(coords.shape[0])]
+            xy = self._sample_pixels(idx,num,rng)
 
         return self.pixel2hand(xy)
 
+    def sample_afferents(self,affclass,id_or_tag=None,**args):
+        """Samples afferent locations for several afferent classes and regions
+        in one pass, at the density of each class in each region.
+
+        Args:
+            affclass (list): Afferent classes.
+            id_or_tag (str or list): Region tag or list of region ID numbers
+                (default: None, selecting all regions).
+
+        Kwargs:
+            density (dict): Mapping between tuples containing afferent class
+                and region ID number, and density in cm^2 (default: densities
+                of the surface).
+            density_multiplier (float): Scales all densities (default: 1.).
+            seed (int): Random number seed.
+
+        Returns:
+            Tuple containing a 2D array of coordinates in surface space, an
+            array of afferent classes, and an array of region ID numbers as
+            returned by locate(), with locations ordered by class and region.
+        """
+        if self.outline is None:
+            raise RuntimeError("Cannot sample from surface without border.")
+        rng = np.random.default_rng(args.get('seed',None))
+        density = args.get('density',self.density)
+        multiplier = args.get('density_multiplier',1.)
+
+        if type(id_or_tag) is str or id_or_tag is None:
+            idx = self.tag2idx(id_or_tag)
+        else:
+            idx = list(id_or_tag)
+
+        groups = [(a,i) for a in affclass for i in idx]
+        if len(groups)==0:
+            return np.zeros((0,2)), np.array([],dtype=str),\
+                np.array([],dtype=np.int8)
+        xy,grid = self._sample_grid([i for a,i in groups],
+            [multiplier*density[g] for g in groups],rng)
+        xy = self.pixel2hand(xy)
+        if self._overlap:
+            # locations may lie in a later region as well
+            regions = self.locate(xy)[1]
+        else:
+            regions = np.array(idx,dtype=np.int8)[grid%len(idx)]
+        return xy, np.array(affclass)[grid//len(idx)], regions
+
     def construct_dist_matrix(self):
         """Constructs matrix of pair-wise distances between all pixels contained
         in the surface. This method is executed automatically when the outline
-        variable is set during construction of the Surface object.
+        variable is set during construction of the Surface object. If disk
+        caching is enabled (see cache.set_cache_dir()), the graph is stored on
+        disk, keyed by outline and pxl_per_mm. Surfaces using fast marching only
+        keep the mask of pixels on the surface.
         """
+        self._distance_lru = LRUCache(16)
+        self._fields = LRUCache(None,self.max_field_memory)
+        # use counts of recently queried sources
+        self._source_hits = LRUCache(4096)
+        self._cache_lock = threading.Lock()
+        self.D = None
         if self.outline is None:
-            self.D = None
+            self._domain = None
             return
 
         hand = np.fliplr(self.outline.T)
         hand = binary_fill_holes(hand)
         hand = binary_dilation(hand)
+        self._domain = np.ascontiguousarray(hand)
+        if self.distance_method=='fmm':
+            return
+
+        self._cache_key = array_key(self.outline,pxl_per_mm=self.pxl_per_mm,
+            graph='8-neighbour')
+        n = self.outline.size
+        cached = [load_array(self._cache_key,'graph_' + f)
+            for f in ('data','indices','indptr')]
+        if all(c is not None for c in cached):
+            self.D = csr_matrix(tuple(cached),shape=(n,n))
+            return
 
         idx = np.flatnonzero(hand.flatten())
         pos = np.reshape(np.arange(hand.size),hand.shape)
@@ -283,56 +567,296 @@ class Surface(object):
             weights = np.concatenate((weights, np.tile(dist[i]/self.pxl_per_mm,ind.size)))
 
         self.D = csr_matrix((weights,(nodes[:,0],nodes[:,1])),shape=(hand.size,hand.size))
+        save_array(self._cache_key,'graph_data',self.D.data)
+        save_array(self._cache_key,'graph_indices',self.D.indices)
+        save_array(self._cache_key,'graph_indptr',self.D.indptr)
+
+    def pixel_index(self,xy):
+        """Maps locations to linear pixel indices, as used by the distance graph.
+
+        Args:
+            xy (2D array): Locations in surface space.
+
+        Returns:
+            Array of linear pixel indices.
+        """
+        shape = self.outline.T.shape
+        xyp = np.rint(self.hand2pixel(xy)).astype(np.int64)
+        xyp[xyp<0] = 0
+        xyp[xyp[:,0]>=shape[0],0] = shape[0]-1
+        xyp[xyp[:,1]>=shape[1],1] = shape[1]-1
+        return xyp[:,0]*shape[1] + xyp[:,1]
+
+    def distance_fields(self,pixels,targets=None):
+        """Computes full geodesic distance fields from source pixels. Fields are
+        kept in memory up to max_field_memory bytes.
+
+        Args:
+            pixels (array): Linear indices of unique source pixels.
+            targets (array): Linear indices of target pixels (default: all).
+
+        Returns:
+            2D array of distances (sources x targets).
+        """
+        if targets is None:
+            targets = slice(None)
+        out = [None]*pixels.size
+        missing = []
+        for i,px in enumerate(pixels):
+            f = self._fields.get(int(px))
+            if f is None:
+                missing.append(i)
+            else:
+                out[i] = f[targets]
+        if len(missing)>0:
+            F = dijkstra(self.D,directed=False,indices=pixels[missing])
+            for j,i in enumerate(missing):
+                self._fields.put(int(pixels[i]),F[j].copy())
+                out[i] = F[j,targets]
+        return np.array(out).reshape((pixels.size,-1))
+
+    def geodesic(self,src,tgt,limit=np.inf,workers=None):
+        """Computes geodesic distances between pairs of pixels. Each source is
+        solved only until all of its targets are reached, or up to limit, and
+        sources are split across a pool of threads. Full fields of repeatedly
+        used sources are kept in memory, see distance_fields().
+
+        Args:
+            src (array): Linear indices of source pixels, one per pair.
+            tgt (array): Linear indices of target pixels, one per pair.
+            limit (float): Distances beyond limit are returned as inf
+                (default: inf).
+            workers (int): Number of threads (default: number of CPUs).
+
+        Returns:
+            Array of distances, one per pair.
+        """
+        src = np.asarray(src,dtype=np.int64)
+        tgt = np.asarray(tgt,dtype=np.int64)
+        out = np.empty(src.shape)
+        usrc,inv = np.unique(src,return_inverse=True)
+        inv = inv.reshape(-1)
+        order = np.argsort(inv,kind='stable')
+        bounds = np.searchsorted(inv[order],np.arange(usrc.size+1))
+
+        todo = []
+        for k,px in enumerate(usrc):
+            px = int(px)
+            pairs = order[bounds[k]:bounds[k+1]]
+            f = self._fields.get(px)
+            if f is None and np.isinf(limit):
+                # full fields are only worth storing for repeated sources
+                with self._cache_lock:
+                    hits = self._source_hits.get(px,0) + 1
+                    self._source_hits.put(px,hits)
+                if hits>=2:
+                    f = self.distance_fields(np.array([px]))[0]
+            if f is None:
+                todo.append(k)
+            else:
+                out[pairs] = f[tgt[pairs]]
+        if len(todo)==0:
+            out[out>limit] = np.inf
+            return out
+
+        # pairs of the remaining sources, grouped by source
+        todo = np.array(todo)
+        pairs = np.concatenate([order[bounds[k]:bounds[k+1]] for k in todo])
+        offsets = np.concatenate(([0],np.cumsum(bounds[todo+1]-bounds[todo])))
+        targets = tgt[pairs]
+        dist = np.empty(pairs.shape)
+        D = self.D
+
+        def solve(chunk):
+            dijkstra_pairs(D.indptr,D.indices,D.data,usrc[todo[chunk]],
+                offsets[chunk.start:chunk.stop+1]-offsets[chunk.start],
+                targets[offsets[chunk.start]:offsets[chunk.stop]],float(limit),
+                dist[offsets[chunk.start]:offsets[chunk.stop]])
+
+        workers = min(workers or os.cpu_count() or 1,todo.size)
+        step = -(-todo.size//workers)
+        chunks = [range(i,min(i+step,todo.size)) for i in range(0,todo.size,step)]
+        if len(chunks)==1:
+            solve(chunks[0])
+        else:
+            with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+                list(pool.map(solve,chunks))
+        out[pairs] = dist
+        out[out>limit] = np.inf
+        return out
+
+    def outside(self,pixels):
+        """Finds pixels that are not on the surface.
+
+        Args:
+            pixels (array): Linear pixel indices.
+
+        Returns:
+            Boolean array.
+        """
+        return ~self._domain.ravel()[pixels]
+
+    def eikonal(self,src,tgt,limit=np.inf,workers=None):
+        """Computes geodesic distances between pairs of locations by fast
+        marching. The distance field of each source is solved to second order
+        accuracy on the pixel grid, starting from exact distances to the pixels
+        around the source, until the pixels around all of its targets are
+        reached, or up to limit. Distances are then interpolated bilinearly at
+        the targets. Sources are split across a pool of threads.
 
+        Args:
+            src (2D array): Source locations in pixel space, one per pair.
+            tgt (2D array): Target locations in pixel space, one per pair.
+            limit (float): Distances beyond limit are returned as inf
+                (default: inf).
+            workers (int): Number of threads (default: number of CPUs).
+
+        Returns:
+            Array of distances, one per pair.
+        """
+        src = np.reshape(np.asarray(src,dtype=np.float64),(-1,2))
+        tgt = np.reshape(np.asarray(tgt,dtype=np.float64),(-1,2))
+        # group pairs by source
+        order = np.lexsort((src[:,1],src[:,0]))
+        s = src[order]
+        starts = np.flatnonzero(np.concatenate(([True],
+            np.any(s[1:]!=s[:-1],axis=1)))) if s.shape[0]>0 else\
+            np.zeros((0,),dtype=np.int64)
+        usrc = np.ascontiguousarray(s[starts])
+        offsets = np.append(starts,s.shape[0])
+        targets = np.ascontiguousarray(tgt[order])
+        dist = np.empty((order.size,))
+        h = 1./self.pxl_per_mm
+        # march a little beyond the limit, so that interpolation near it works
+        march = float(limit) + 2.*h
+
+        def solve(chunk):
+            fmm_pairs(self._domain,h,usrc[chunk.start:chunk.stop],
+                offsets[chunk.start:chunk.stop+1]-offsets[chunk.start],
+                targets[offsets[chunk.start]:offsets[chunk.stop]],march,
+                dist[offsets[chunk.start]:offsets[chunk.stop]])
+
+        n = usrc.shape[0]
+        workers = max(min(workers or os.cpu_count() or 1,n),1)
+        step = max(-(-n//workers),1)
+        chunks = [range(i,min(i+step,n)) for i in range(0,n,step)]
+        if len(chunks)==1:
+            solve(chunks[0])
+        elif len(chunks)>1:
+            with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+                list(pool.map(solve,chunks))
+        out = np.empty((order.size,))
+        out[order] = dist
+        out[out>limit] = np.inf
+        return out
 
-    def distance(self,xy1,xy2):
+    def distance_field(self,xy,limit=None):
+        """Computes the geodesic distance field of a location by fast
+        marching, see eikonal().
+
+        Args:
+            xy (array): Location in surface space.
+            limit (float): Stops marching beyond this distance (default: None).
+
+        Returns:
+            2D array of distances to all pixels, indexed like the pixel grid
+            (inf off the surface or beyond limit).
+        """
+        if self.outline is None:
+            raise RuntimeError("Cannot compute distance fields without border.")
+        p = self.hand2pixel(np.reshape(xy,(1,2)))[0]
+        return fmm_field(self._domain,1./self.pxl_per_mm,p[0],p[1],
+            np.inf if limit is None else float(limit))
+
+    def _grid_locations(self,xy):
+        # locations as used by the distance method: nearest pixels for the
+        # graph, exact pixel coordinates for fast marching
+        if self.distance_method=='fmm':
+            return self.hand2pixel(xy)
+        return self.pixel_index(xy)
+
+    def _solve_pairs(self,p1,p2,i1,i2,limit):
+        # solves for pairs p1[i1], p2[i2] from whichever side has fewer
+        # distinct locations
+        limit = np.inf if limit is None else limit
+        solve = self.eikonal if self.distance_method=='fmm' else self.geodesic
+        if np.unique(p1,axis=0).shape[0]>np.unique(p2,axis=0).shape[0]:
+            return solve(p2[i2],p1[i1],limit)
+        return solve(p1[i1],p2[i2],limit)
+
+    def _check_outside(self,xy1,xy2,d,limit):
+        if (limit is None and np.any(np.isinf(d))) or\
+            np.any(self.outside(self.pixel_index(xy1))) or\
+            np.any(self.outside(self.pixel_index(xy2))):
+            warnings.warn("At least one afferent or pin centre is outside " +
+                "surface boundary and will be ignored.",stacklevel=3)
+
+    def distance(self,xy1,xy2,limit=None):
         """Computes the shortest distance between pairwise locations on the surface.
+        Results are kept in an in-process LRU cache, so the same set of locations
+        is never solved twice.
 
         Args:
             xy1 (2D array): Origin location(s) in surface space.
             xy2 (2D array): Destination location(s) in surface space.
+            limit (float): Distances beyond limit are returned as inf, which
+                allows the search to stop early (default: None).
 
         Returns:
             2D array containing all pairwise distances between origin and
             destination locations.
         """
-        if self.D is None:
+        if self.outline is None:
             # if infinite sheet, calculate length of straight line
             dx = xy1[:,0:1] - xy2[:,0:1].T
             dy = xy1[:,1:2] - xy2[:,1:2].T
-            return np.sqrt(dx**2 + dy**2)
+            D = np.sqrt(dx**2 + dy**2)
+            if limit is not None:
+                D[D>limit] = np.inf
+            return D
         else:
-            # convert between 2D and 1D coordinate representation
-            lin_idx = np.arange(self.outline.size).reshape(self.outline.T.shape)
-            xyp = np.rint(self.hand2pixel(xy1)).astype(np.int64)
-            xyp[xyp<0] = 0
-            xyp[xyp[:,0]>=lin_idx.shape[0],0] = lin_idx.shape[0]-1
-            xyp[xyp[:,1]>=lin_idx.shape[1],1] = lin_idx.shape[1]-1
-            xyp = lin_idx[xyp[:,0],xyp[:,1]]
-
-            xya = np.rint(self.hand2pixel(xy2)).astype(np.int64)
-            xya[xya<0] = 0
-            xya[xya[:,0]>=lin_idx.shape[0],0] = lin_idx.shape[0]-1
-            xya[xya[:,1]>=lin_idx.shape[1],1] = lin_idx.shape[1]-1
-            xya = lin_idx[xya[:,0],xya[:,1]]
-
-            # flip for speeding up computations
-            flip = False
-            if xyp.size>xya.size:
-                flip = True
-                xyp,xya = xya,xyp
-
-            D = dijkstra(self.D,directed=False,indices=xyp)
-            D = D[:,xya]
-
-            if np.any(np.isinf(D)):
-                warnings.warn("At least one afferent or pin centre is outside " +
-                    "surface boundary and will be ignored.",stacklevel=2)
-
-            if flip:
-                D = D.T
+            p1 = self._grid_locations(xy1)
+            p2 = self._grid_locations(xy2)
+            key = (p1.tobytes(),p2.tobytes(),limit)
+            D = self._distance_lru.get(key)
+            if D is None:
+                n1,n2 = p1.shape[0],p2.shape[0]
+                D = self._solve_pairs(p1,p2,np.repeat(np.arange(n1),n2),
+                    np.tile(np.arange(n2),n1),limit).reshape((n1,n2))
+                self._distance_lru.put(key,D)
+            self._check_outside(xy1,xy2,D,limit)
+            return D.copy()
 
-            return D
+    def pair_distance(self,xy1,xy2,limit=None):
+        """Computes the shortest distances between corresponding locations on
+        the surface, i.e. between xy1[i] and xy2[i]. Results are kept in the
+        same LRU cache as those of distance().
+
+        Args:
+            xy1 (2D array): Origin locations in surface space.
+            xy2 (2D array): Destination locations in surface space.
+            limit (float): Distances beyond limit are returned as inf, which
+                allows the search to stop early (default: None).
+
+        Returns:
+            Array of distances.
+        """
+        if self.outline is None:
+            d = np.sqrt(np.sum((xy1-xy2)**2,axis=1))
+            if limit is not None:
+                d[d>limit] = np.inf
+            return d
+        else:
+            p1 = self._grid_locations(xy1)
+            p2 = self._grid_locations(xy2)
+            key = ('pairs',p1.tobytes(),p2.tobytes(),limit)
+            d = self._distance_lru.get(key)
+            if d is None:
+                idx = np.arange(p1.shape[0])
+                d = self._solve_pairs(p1,p2,idx,idx,limit)
+                self._distance_lru.put(key,d)
+            self._check_outside(xy1,xy2,d,limit)
+            return d.copy()
 
     def export(self,filename='surface.gen'):
         text_file = open(filename, "w")
@@ -345,11 +869,349 @@ class Surface(object):
         text_file.close()
 
 
+@njit(nogil=True,cache=True)
+def dijkstra_pairs(indptr,indices,weights,sources,offsets,targets,limit,out):
+    """Shortest path lengths on a graph in CSR form from each source k to its
+    targets[offsets[k]:offsets[k+1]], written to the same positions in out.
+    The search from a source stops once all of its targets are reached; paths
+    longer than limit are not followed, and targets not reached are inf.
+    """
+    n = indptr.size - 1
+    dist = np.full(n,np.inf)
+    want = np.zeros(n,dtype=np.int64)
+    # position of each node in the heap; -1 if not queued, -2 once settled
+    pos = -np.ones(n,dtype=np.int64)
+    touched = np.empty(n,dtype=np.int64)
+    heap = np.empty(n,dtype=np.int64)
+    for k in range(sources.size):
+        stamp = k + 1
+        remaining = 0
+        for j in range(offsets[k],offsets[k+1]):
+            if want[targets[j]]!=stamp:
+                want[targets[j]] = stamp
+                remaining += 1
+
+        s = sources[k]
+        dist[s] = 0.
+        touched[0] = s
+        ntouched = 1
+        heap[0] = s
+        pos[s] = 0
+        size = 1
+        while size>0 and remaining>0:
+            u = heap[0]
+            d = dist[u]
+            pos[u] = -2
+            if want[u]==stamp:
+                want[u] = 0
+                remaining -= 1
+            # move the last node to the root and sift it down
+            size -= 1
+            if size>0:
+                last = heap[size]
+                dl = dist[last]
+                i = 0
+                while True:
+                    c = 2*i + 1
+                    if c>=size:
+                        break
+                    if c+1<size and dist[heap[c+1]]<dist[heap[c]]:
+                        c += 1
+                    if dist[heap[c]]>=dl:
+                        break
+                    heap[i] = heap[c]
+                    pos[heap[i]] = i
+                    i = c
+                heap[i] = last
+                pos[last] = i
+
+            for e in range(indptr[u],indptr[u+1]):
+                v = indices[e]
+                nd = d + weights[e]
+                if nd<dist[v] and nd<=limit:
+                    if pos[v]==-1:
+                        # not queued yet
+                        touched[ntouched] = v
+                        ntouched += 1
+                        i = size
+                        size += 1
+                    else:
+                        i = pos[v]
+                    dist[v] = nd
+                    # sift up
+                    while i>0:
+                        p = (i-1)//2
+                        if dist[heap[p]]<=nd:
+                            break
+                        heap[i] = heap[p]
+                        pos[heap[i]] = i
+                        i = p
+                    heap[i] = v
+                    pos[v] = i
+
+        for j in range(offsets[k],offsets[k+1]):
+            out[j] = dist[targets[j]]
+        for i in range(ntouched):
+            dist[touched[i]] = np.inf
+            pos[touched[i]] = -1
+    return out
+
+@njit(nogil=True,cache=True)
+def _heap_sift_up(heap,pos,T,i,k):
+    # moves node k up from heap position i
+    t = T[k]
+    while i>0:
+        p = (i-1)//2
+        if T[heap[p]]<=t:
+            break
+        heap[i] = heap[p]
+        pos[heap[i]] = i
+        i = p
+    heap[i] = k
+    pos[k] = i
+
+@njit(nogil=True,cache=True)
+def _heap_pop(heap,pos,T,size):
+    # removes the root; returns the new heap size
+    size -= 1
+    if size>0:
+        last = heap[size]
+        t = T[last]
+        i = 0
+        while True:
+            c = 2*i + 1
+            if c>=size:
+                break
+            if c+1<size and T[heap[c+1]]<T[heap[c]]:
+                c += 1
+            if T[heap[c]]>=t:
+                break
+            heap[i] = heap[c]
+            pos[heap[i]] = i
+            i = c
+        heap[i] = last
+        pos[last] = i
+    return size
+
+@njit(nogil=True,cache=True)
+def _eikonal_update(T,state,nx,ny,i,j,h):
+    # solves sum_k a_k*(t-v_k)^2 = h^2 over both axes, using second order
+    # differences where two known pixels lie upwind
+    A = 0.
+    B = 0.
+    C = -h*h
+    vmax = -np.inf
+    best = np.inf
+    for axis in range(2):
+        a = 0.
+        v = np.inf
+        t1 = np.inf
+        for side in (-1,1):
+            i1 = i + side*(1-axis)
+            j1 = j + side*axis
+            if i1<0 or i1>=nx or j1<0 or j1>=ny:
+                continue
+            k1 = i1*ny + j1
+            if state[k1]!=2 or T[k1]>=t1:
+                continue
+            t1 = T[k1]
+            a = 1.
+            v = t1
+            i2 = i1 + side*(1-axis)
+            j2 = j1 + side*axis
+            if i2>=0 and i2<nx and j2>=0 and j2<ny:
+                k2 = i2*ny + j2
+                if state[k2]==2 and T[k2]<=t1:
+                    a = 2.25
+                    v = (4.*t1-T[k2])/3.
+        if a>0.:
+            A += a
+            B -= 2.*a*v
+            C += a*v*v
+            vmax = max(vmax,v)
+            best = min(best,v+h/np.sqrt(a))
+    disc = B*B - 4.*A*C
+    if disc>=0.:
+        t = (-B+np.sqrt(disc))/(2.*A)
+        if t>=vmax:
+            return min(t,best)
+    return best
+
+@njit(nogil=True,cache=True)
+def _fmm_march(domain,nx,ny,h,px,py,limit,want,stamp,remaining,T,state,heap,pos,
+    touched):
+    """Fast marching from a source at pixel coordinates (px,py). Marches until
+    all wanted pixels are known, or the whole surface if remaining<0, without
+    accepting pixels beyond limit. Returns the number of touched pixels.
+    """
+    ntouched = 0
+    size = 0
+    # exact distances to the pixels around the source
+    i0 = int(np.floor(px))
+    j0 = int(np.floor(py))
+    for i in range(i0-1,i0+3):
+        for j in range(j0-1,j0+3):
+            if i<0 or i>=nx or j<0 or j>=ny or not domain[i*ny+j]:
+                continue
+            k = i*ny + j
+            T[k] = h*np.sqrt((i-px)**2 + (j-py)**2)
+            state[k] = 2
+            touched[ntouched] = k
+            ntouched += 1
+            if want[k]==stamp:
+                want[k] = 0
+                remaining -= 1
+    ninit = ntouched
+
+    # queue the neighbours of the initial pixels, then march
+    n = 0
+    while True:
+        if n<ninit:
+            k = touched[n]
+            n += 1
+        else:
+            if size==0 or remaining==0:
+                break
+            k = heap[0]
+            if T[k]>limit:
+                break
+            size = _heap_pop(heap,pos,T,size)
+            state[k] = 2
+            if want[k]==stamp:
+                want[k] = 0
+                remaining -= 1
+        i = k//ny
+        j = k - i*ny
+        for nb in range(4):
+            i1 = i + (1 if nb==0 else -1 if nb==1 else 0)
+            j1 = j + (1 if nb==2 else -1 if nb==3 else 0)
+            if i1<0 or i1>=nx or j1<0 or j1>=ny:
+                continue
+            k1 = i1*ny + j1
+            if not domain[k1] or state[k1]==2:
+                continue
+            t = _eikonal_update(T,state,nx,ny,i1,j1,h)
+            if t<T[k1]:
+                T[k1] = t
+                if state[k1]==0:
+                    state[k1] = 1
+                    touched[ntouched] = k1
+                    ntouched += 1
+                    size += 1
+                    _heap_sift_up(heap,pos,T,size-1,k1)
+                else:
+                    _heap_sift_up(heap,pos,T,pos[k1],k1)
+    return ntouched
+
+@njit(nogil=True,cache=True)
+def _fmm_interp(T,state,domain,nx,ny,h,qx,qy,px,py):
+    # distances close to the source are straight lines
+    d2 = (qx-px)**2 + (qy-py)**2
+    iq = int(np.floor(qx+.5))
+    jq = int(np.floor(qy+.5))
+    if d2<=1. and iq>=0 and iq<nx and jq>=0 and jq<ny and domain[iq*ny+jq]:
+        return h*np.sqrt(d2)
+
+    i = int(np.floor(qx))
+    j = int(np.floor(qy))
+    fx = qx - i
+    fy = qy - j
+    val = 0.
+    best = np.inf
+    complete = True
+    for c in range(4):
+        ic = i + (c&1)
+        jc = j + (c>>1)
+        w = (fx if c&1 else 1.-fx)*(fy if c>>1 else 1.-fy)
+        if ic<0 or ic>=nx or jc<0 or jc>=ny or state[ic*ny+jc]!=2:
+            complete = False
+            continue
+        t = T[ic*ny+jc]
+        val += w*t
+        best = min(best,t + h*np.sqrt((ic-qx)**2 + (jc-qy)**2))
+    if complete:
+        return val
+    # next to the border, go through the nearest known pixel
+    return best
+
+@njit(nogil=True,cache=True)
+def fmm_pairs(domain,h,sources,offsets,targets,limit,out):
+    """Geodesic distances by fast marching from each source (in pixel
+    coordinates) to its targets[offsets[k]:offsets[k+1]], written to the same
+    positions in out.
+    """
+    nx,ny = domain.shape
+    dom = domain.ravel()
+    n = dom.size
+    T = np.full(n,np.inf)
+    state = np.zeros(n,dtype=np.int8)
+    want = np.zeros(n,dtype=np.int32)
+    heap = np.empty(n,dtype=np.int32)
+    pos = np.empty(n,dtype=np.int32)
+    touched = np.empty(n,dtype=np.int32)
+    for k in range(sources.shape[0]):
+        stamp = k + 1
+        remaining = 0
+        # the pixels around each target need to be known
+        for m in range(offsets[k],offsets[k+1]):
+            i = int(np.floor(targets[m,0]))
+            j = int(np.floor(targets[m,1]))
+            for c in range(4):
+                ic = i + (c&1)
+                jc = j + (c>>1)
+                if ic<0 or ic>=nx or jc<0 or jc>=ny:
+                    continue
+                kc = ic*ny + jc
+                if dom[kc] and want[kc]!=stamp:
+                    want[kc] = stamp
+                    remaining += 1
+        px = sources[k,0]
+        py = sources[k,1]
+        ntouched = _fmm_march(dom,nx,ny,h,px,py,limit,want,stamp,remaining,
+            T,state,heap,pos,touched)
+        for m in range(offsets[k],offsets[k+1]):
+            out[m] = _fmm_interp(T,state,dom,nx,ny,h,targets[m,0],targets[m,1],
+                px,py)
+        for m in range(ntouched):
+            T[touched[m]] = np.inf
+            state[touched[m]] = 0
+    return out
+
+@njit(nogil=True,cache=True)
+def fmm_field(domain,h,px,py,limit):
+    """Full geodesic distance field by fast marching from a source in pixel
+    coordinates (inf off the surface or beyond limit).
+    """
+    nx,ny = domain.shape
+    dom = domain.ravel()
+    n = dom.size
+    T = np.full(n,np.inf)
+    state = np.zeros(n,dtype=np.int8)
+    want = np.zeros(n,dtype=np.int32)
+    heap = np.empty(n,dtype=np.int32)
+    pos = np.empty(n,dtype=np.int32)
+    touched = np.empty(n,dtype=np.int32)
+    _fmm_march(dom,nx,ny,h,px,py,limit,want,1,-1,T,state,heap,pos,touched)
+    for k in range(n):
+        if state[k]!=2:
+            T[k] = np.inf
+    return T.reshape((nx,ny))
+
 def bbox(xy):
     """Calculates bounding box for arbitrary boundary.
     """
     return np.vstack((np.min(xy,axis=0),np.max(xy,axis=0)))
 
+def bundle_source(filename):
+    """Returns the hash of the outline that a region bundle was segmented
+    from, or None for bundles that do not record it.
+    """
+    try:
+        with np.load(filename) as b:
+            return str(b['source']) if 'source' in b.files else None
+    except (OSError,ValueError):
+        return None
+
 def image2outline(filename,thres=250):
     """Converts image to greyscale and thresholds to generate binary outline.
     """
@@ -358,7 +1220,59 @@ def image2outline(filename,thres=250):
     outline = np.array(im)<thres
     return outline
 
+
+class LazySurface(Surface):
+    """A Surface that is only constructed when first used. Accessing any
+    attribute builds the underlying Surface, after which the object behaves
+    exactly like (and is of type) Surface.
+    """
+
+    def __init__(self,**args):
+        """Initializes a LazySurface object.
+
+        Kwargs:
+            All kwargs are passed on to the Surface constructor on first use.
+        """
+        self._lazy_args = args
+        self._lazy_lock = threading.Lock()
+
+    def __getattribute__(self,name):
+        if name.startswith('__') or name.startswith('_lazy') or\
+            name=='materialize':
+            return object.__getattribute__(self,name)
+        # wait for (or start) construction, except within the constructor
+        if object.__getattribute__(self,'__dict__').get('_lazy_owner')!=\
+            threading.get_ident():
+            LazySurface.materialize(self)
+        return object.__getattribute__(self,name)
+
+    def __reduce__(self):
+        if type(self) is LazySurface:
+            return (LazySurface,(),{'_lazy_args':self._lazy_args})
+        return super().__reduce__()
+
+    def __setstate__(self,state):
+        self.__init__(**state['_lazy_args'])
+
+    def materialize(self):
+        """Builds the underlying Surface, if not done already. Threads that use
+        the surface meanwhile wait until construction has finished.
+        """
+        with self._lazy_lock:
+            if type(self) is not LazySurface:
+                return
+            self._lazy_owner = threading.get_ident()
+            try:
+                Surface.__init__(self,**self._lazy_args)
+            finally:
+                del self._lazy_owner
+            del self._lazy_args
+            self.__class__ = Surface
+
+
+surface_dir = os.path.dirname(os.path.dirname(__file__)) + '/surfaces/'
+
 null_surface = Surface()
-hand_surface = Surface(filename=(os.path.dirname(os.path.dirname(__file__))\
-        + '/surfaces/hand.png'),orig=hand_orig,pxl_per_mm=hand_pxl_per_mm,
+hand_surface = LazySurface(filename=surface_dir + 'hand.png',
+        bundle=surface_dir + 'hand.npz',orig=hand_orig,pxl_per_mm=hand_pxl_per_mm,
         theta=hand_theta,density=hand_density,tags=hand_tags)
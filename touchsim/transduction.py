@@ -1,8 +1,30 @@
 import numpy as np
-from scipy import interpolate,signal
-from numba import guvectorize,float64,boolean
+import threading
+import warnings
+from fractions import Fraction
+from math import isclose
+from scipy import interpolate,signal,sparse,linalg
+from scipy.spatial import cKDTree
+from numba import guvectorize,njit,float32,float64,int64,boolean
 
-from .constants import ihbasis
+from .constants import ihbasis, affparams
+from .cache import LRUCache, array_key
+from .instrument import stage
+
+# factorizations of pin coupling matrices, shared by all stimuli with the same
+# pins in contact and radius
+factor_cache = LRUCache(256)
+_factor_lock = threading.Lock()
+
+# profiles of normalized traces, to be scaled by the trace amplitude; meant for
+# short repeated traces, long ones are not cached
+profile_cache = LRUCache(8,maxbytes=2**26)
+
+# anti-aliasing filters for polyphase resampling, by rate ratio and quality
+filter_cache = LRUCache(32)
+
+# filter half-length (in multiples of the larger rate factor) and Kaiser beta
+resample_quality = {'fast': (4,5.), 'default': (10,5.), 'high': (32,9.)}
 
 def check_pin_radius(loc,rad):
     if loc.shape[0]>1:
@@ -17,10 +39,76 @@ def check_pin_radius(loc,rad):
     else:
         return rad
 
-def skin_touch_profile(S0,xy,samp_freq,ProbeRad):
-    S0 = S0.T # hack, needs to be fixed
-    s = S0.shape
-
+def check_dtype(dtype):
+    """Returns the simulation precision as a numpy dtype.
+
+    Args:
+        dtype: np.float64 (double precision) or np.float32 (single precision,
+            which halves memory traffic of the propagated inputs).
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float64,np.float32):
+        raise ValueError("dtype must be float32 or float64.")
+    return dtype
+
+def resample_filter(up,down,quality='default'):
+    """Designs (once) the low-pass FIR filter for polyphase resampling by
+    up/down at the given quality.
+    """
+    key = (up,down,quality)
+    with _factor_lock:
+        h = filter_cache.get(key)
+    if h is None:
+        if quality not in resample_quality:
+            raise ValueError("Resampling quality must be one of %s or 'fft'." %
+                sorted(resample_quality.keys()))
+        half,beta = resample_quality[quality]
+        max_rate = max(up,down)
+        h = signal.firwin(2*half*max_rate+1,1./max_rate,window=('kaiser',beta))
+        with _factor_lock:
+            filter_cache.put(key,h)
+    return h
+
+def resample_profile(x,fs_in,fs_out,quality='default',axis=0):
+    """Resamples along the time axis with a rational polyphase filter.
+
+    Args:
+        x (array): Signal.
+        fs_in (float): Sampling frequency of x.
+        fs_out (float): Target sampling frequency.
+        quality (str): 'fast', 'default', 'high', or 'fft' for FFT-based
+            resampling, which is also used if fs_out/fs_in is not a ratio of
+            integers up to 1000 (default: 'default').
+        axis (int): Time axis (default: 0).
+
+    Returns:
+        Resampled signal.
+    """
+    if quality!='fft' and quality not in resample_quality:
+        raise ValueError("Resampling quality must be one of %s or 'fft'." %
+            sorted(resample_quality.keys()))
+    nout = int(round(x.shape[axis]/fs_in*fs_out))
+    r = Fraction(fs_out/fs_in).limit_denominator(1000)
+    up,down = r.numerator,r.denominator
+    # rates without a small rational ratio (e.g. 4999 Hz) would be resampled
+    # at a slightly wrong rate, which shifts spike times
+    if quality=='fft' or not isclose(up*fs_in,down*fs_out,rel_tol=1e-9):
+        return signal.resample(x,nout,axis=axis)
+
+    h = resample_filter(up,down,quality)
+    y = signal.resample_poly(x,up,down,axis=axis,window=h,padtype='line')
+
+    # match the length of FFT-based resampling
+    n = y.shape[axis]
+    if n>nout:
+        y = np.take(y,np.arange(nout),axis=axis)
+    elif n<nout:
+        pad = [(0,0)]*y.ndim
+        pad[axis] = (0,nout-n)
+        y = np.pad(y,pad,mode='edge')
+    return y
+
+def pin_coupling(xy,ProbeRad):
     E = 0.05
     nu = 0.4
 
@@ -35,12 +123,83 @@ def skin_touch_profile(S0,xy,samp_freq,ProbeRad):
     D = (1.-nu**2.)/np.pi/ProbeRad * np.arcsin(ProbeRad/R)/E
     np.seterr(all="warn")
     D[R<=ProbeRad] = (1.-nu**2.)/2./ProbeRad/E
+    return D
+
+def factorize(A):
+    # coupling matrices are symmetric positive definite for non-overlapping
+    # pins; fall back to LU otherwise
+    try:
+        return 'cho', linalg.cho_factor(A,check_finite=False)
+    except linalg.LinAlgError:
+        pass
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore",linalg.LinAlgWarning)
+        lu = linalg.lu_factor(A,check_finite=False)
+    if np.any(np.diag(lu[0])==0.):
+        raise linalg.LinAlgError("Singular matrix")
+    return 'lu', lu
+
+def factor_solve(f,b):
+    if f[0]=='cho':
+        return linalg.cho_solve(f[1],b,check_finite=False)
+    return linalg.lu_solve(f[1],b,check_finite=False)
+
+def cached_factor(layout,mask,D):
+    """Returns the factorization of D restricted to the pins in mask. The key
+    is the location of these pins, so that sub-layouts share factorizations,
+    e.g. when pins are appended to a stimulus.
+    """
+    xy,ProbeRad = layout
+    key = array_key(xy[mask],ProbeRad=float(ProbeRad))
+    with _factor_lock:
+        f = factor_cache.get(key)
+    if f is None:
+        f = factorize(D[np.ix_(mask,mask)])
+        with _factor_lock:
+            factor_cache.put(key,f)
+    return f
+
+def scaled_skin_touch_profile(S0,xy,samp_freq,ProbeRad,known=None):
+    """Computes the skin profile like skin_touch_profile(), but reuses the
+    profile of a trace that differs only by a positive gain. The contact solve
+    depends on the signs of the trace and pressures only, so its solution
+    scales linearly with the trace amplitude.
+    """
+    scale = np.max(np.abs(S0)) if S0.size>0 else 0.
+    # P and Pdyn each hold one value per pin and sample
+    if scale==0. or 2*S0.size*8>profile_cache.maxbytes:
+        return skin_touch_profile(S0,xy,samp_freq,ProbeRad,known)
+
+    key = array_key(np.round(S0/scale,12)+0.,xy,samp_freq=float(samp_freq),
+        ProbeRad=float(ProbeRad))
+    with _factor_lock:
+        prof = profile_cache.get(key)
+    if prof is not None:
+        return scale*prof[0], scale*prof[1]
+
+    P,Pdyn = skin_touch_profile(S0,xy,samp_freq,ProbeRad,known)
+    with _factor_lock:
+        profile_cache.put(key,(P/scale,Pdyn/scale))
+    return P, Pdyn
+
+def skin_touch_profile(S0,xy,samp_freq,ProbeRad,known=None):
+    S0 = S0.T # hack, needs to be fixed
+    s = S0.shape
+
+    layout = (xy,ProbeRad)
+    D = pin_coupling(xy,ProbeRad)
 
     S0neg = S0<0
     absS0 = np.abs(S0)
 
     P = np.zeros(s)
     prevS0 = np.zeros(s)
+    if known is not None:
+        # samples whose contact solution is already known; each sample is
+        # solved independently, so these never need to be revisited
+        rows,Pk = known
+        P[rows] = np.abs(Pk)
+        prevS0[rows] = absS0[rows]
     count=0
     # iterative contact-detection algorithm
     while count==0 or P[P<0].size>0:
@@ -49,7 +208,7 @@ def skin_touch_profile(S0,xy,samp_freq,ProbeRad):
         # only work on changed (and nonzeros) line
         diffl = np.sum(absS0-prevS0,axis=1) != 0.
         S0loc = absS0[diffl,:]
-        P[diffl,:] = block_solve(S0loc,D)
+        P[diffl,:] = block_solve(S0loc,D,layout)
         prevS0 = absS0.copy()
 
     # correct for the hack
@@ -68,12 +227,13 @@ def skin_touch_profile(S0,xy,samp_freq,ProbeRad):
         S1p[0,:] = S1p[1,:]
         S1p[-1,:] = S1p[-2,:]
         # linsolve
-        Pdyn = np.linalg.solve(D,S1p.T)
+        Pdyn = factor_solve(cached_factor(layout,np.ones(s[1],dtype=bool),D),
+            S1p.T)
     else:
         Pdyn = np.zeros(P.shape);
     return P, Pdyn
 
-def block_solve(S0,D):
+def block_solve(S0,D,layout=None):
     nz = S0!=0
     # do clever packing to speed up unique_rows
     if nz.shape[1]<128:
@@ -95,20 +255,13 @@ def block_solve(S0,D):
         nzi = unz[ii,:]   # non-zeros elements
         ixgrid = np.ix_(lines,nzi)
         nzigrid = np.ix_(nzi,nzi)
-        P[ixgrid] = np.linalg.solve(D[nzigrid],S0[ixgrid].T).T
+        if layout is None:
+            P[ixgrid] = np.linalg.solve(D[nzigrid],S0[ixgrid].T).T
+        else:
+            P[ixgrid] = factor_solve(cached_factor(layout,nzi,D),S0[ixgrid].T).T
     return P
 
-def circ_load_vert_stress(P,PLoc,PRad,AffLoc,AffDepth):
-    AffDepth = np.atleast_2d(np.array(AffDepth))
-    nsamp,npin = P.shape
-    nrec = AffLoc.shape[0]
-
-    x = AffLoc[:,0:1] - PLoc[:,0:1].T    # (npin,nrec)
-    y = AffLoc[:,1:2] - PLoc[:,1:2].T    # (npin,nrec)
-    z = np.dot(np.ones((npin,1)),AffDepth) # (npin,nrec)
-
-    r = np.hypot(x,y).T
-
+def stress_kernel(r,z,PRad):
     # Pressure stress matrix (r,t,z)  (SNEDDON 1946)
     XSI = z/PRad
     RHO = r/PRad
@@ -121,17 +274,76 @@ def circ_load_vert_stress(P,PLoc,PRad,AffLoc,AffDepth):
     J01 = np.sin(phi/2.) / np.sqrt(R)
     J02 = rr * np.sin(3./2.*phi - theta) / R**(3./2.)
 
+    return J01 + XSI*J02
+
+def circ_load_vert_stress(P,PLoc,PRad,AffLoc,AffDepth,tol=None):
+    # the output has the precision of P
+    if tol is not None:
+        return circ_load_vert_stress_sparse(P,PLoc,PRad,AffLoc,AffDepth,tol)
+
+    AffDepth = np.atleast_2d(np.array(AffDepth))
+    nsamp,npin = P.shape
+    nrec = AffLoc.shape[0]
+
+    x = AffLoc[:,0:1] - PLoc[:,0:1].T    # (npin,nrec)
+    y = AffLoc[:,1:2] - PLoc[:,1:2].T    # (npin,nrec)
+    z = np.dot(np.ones((npin,1)),AffDepth) # (npin,nrec)
+
+    r = np.hypot(x,y).T
+
     # Pressure rotated stress matrix (x,y,z)
     eps = P/2./PRad/PRad/np.pi
 
-    s_z = np.dot(eps,(J01 + XSI*J02))
+    # computed afferent-major, as afferents are processed one by one later
+    K = stress_kernel(r,z,PRad).astype(P.dtype,copy=False)
+    s_z = np.dot(K.T,eps.T).T
 
     return s_z
 
-def circ_load_dyn_wave(dynProfile,Ploc,PRad,Rloc,Rdepth,sfreq,sur):
-    nsamp = dynProfile.shape[1]
-    npin = dynProfile.shape[0]
+def stress_cutoff(PRad,depth,tol):
+    """Distance beyond which the stress kernel stays below tol times its
+    value under the pin.
+    """
+    r = PRad*np.geomspace(1e-3,1e6,2000)
+    k = np.abs(stress_kernel(r,depth,PRad))/np.abs(stress_kernel(0.,depth,PRad))
+    above = np.flatnonzero(k>=tol)
+    if above.size==0:
+        return r[0]
+    return r[min(above[-1]+1,r.size-1)]
+
+def propagation_pairs(PLoc,AffLoc,radius):
+    """Finds all pin-afferent pairs closer than radius using a KD-tree.
+
+    Returns:
+        Tuple of pin indices, afferent indices, and distances.
+    """
+    pairs = cKDTree(PLoc).sparse_distance_matrix(cKDTree(AffLoc),radius,
+        output_type='ndarray')
+    return pairs['i'], pairs['j'], pairs['v']
+
+def circ_load_vert_stress_sparse(P,PLoc,PRad,AffLoc,AffDepth,tol):
+    AffDepth = np.broadcast_to(np.asarray(AffDepth,dtype=float).reshape(-1),
+        (AffLoc.shape[0],))
+    nsamp,npin = P.shape
+    nrec = AffLoc.shape[0]
+
+    # only evaluate pairs within the largest cutoff distance
+    udepth = np.unique(AffDepth)
+    radius = max(stress_cutoff(PRad,d,tol) for d in udepth)
+    ip,ia,r = propagation_pairs(PLoc,AffLoc,radius)
 
+    z = AffDepth[ia]
+    J = stress_kernel(r,z,PRad)
+    keep = np.abs(J)>=tol*np.abs(stress_kernel(0.,z,PRad))
+    J = sparse.csr_matrix((J[keep].astype(P.dtype,copy=False),
+        (ia[keep],ip[keep])),shape=(nrec,npin))
+
+    # Pressure rotated stress matrix (x,y,z)
+    eps = P/2./PRad/PRad/np.pi
+
+    return (J @ eps.T).T
+
+def wave_delay_decay(Ploc,PRad,Rloc,sur):
     dr = sur.distance(Ploc,Rloc)
 
     # delay (everything is synchronous under the probe)
@@ -145,16 +357,82 @@ def circ_load_dyn_wave(dynProfile,Ploc,PRad,Rloc,Rdepth,sfreq,sur):
     np.seterr(all="warn")
     decay[dr<=PRad] = 1./2./PRad
 
-    udyn = add_delays(delay.T,decay.T,dynProfile,sfreq)
-    udyn = udyn.T
+    return delay, decay
+
+def circ_load_dyn_wave(dynProfile,Ploc,PRad,Rloc,Rdepth,sfreq,sur,history=None,
+    tol=None):
+    # the output has the precision of dynProfile; prepend preceding samples,
+    # so that delayed waves carry over
+    if history is not None:
+        dynProfile = np.concatenate((history,dynProfile),axis=1)
+
+    if tol is None:
+        delay,decay = wave_delay_decay(Ploc,PRad,Rloc,sur)
+        udyn = add_delays(delay.T,decay.T,dynProfile,sfreq)
+        udyn = udyn.T
+    else:
+        udyn = add_delays_sparse(dynProfile,Ploc,PRad,Rloc,sfreq,sur,tol)
+
+    if history is not None:
+        udyn = udyn[history.shape[1]:]
 
     # z decay is 1/z^2
-    udyn = udyn / (Rdepth**2)
+    udyn = np.divide(udyn,Rdepth**2,dtype=udyn.dtype)
 
     return udyn
 
-@guvectorize([(float64[:],float64[:],float64[:,:],float64[:],float64[:])],
-    '(m),(m),(m,n),()->(n)',nopython=True,target='parallel')
+def add_delays_sparse(dynProfile,Ploc,PRad,Rloc,sfreq,sur,tol):
+    npin,nsamp = dynProfile.shape
+    nrec = Rloc.shape[0]
+
+    # decay falls below tol times its maximum beyond this distance; distances
+    # on a surface are never shorter than straight lines, apart from one pixel
+    # of discretization
+    radius = PRad/np.sin(min(tol,1.)*np.pi/2.)
+    if sur.outline is None:
+        ip,ia,dr = propagation_pairs(Ploc,Rloc,radius)
+    else:
+        # geodesics only need to be followed up to the radius
+        ip,ia,_ = propagation_pairs(Ploc,Rloc,radius+2./sur.pxl_per_mm)
+        dr = sur.pair_distance(Ploc[ip],Rloc[ia],limit=radius)
+
+    keep = dr<=radius
+    ip,ia,dr = ip[keep],ia[keep],dr[keep]
+
+    # same delay and decay as wave_delay_decay()
+    delay_idx = np.rint(np.maximum(dr-PRad,0.)/8000.*sfreq).astype(np.int64)
+    with np.errstate(all='ignore'):
+        decay = 1./PRad/np.pi*np.arcsin(PRad/dr)
+    decay[dr<=PRad] = 1./2./PRad
+
+    # one sparse product per distinct delay
+    udyn = np.zeros((nsamp,nrec),dtype=dynProfile.dtype)
+    order = np.argsort(delay_idx,kind='stable')
+    bounds = np.flatnonzero(np.diff(delay_idx[order]))+1
+    for k in np.split(order,bounds):
+        if k.size==0:
+            continue
+        d = delay_idx[k[0]]
+        if d>=nsamp:
+            continue
+        W = sparse.csr_matrix((decay[k].astype(dynProfile.dtype,copy=False),
+            (ia[k],ip[k])),shape=(nrec,npin))
+        rows = np.flatnonzero(np.diff(W.indptr))
+        udyn[d:,rows] += (W[rows] @ dynProfile[:,:nsamp-d]).T
+    return udyn
+
+def max_delay(Ploc,PRad,Rloc,sfreq,sur):
+    """Longest wave propagation delay between pins and afferents in samples.
+    """
+    delay,_ = wave_delay_decay(Ploc,PRad,Rloc,sur)
+    delay = delay[np.isfinite(delay)]
+    if delay.size==0:
+        return 0
+    return int(np.rint(np.max(delay)*sfreq))
+
+@guvectorize([(float64[:],float64[:],float32[:,:],float64[:],float32[:]),
+    (float64[:],float64[:],float64[:,:],float64[:],float64[:])],
+    '(m),(m),(m,n),()->(n)',nopython=True,target='parallel',cache=True)
 def add_delays(delay,decay,dynProfile,sfreq,udyn):
     for i in range(udyn.shape[0]):
         udyn[i] = 0
@@ -167,80 +445,368 @@ def add_delays(delay,decay,dynProfile,sfreq,udyn):
             for i in range(dynProfile.shape[1]):
                 udyn[i] += dynProfile[jj,i]*decay[jj]
 
-def lif_neuron(aff,stimi,dstimi):
+# Butterworth filters by cutoff parameter, filled from constants.affparams on
+# first use
+_sos_bank = {}
+
+def model_filter(cutoff):
+    """Returns the low-pass filter (second-order sections) of a neuron model
+    with the given cutoff parameter.
+    """
+    if len(_sos_bank)==0:
+        for p in affparams.values():
+            for c in np.unique(p[:,0]):
+                _sos_bank[c] = signal.butter(3,c*4./1000.,output='sos')
+    sos = _sos_bank.get(cutoff)
+    if sos is None:
+        # parameters not from the standard models
+        sos = signal.butter(3,cutoff*4./1000.,output='sos')
+        _sos_bank[cutoff] = sos
+    return sos
+
+def lif_neuron(aff,stimi,dstimi,seed=None):
+    return LIFStream(aff,seed=seed).process(stimi,dstimi,final=True)
+
+class LIFStream(object):
+    """Filters mechanical inputs and integrates the leaky integrate-and-fire
+    model block by block. Filter states, membrane voltages, post-spike current
+    counters, and noise streams are carried across block boundaries, so that
+    processing a trace in blocks gives the same spikes as processing it at once.
+    """
     srate = 5000. # fixed sampling frequency
-
-    stimi = stimi.T
-    dstimi = dstimi.T
-
-    p = np.atleast_2d(aff.parameters)
-
-    # Make basis for post-spike current
-    ih = np.dot(p[:,10:12],ihbasis)
-
-    uq,ia,ic = np.unique(np.atleast_2d(aff.gid),axis=0,
-        return_index=True,return_inverse=True)
-    for i in range(uq.shape[0]):
-        bfilt,afilt = signal.butter(3,p[ia[i],0]*4./1000.)
-        if uq[i,0]==0:
-            stimi[ic==i] = signal.lfilter(bfilt,afilt,stimi[ic==i],axis=1)
-        dstimi[ic==i] = signal.lfilter(bfilt,afilt,dstimi[ic==i],axis=1)
-
-    Iinj = weight_inputs(p,stimi,dstimi)
-
-    Vmem = np.zeros(Iinj.shape)
-    Sp = lif_sub(Vmem,Iinj,ih,p,aff.noisy)
-
-    spikes = []
-    for i in range(len(aff)):
-        spikes.append(np.flatnonzero(Sp[i])/srate + p[i,12]/1000. + 1./srate)
-
-    return spikes
-
-@guvectorize([(float64[:],float64[:],float64[:],float64[:])],
-    '(m),(n),(n)->(n)',nopython=True,target='parallel')
-def weight_inputs(p,stimi,dstimi,Iinj):
-    for i in range(stimi.shape[0]):
-        if np.sign(stimi[i])>=0:
-            Iinj[i]  = p[1]*stimi[i]
+    scratch_bytes = 2**26 # spike index buffers per integrate() call
+
+    def __init__(self,aff,seed=None):
+        """Initializes a LIFStream object.
+
+        Args:
+            aff (Afferent or AfferentPopulation object): The afferents.
+            seed (2D array): Per-afferent keys of the membrane noise streams,
+                one row of (seed, stimulus index, afferent index) per afferent
+                as returned by noise_seeds(); None draws a random seed
+                (default: None).
+        """
+        p = np.atleast_2d(aff.parameters)
+        static = np.atleast_2d(aff.gid)[:,0]==0 # only SA1 filter statics
+
+        # each filter works on a contiguous block of afferents; populations
+        # are usually generated in runs of the same model, otherwise afferents
+        # are sorted by filter and everything downstream runs in that order
+        key = np.column_stack((~static,p[:,0]))
+        uq,ic = np.unique(key,axis=0,return_inverse=True)
+        ic = ic.reshape(-1)
+        self.order = None
+        runs = np.flatnonzero(np.diff(ic))+1
+        if runs.size>=2*uq.shape[0]:
+            self.order = np.argsort(ic,kind='stable')
+            ic = ic[self.order]
+            runs = np.flatnonzero(np.diff(ic))+1
+        bounds = np.concatenate(([0],runs,[ic.size]))
+
+        self.groups = []
+        for a,b in zip(bounds[:-1],bounds[1:]):
+            sos = model_filter(uq[ic[a],1])
+            zi = np.zeros((b-a,sos.shape[0],2))
+            self.groups.append([slice(a,b),uq[ic[a],0]==0,sos,zi,zi.copy()])
+
+        self.p = self._sorted(p)
+
+        # Make basis for post-spike current
+        self.ih = np.dot(self.p[:,10:12],ihbasis)
+
+        # noise is drawn from counter-based streams keyed per afferent and
+        # indexed by sample, so it does not depend on threads or blocks
+        self.noisy = self._sorted(np.atleast_1d(aff.noisy))
+        if seed is None:
+            n = self.p.shape[0]
+            seed = np.column_stack((np.full(n,np.random.SeedSequence().entropy
+                % 2**63,dtype=np.int64),np.zeros(n,dtype=np.int64),np.arange(n)))
+        self.seed = self._sorted(np.asarray(seed,dtype=np.int64))
+
+        self.state = np.zeros((self.p.shape[0],2))
+        self.state[:,1] = self.ih.shape[1]
+        self.held = None
+        self.offset = 0
+
+    def _sorted(self,x):
+        return x if self.order is None else x[self.order]
+
+    def sorted(self,aff):
+        """Returns the afferents in filter order. Propagating stimuli to these
+        instead of the original population saves reordering the inputs.
+        """
+        return aff if self.order is None else aff[self.order]
+
+    def process(self,stimi,dstimi,final=False,presorted=False,csr=False):
+        """Processes the next block of mechanical inputs.
+
+        Args:
+            stimi (2D array): Static mechanical input (samples x afferents).
+            dstimi (2D array): Dynamic mechanical input (samples x afferents).
+            final (bool): Whether this is the last block (default: False).
+            presorted (bool): Whether inputs are already in filter order, i.e.
+                were computed for sorted() of the afferents (default: False).
+            csr (bool): Return spikes in compressed form, see integrate()
+                (default: False).
+
+        Returns:
+            List of arrays containing the spike times for each afferent.
+        """
+        with stage('filter',shape=stimi.shape):
+            stimi,dstimi = self.filter(stimi,dstimi,presorted)
+        with stage('lif',shape=stimi.shape) as ev:
+            spikes = self.integrate(stimi,dstimi,final,csr)
+            ev['spikes'] = int(spikes[0][-1]) if csr else\
+                sum(len(sp) for sp in spikes)
+        return spikes
+
+    def filter(self,stimi,dstimi,presorted=False):
+        """Low-pass filters the next block of mechanical inputs.
+
+        Returns:
+            Tuple of filtered static and dynamic inputs (afferents x samples,
+            in filter order).
+        """
+        # transpose, so that each afferent's samples are contiguous
+        stimi = np.ascontiguousarray(stimi.T)
+        dstimi = np.ascontiguousarray(dstimi.T)
+        if not presorted:
+            stimi = self._sorted(stimi)
+            dstimi = self._sorted(dstimi)
+
+        # filter each block of afferents in place, carrying filter states
+        for rows,static,sos,zs,zd in self.groups:
+            if static:
+                x = stimi[rows]
+                sos_filter(x,sos,zs,x,zs)
+            x = dstimi[rows]
+            sos_filter(x,sos,zd,x,zd)
+        return stimi, dstimi
+
+    def integrate(self,stimi,dstimi,final=False,csr=False):
+        """Integrates the model over the next block of filtered inputs.
+
+        Args:
+            stimi (2D array): Filtered static input (afferents x samples).
+            dstimi (2D array): Filtered dynamic input (afferents x samples).
+            final (bool): Whether this is the last block (default: False).
+            csr (bool): Return spikes in compressed form (default: False).
+
+        Returns:
+            List of arrays containing the spike times for each afferent, or, if
+            csr is True, a tuple of offsets (afferents+1) and concatenated spike
+            times, where the spikes of afferent i are
+            times[offsets[i]:offsets[i+1]].
+        """
+        n,nsamp = stimi.shape
+        # input currents depend on the following sample, so the last sample
+        # is held back until the next block arrives
+        held = np.zeros((n,2)) if self.held is None else self.held
+        flags = np.array([self.held is not None,final,self.offset],
+            dtype=np.int64)
+        steps = nsamp + flags[0] - (not final)
+
+        # spikes need at least 6 samples between them; start with room for
+        # moderate rates, within the scratch budget, and rerun afferents that
+        # exceed it once their exact spike counts are known
+        cap = min(max(steps//6+2,1),max(16,steps//32),
+            max(self.scratch_bytes//(8*max(n,1)),1))
+        idx,counts,state = lif_spikes(stimi,dstimi,self.seed,self.p,self.ih,
+            self.noisy,self.state,held,flags,np.empty(cap))
+        offsets = np.zeros(n+1,dtype=np.int64)
+        np.cumsum(counts,out=offsets[1:])
+        indices = np.empty(offsets[-1],dtype=np.int64)
+
+        fits = np.flatnonzero(counts<=cap)
+        csr_scatter(indices,offsets,fits,idx[fits],counts[fits])
+        del idx
+        over = np.flatnonzero(counts>cap)
+        if over.size>0:
+            # rerun in chunks of afferents whose spikes fit the budget
+            step = max(self.scratch_bytes//(8*int(counts[over].max())),1)
+            for k in range(0,over.size,step):
+                rows = over[k:k+step]
+                idx2,_,_ = lif_spikes(stimi[rows],dstimi[rows],self.seed[rows],
+                    self.p[rows],self.ih[rows],self.noisy[rows],
+                    self.state[rows],held[rows],flags,
+                    np.empty(int(counts[rows].max())))
+                csr_scatter(indices,offsets,rows,idx2,counts[rows])
+
+        self.state = state
+        self.held = None if final else np.column_stack(
+            (stimi[:,-1],dstimi[:,-1])) if nsamp>0 else self.held
+        times = (indices+self.offset)/self.srate +\
+            np.repeat(self.p[:,12]/1000.,counts) + 1./self.srate
+        self.offset += steps
+
+        if self.order is not None:
+            inv = np.empty_like(self.order)
+            inv[self.order] = np.arange(n)
+            offsets,times = csr_take(offsets,times,inv)
+        if csr:
+            return offsets, times
+        return np.split(times,offsets[1:-1])
+
+def csr_take(offsets,values,rows):
+    """Selects rows of a compressed sparse row (CSR) list of arrays.
+
+    Args:
+        offsets (1D array): Row offsets (rows+1).
+        values (1D array): Concatenated values of all rows.
+        rows (1D int array): Rows to select.
+
+    Returns:
+        Tuple of offsets and values of the selected rows.
+    """
+    counts = offsets[1:][rows] - offsets[:-1][rows]
+    new = np.zeros(len(rows)+1,dtype=np.int64)
+    np.cumsum(counts,out=new[1:])
+    idx = np.repeat(offsets[:-1][rows]-new[:-1],counts) + np.arange(new[-1])
+    return new, values[idx]
+
+def csr_scatter(indices,offsets,rows,idx,counts):
+    """Copies the first counts[k] entries of idx[k] into row rows[k] of a
+    compressed sparse row (CSR) list of arrays.
+
+    Args:
+        indices (1D array): Concatenated values of all rows, written in place.
+        offsets (1D array): Row offsets.
+        rows (1D int array): Rows to write.
+        idx (2D array): Values for each row, padded to equal length.
+        counts (1D int array): Number of values for each row.
+    """
+    start = np.zeros(len(rows)+1,dtype=np.int64)
+    np.cumsum(counts,out=start[1:])
+    r = np.repeat(np.arange(len(rows)),counts)
+    c = np.arange(start[-1]) - start[:-1][r]
+    indices[offsets[:-1][rows][r] + c] = idx[r,c]
+
+@guvectorize([(float32[:],float64[:,:],float64[:,:],float32[:],float64[:,:]),
+    (float64[:],float64[:,:],float64[:,:],float64[:],float64[:,:])],
+    '(n),(s,m),(s,k)->(n),(s,k)',nopython=True,target='parallel',cache=True)
+def sos_filter(x,sos,zi,y,zo):
+    # cascade of second-order sections (transposed direct form II), as in
+    # scipy.signal.sosfilt; x and y, zi and zo may be the same arrays. Single
+    # precision inputs are filtered with double precision states.
+    ns = sos.shape[0]
+    z = zi.copy()
+    for i in range(x.shape[0]):
+        v = x[i]
+        for s in range(ns):
+            w = sos[s,0]*v + z[s,0]
+            z[s,0] = sos[s,1]*v - sos[s,4]*w + z[s,1]
+            z[s,1] = sos[s,2]*v - sos[s,5]*w
+            v = w
+        y[i] = v
+    for s in range(ns):
+        zo[s,0] = z[s,0]
+        zo[s,1] = z[s,1]
+
+_philox_m = (np.uint64(0xD2511F53),np.uint64(0xCD9E8D57))
+_philox_w = (np.uint64(0x9E3779B9),np.uint64(0xBB67AE85))
+_mask32 = np.uint64(0xFFFFFFFF)
+
+@njit(cache=True)
+def philox4x32(c0,c1,c2,c3,k0,k1):
+    # Philox4x32-10 counter-based generator (Salmon et al. 2011); all
+    # arguments and results are 32-bit words held in uint64
+    m0,m1 = _philox_m
+    w0,w1 = _philox_w
+    for r in range(10):
+        p0 = m0*c0
+        p1 = m1*c2
+        c0,c1,c2,c3 = ((p1>>np.uint64(32))^c1^k0, p1&_mask32,
+            (p0>>np.uint64(32))^c3^k1, p0&_mask32)
+        k0 = (k0+w0)&_mask32
+        k1 = (k1+w1)&_mask32
+    return c0,c1,c2,c3
+
+@njit(cache=True)
+def philox_normals(key,pair):
+    # standard normal deviates 2*pair and 2*pair+1 of the stream with key
+    # (seed, stimulus, afferent), by Box-Muller
+    seed = np.uint64(key[0])
+    pair = np.uint64(pair)
+    x0,x1,x2,x3 = philox4x32(pair&_mask32,pair>>np.uint64(32),
+        np.uint64(key[1])&_mask32,np.uint64(key[2])&_mask32,
+        seed&_mask32,seed>>np.uint64(32))
+    u1 = ((x0>>np.uint64(5))*np.uint64(67108864)+(x1>>np.uint64(6)))/\
+        9007199254740992.
+    u2 = ((x2>>np.uint64(5))*np.uint64(67108864)+(x3>>np.uint64(6)))/\
+        9007199254740992.
+    r = np.sqrt(-2.*np.log(1.-u1))
+    return r*np.cos(2.*np.pi*u2), r*np.sin(2.*np.pi*u2)
+
+@guvectorize([(float32[:],float32[:],int64[:],float64[:],float64[:],
+    boolean[:],float64[:],float64[:],int64[:],float64[:],int64[:],int64[:],
+    float64[:]),(float64[:],float64[:],int64[:],float64[:],float64[:],
+    boolean[:],float64[:],float64[:],int64[:],float64[:],int64[:],int64[:],
+    float64[:])],'(n),(n),(q),(o),(m),(),(k),(j),(l),(c)->(c),(),(k)',
+    nopython=True,target='parallel',cache=True)
+def lif_spikes(stimi,dstimi,key,p,ih,noisy,state,held,flags,cap,idx,count,
+    state_out):
+    # fused input weighting and leaky integrate-and-fire; flags are (held
+    # sample present, final block, index of the first sample), held the static
+    # and dynamic input of the sample held back from the previous block, key
+    # that of the noise stream. Writes up to cap.size spike indices and the
+    # total number of spikes.
+    n = stimi.shape[0]
+    h = flags[0]
+    total = n + h
+    steps = total if flags[1] else total-1
+    tau = p[9]
+    nh = ih.size
+    V = state[0]
+    ih_counter = int(state[1])
+    cnt = 0
+    z = (0.,0.)
+    for ii in range(steps):
+        if ii<h:
+            s = held[0]
+            d = held[1]
         else:
-            Iinj[i]  = -p[2]*stimi[i]
+            s = stimi[ii-h]
+            d = dstimi[ii-h]
+        jj = min(ii+1,total-1)
+        dn = held[1] if jj<h else dstimi[jj-h]
 
-        if np.sign(dstimi[i])>=0:
-            Iinj[i]  += p[3]*dstimi[i]
+        if s>=0.:
+            I = p[1]*s
         else:
-            Iinj[i]  += -p[4]*dstimi[i]
-
-        ddstimi = (dstimi[min(i+1,stimi.shape[0]-1)]-dstimi[i])
-        if np.sign(ddstimi)>=0:
-            Iinj[i]  += p[5]*ddstimi
+            I = -p[2]*s
+        if d>=0.:
+            I += p[3]*d
         else:
-            Iinj[i]  += -p[6]*ddstimi
-
-@guvectorize([(float64[:],float64[:],float64[:],float64[:],boolean[:],
-    float64[:])],'(n),(n),(m),(o),()->(n)',nopython=True,target='parallel')
-def lif_sub(Vmem,Iinj,ih,p,noisy,Sp):
-    if noisy[0]:
-        Iinj += p[8]*np.random.standard_normal(Iinj.shape)
-
-    tau = p[9]
-    if p[7]>0.:
-        Iinj = p[7]*Iinj/(p[7]+np.abs(Iinj))
-        Iinj[np.isnan(Iinj)] = 0.
-
-    nh = ih.size
-    ih_counter = nh
-    for ii in range(Vmem.size):
+            I += -p[4]*d
+        dd = dn - d
+        if dd>=0.:
+            I += p[5]*dd
+        else:
+            I += -p[6]*dd
+
+        if noisy[0]:
+            t = flags[2] + ii
+            if ii==0 or t&1==0:
+                z = philox_normals(key,t>>1)
+            I += p[8]*z[t&1]
+        if p[7]>0.:
+            I = p[7]*I/(p[7]+np.abs(I))
+            if np.isnan(I):
+                I = 0.
 
         if ih_counter==nh:
-            Vmem[ii] =  Vmem[ii-1] + (-(Vmem[ii-1])/tau + Iinj[ii])
+            V =  V + (-V/tau + I)
         else:
-            Vmem[ii] =  Vmem[ii-1] + (-(Vmem[ii-1])/tau + Iinj[ii] + ih[ih_counter])
+            V =  V + (-V/tau + I + ih[ih_counter])
             ih_counter += 1
 
-        if Vmem[ii]>1. and ih_counter>5:
-            Sp[ii] = 1
-            Vmem[ii] = 0.
+        if V>1. and ih_counter>5:
+            if cnt<cap.size:
+                idx[cnt] = ii
+            cnt += 1
+            V = 0.
             ih_counter = 0
-        else:
-            Sp[ii] = 0
+
+    count[0] = cnt
+    state_out[0] = V
+    state_out[1] = ih_counter
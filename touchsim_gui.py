@@ -8,13 +8,15 @@ from dataclasses import dataclass
 from matplotlib.backends.backend_pdf import PdfPages
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QListWidget, QVBoxLayout, QHBoxLayout, QFileDialog,
-    QLabel, QPushButton, QGroupBox, QMessageBox, QSizePolicy, QDoubleSpinBox, QCheckBox, QComboBox
+    QLabel, QPushButton, QGroupBox, QMessageBox, QSizePolicy, QDoubleSpinBox, QCheckBox, QComboBox,
+    QProgressBar
 )
 
 ### LOCAL DEPENDENCIES
 from guimpl import *
 from modelselector import *
 from buttonstyler import *
+from simworker import SimJob, SimulationThread, TaskThread
 
 # ------------------------------------------------------------
 # Sorted stimulation sites
@@ -40,6 +42,37 @@ class StimData:
     path: str
     df: pd.DataFrame
 
+# ------------------------------------------------------------
+# Export helpers
+# ------------------------------------------------------------
+EXPORT_FILTERS = "CSV Files (*.csv);;TouchSim Binary (*.tsr)"
+
+def is_binary_export(path, selected_filter):
+    return path.endswith(".tsr") or "tsr" in selected_filter
+
+def psth_densities(responses, bin_size):
+    """Spikes per ms in each PSTH bin for every response, and their average
+    over responses (responses may differ in length)."""
+    densities = {
+        name: np.sum(resp.psth(bin=bin_size), axis=0) / bin_size
+        for name, resp in responses.items()
+    }
+    max_bins = max(len(d) for d in densities.values())
+    padded = np.full((len(densities), max_bins), np.nan)
+    for i, d in enumerate(densities.values()):
+        padded[i, :len(d)] = d
+    return densities, np.nanmean(padded, axis=0)
+
+def combine_responses(responses):
+    """Joins single-stimulus responses of the same afferent(s) into one
+    Response with one stimulus per entry."""
+    first = next(iter(responses.values()))
+    offsets, times = ts.classes.stack_csr(
+        [(r._offsets, r._times) for r in responses.values()]
+    )
+    stims = [r.stim[0] for r in responses.values()]
+    return ts.Response.from_csr(first.aff, stims, offsets, times)
+
 # ------------------------------------------------------------
 # Main GUI Class
 # ------------------------------------------------------------
@@ -51,6 +84,9 @@ class TouchSimApp(QWidget):
 
         self.loaded_csvs: list[StimData] = []
         self.r = None
+        self.all_responses = {}
+        self.sim_thread = None
+        self.task_thread = None
         # PSTH bin size in milliseconds (user-configurable)
         self.psth_bin_size = 100.0
 
@@ -60,6 +96,15 @@ class TouchSimApp(QWidget):
     def current_time(self):
         return time.ctime(time.time())
 
+    # Stop background simulations before closing
+    def closeEvent(self, event):
+        if self.sim_thread is not None and self.sim_thread.isRunning():
+            self.sim_thread.cancel()
+            self.sim_thread.wait()
+        if self.task_thread is not None:
+            self.task_thread.wait()
+        super().closeEvent(event)
+
     # DEBUG LOGGER
     def log(self, msg):
         print(f"{self.current_time()[-13:-5]} -> {msg}")
@@ -158,8 +203,8 @@ class TouchSimApp(QWidget):
         csv_group.setLayout(csv_layout)
 
         # Simulation button
-        sim_btn = QPushButton("Generate Afferent Response")
-        sim_btn.clicked.connect(self.generate_response)
+        self.sim_btn = QPushButton("Generate Afferent Response")
+        self.sim_btn.clicked.connect(self.generate_response)
         
         # Multi-model export group
         model_export_group = QGroupBox("Export All Models")
@@ -174,10 +219,10 @@ class TouchSimApp(QWidget):
             model_export_layout.addWidget(checkbox)
         
         # Multi-model export button
-        multi_export_btn = QPushButton("Export All Selected Models")
-        multi_export_btn.clicked.connect(self.export_all_models)
-        highlight_button(multi_export_btn, color="blue")
-        model_export_layout.addWidget(multi_export_btn)
+        self.multi_export_btn = QPushButton("Export All Selected Models")
+        self.multi_export_btn.clicked.connect(self.export_all_models)
+        highlight_button(self.multi_export_btn, color="blue")
+        model_export_layout.addWidget(self.multi_export_btn)
         model_export_group.setLayout(model_export_layout)
     
         # Export button
@@ -202,9 +247,20 @@ class TouchSimApp(QWidget):
         bin_layout.addWidget(bin_label)
         bin_layout.addWidget(self.psth_bin_input)
         left_panel.addLayout(bin_layout)
-        left_panel.addWidget(sim_btn)
+        left_panel.addWidget(self.sim_btn)
         left_panel.addWidget(self.export_btn)
         left_panel.addWidget(model_export_group)
+
+        # Simulation progress and cancel
+        progress_layout = QHBoxLayout()
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setTextVisible(True)
+        self.cancel_btn = QPushButton("Cancel")
+        self.cancel_btn.clicked.connect(self.cancel_simulation)
+        self.cancel_btn.setEnabled(False)
+        progress_layout.addWidget(self.progress_bar)
+        progress_layout.addWidget(self.cancel_btn)
+        left_panel.addLayout(progress_layout)
         left_panel.addStretch()
         layout.addLayout(left_panel, 1) # Width Ratio
         
@@ -354,17 +410,9 @@ class TouchSimApp(QWidget):
     # --------------------------------------------------------
     # Generate TouchSim Response
     # --------------------------------------------------------
-    def generate_single_response(self, stim_data: StimData, selected_aff: str):
-
-        # Afferent
-        idx = self.model_selector.selected_idx()
-
-        a = ts.Afferent(
-            affclass=selected_aff,
-            idx=idx  # None = Random (Default)
-            )
-        
-        # Stimulus
+    def stimulus_arrays(self, stim_data: StimData):
+        """Returns the trace and sampling frequency of a loaded CSV, or None
+        (after telling the user) if it cannot be simulated."""
         stim_df = stim_data.df
         stim_name = stim_data.name
         
@@ -378,21 +426,64 @@ class TouchSimApp(QWidget):
             stimulus_trace = stim_df.get("amplitude").to_numpy()
         except:
             QMessageBox.critical(self, "Error", f"Missing/corrupted stimulus data: '{stim_name}'")
-            return
+            return None
 
         if len(stimulus_timestamp) <= 1:
-            QMessageBox.critical(self, "Insufficient Data", "Stimulus should contain at least 2 data points")
-            return
+            QMessageBox.critical(self, "Insufficient Data", f"Stimulus '{stim_name}' should contain at least 2 data points")
+            return None
 
         sampling_freq = 1 / (float(stimulus_timestamp[1]) - float(stimulus_timestamp[0]))
-        self.log(f"Generating Stimulus. Detected Sampling Frequency: {sampling_freq}")
-        s = ts.Stimulus(trace=stimulus_trace, fs=sampling_freq)
+        self.log(f"Detected Sampling Frequency of {stim_name}: {sampling_freq}")
+        return stimulus_trace, sampling_freq
+
+    def start_jobs(self, jobs, on_result, on_done, on_failed=None):
+        """Runs simulation jobs in the background, reporting progress."""
+        if self.sim_thread is not None and self.sim_thread.isRunning():
+            QMessageBox.warning(self, "Busy", "A simulation is already running.")
+            return False
+        if not jobs:
+            return False
+
+        self.sim_thread = SimulationThread(jobs, parent=self)
+        self.sim_thread.result.connect(on_result)
+        self.sim_thread.failed.connect(
+            lambda job, msg: self.log(f"Warning: Could not generate response for {job.stim_name} with {job.label}: {msg}")
+        )
+        if on_failed is not None:
+            self.sim_thread.failed.connect(on_failed)
+        self.sim_thread.progress.connect(self.update_progress)
+        self.sim_thread.done.connect(self.simulation_finished)
+        self.sim_thread.done.connect(on_done)
+
+        self.set_busy(True)
+        self.sim_thread.start()
+        return True
+
+    def set_busy(self, busy):
+        for btn in (self.sim_btn, self.multi_export_btn):
+            btn.setEnabled(not busy)
+        self.cancel_btn.setEnabled(busy)
+        if busy:
+            disable_button(self.export_btn)
+            self.progress_bar.setValue(0)
+
+    def update_progress(self, done, total):
+        self.progress_bar.setMaximum(max(total, 1))
+        self.progress_bar.setValue(done)
+        self.progress_bar.setFormat(f"%v / %m simulations")
+
+    def cancel_simulation(self):
+        if self.sim_thread is not None and self.sim_thread.isRunning():
+            self.log("Cancelling simulation")
+            self.sim_thread.cancel()
+
+    def simulation_finished(self, cancelled):
+        self.set_busy(False)
+        if cancelled:
+            self.progress_bar.setFormat("Cancelled")
+        if self.all_responses:
+            enable_button(self.export_btn, highlight=True, color="green")
 
-        # Response
-        self.log(f"Generating Response for {stim_name}")
-        r = a.response(s)
-        return r
-        
     def generate_response(self):
         if len(self.loaded_csvs) == 0:
             QMessageBox.warning(self, "No CSV", "Please import stimulation CSV first.")
@@ -403,25 +494,90 @@ class TouchSimApp(QWidget):
             QMessageBox.warning(self, "No Afferents", "Select at least one afferent type.")
             return
 
-        responses: dict[str, Response] = {}
+        idx = self.model_selector.selected_idx()  # None = Random (Default)
+        jobs = []
         for stim_data in self.loaded_csvs:
-            single_response = self.generate_single_response(
-                stim_data=stim_data, selected_aff=selected_aff
-            )
-            responses[stim_data.name] = single_response
+            arrays = self.stimulus_arrays(stim_data)
+            if arrays is not None:
+                jobs.append(SimJob(
+                    label=selected_aff, stim_name=stim_data.name,
+                    affclass=selected_aff, idx=idx,
+                    trace=arrays[0], fs=arrays[1]
+                ))
+
+        self.all_responses = {}
+        order = [stim_data.name for stim_data in self.loaded_csvs]
+
+        def show_result(job, response):
+            # keep responses in CSV order and replot as they come in
+            self.all_responses[job.stim_name] = response
+            responses = {
+                name: self.all_responses[name] for name in order
+                if name in self.all_responses
+            }
+            self.all_responses = responses
+            self.log(f"Plotting Response for {job.stim_name}")
+            self.resp_canvas.plot_multiple_spike_sets(responses=responses)
+            try:
+                self.psth_canvas.plot_multiple_psth(responses=responses, bin_size=self.psth_bin_size, title="Combined PSTH")
+            except Exception:
+                pass
+
+        self.log(f"Generating Responses for {len(jobs)} stimuli")
+        self.start_jobs(jobs, show_result, lambda cancelled: None)
+
+    def export_model(self, model_label, responses, base_dir, base_name, writer, **attrs):
+        """Writes the responses of one model to the binary file or to CSVs.
+
+        Returns:
+            Whether the spike data were exported.
+        """
+        if writer is not None:
+            try:
+                writer.write(
+                    model_label, combine_responses(responses),
+                    stimuli=list(responses.keys()), **attrs
+                )
+                self.log(f"Exported {model_label} to: {writer.path}")
+                return True
+            except Exception as e:
+                self.log(f"Warning: Could not export {model_label}: {e}")
+                return False
+
+        exported = False
+        try:
+            spike_series_list = [
+                pd.Series(resp.spikes[0], name=name)
+                for name, resp in responses.items()
+            ]
+            spike_series_df = pd.concat(spike_series_list, axis=1)
+            spike_path = os.path.join(base_dir, f"{base_name}_{model_label}.csv")
+            spike_series_df.to_csv(spike_path, index=False)
+            self.log(f"Exported spike data for {model_label} to: {spike_path}")
+            exported = True
+        except Exception as e:
+            self.log(f"Warning: Could not export spike series for {model_label}: {e}")
         
-        # Plotting
-        self.log("Plotting Response")
-        self.resp_canvas.plot_multiple_spike_sets(responses=responses)
-        # Update PSTH preview (combined)
+        # Export PSTH data for this model
         try:
-            self.psth_canvas.plot_multiple_psth(responses=responses, bin_size=self.psth_bin_size, title="Combined PSTH")
-        except Exception:
-            pass
-
-        # Enable export
-        enable_button(self.export_btn, highlight=True, color="green")
-        self.all_responses = responses
+            # Average spikes per ms across all stimuli for this model
+            densities, avg_spike_per_bin = psth_densities(
+                responses, self.psth_bin_size
+            )
+            
+            # Create DataFrame with individual and average data
+            psth_df = pd.DataFrame()
+            psth_df["Average"] = avg_spike_per_bin
+            
+            for name, spike_densities in densities.items():
+                psth_df[name] = pd.Series(spike_densities)
+            
+            psth_path = os.path.join(base_dir, f"{base_name}_{model_label}_PSTH.csv")
+            psth_df.to_csv(psth_path, index=False)
+            self.log(f"Exported PSTH data for {model_label} to: {psth_path}")
+        except Exception as e:
+            self.log(f"Warning: Could not export PSTH for {model_label}: {e}")
+        return exported
 
     def export_all_models(self):
         """Generate responses for all selected afferent models (individually) and export results."""
@@ -442,8 +598,8 @@ class TouchSimApp(QWidget):
         self.log(f"Generating responses for selected models: {selected_afferents}")
 
         # Ask user for export path
-        out_path, _ = QFileDialog.getSaveFileName(
-            self, "Save Multi-Model Export", "", "CSV Files (*.csv)"
+        out_path, selected_filter = QFileDialog.getSaveFileName(
+            self, "Save Multi-Model Export", "", EXPORT_FILTERS
         )
         if not out_path:
             return
@@ -451,124 +607,100 @@ class TouchSimApp(QWidget):
         base_dir = os.path.dirname(out_path)
         base_name = os.path.splitext(os.path.basename(out_path))[0]
 
-        # Track exported models for logging
-        exported_models = []
+        stimuli = []
+        for stim_data in self.loaded_csvs:
+            arrays = self.stimulus_arrays(stim_data)
+            if arrays is not None:
+                stimuli.append((stim_data.name, arrays))
 
-        # Generate responses for each selected afferent type and each model index
+        # All selected models form one population, so each CSV is solved and
+        # simulated once, in one job per CSV
+        labels, classes, indices = [], [], []
         for aff_type in selected_afferents:
-            self.log(f"Processing {aff_type} models")
-            
-            # Try to find all available model indices for this afferent type
-            model_idx = 0
-            while True:
-                try:
-                    # Try to create an afferent with this index to check if it exists
-                    test_aff = ts.Afferent(affclass=aff_type, idx=model_idx)
-                    
-                    # Generate responses for all stimuli with this specific model
-                    responses: dict[str, ts.Response] = {}
-                    model_label = f"{aff_type}{model_idx}"
-                    
-                    for stim_data in self.loaded_csvs:
-                        # Create afferent with specific model index
-                        a = ts.Afferent(affclass=aff_type, idx=model_idx)
-                        
-                        # Get stimulus data
-                        stim_df = stim_data.df
-                        stim_name = stim_data.name
-                        
-                        try:
-                            stimulus_timestamp = stim_df.get("time").to_numpy()
-                            stimulus_trace = stim_df.get("amplitude").to_numpy()
-                            
-                            if len(stimulus_timestamp) <= 1:
-                                continue
-                            
-                            sampling_freq = 1 / (float(stimulus_timestamp[1]) - float(stimulus_timestamp[0]))
-                            s = ts.Stimulus(trace=stimulus_trace, fs=sampling_freq)
-                            r = a.response(s)
-                            responses[stim_name] = r
-                        except Exception as e:
-                            self.log(f"Warning: Could not generate response for {stim_name} with {model_label}: {e}")
-                            continue
-                    
-                    # Export spike series data for this model
-                    if responses:
-                        try:
-                            spike_series_list = [
-                                pd.Series(resp.spikes[0], name=name)
-                                for name, resp in responses.items()
-                            ]
-                            spike_series_df = pd.concat(spike_series_list, axis=1)
-                            spike_path = os.path.join(base_dir, f"{base_name}_{model_label}.csv")
-                            spike_series_df.to_csv(spike_path, index=False)
-                            self.log(f"Exported spike data for {model_label} to: {spike_path}")
-                            exported_models.append(model_label)
-                        except Exception as e:
-                            self.log(f"Warning: Could not export spike series for {model_label}: {e}")
-                        
-                        # Export PSTH data for this model
-                        try:
-                            bin_size = self.psth_bin_size
-                            
-                            # Calculate average spikes per ms across all stimuli for this model
-                            all_spike_densities = []
-                            for name, response in responses.items():
-                                spike_counts = np.sum(response.psth(bin=bin_size), axis=0)
-                                spike_densities = spike_counts / bin_size
-                                all_spike_densities.append(spike_densities)
-                            
-                            # Calculate average for each bin
-                            max_bins = max(len(densities) for densities in all_spike_densities)
-                            avg_spike_per_bin = []
-                            for bin_idx in range(max_bins):
-                                bin_values = [
-                                    densities[bin_idx] for densities in all_spike_densities
-                                    if bin_idx < len(densities)
-                                ]
-                                avg_spike_per_bin.append(np.mean(bin_values))
-                            
-                            # Create DataFrame with individual and average data
-                            psth_df = pd.DataFrame()
-                            psth_df["Average"] = avg_spike_per_bin
-                            
-                            for name, response in responses.items():
-                                spike_counts = np.sum(response.psth(bin=bin_size), axis=0)
-                                spike_densities = spike_counts / bin_size
-                                psth_df[name] = spike_densities
-                            
-                            psth_path = os.path.join(base_dir, f"{base_name}_{model_label}_PSTH.csv")
-                            psth_df.to_csv(psth_path, index=False)
-                            self.log(f"Exported PSTH data for {model_label} to: {psth_path}")
-                        except Exception as e:
-                            self.log(f"Warning: Could not export PSTH for {model_label}: {e}")
-                    
-                    model_idx += 1
-                    
-                except Exception:
-                    # No more models available for this afferent type
-                    break
-
-        if exported_models:
-            message = f"Multi-model export completed.\nExported {len(exported_models)} models:\n"
-            message += ", ".join(exported_models)
-            message += f"\n\nFiles saved to:\n{base_dir}"
-            QMessageBox.information(self, "Export Complete", message)
-        else:
-            QMessageBox.warning(self, "Export Failed", "No models were successfully exported.")
+            for model_idx in range(len(ts.constants.affparams[aff_type])):
+                labels.append(f"{aff_type}{model_idx}")
+                classes.append(aff_type)
+                indices.append(model_idx)
+        jobs = [
+            SimJob(
+                label="all models", stim_name=stim_name,
+                affclass=np.array(classes), idx=np.array(indices),
+                trace=trace, fs=fs
+            )
+            for stim_name, (trace, fs) in stimuli
+        ]
+
+        results = {}
+
+        def store_result(job, response):
+            results[job.stim_name] = response
+
+        def write_all(cancelled):
+            if cancelled or not results:
+                QMessageBox.warning(self, "Export Failed", "No models were successfully exported.")
+                return
+            # per-model responses, with stimuli in CSV order
+            model_responses = [
+                {name: results[name][i] for name, _ in stimuli if name in results}
+                for i in range(len(labels))
+            ]
+            attrs = [
+                {"affclass": c, "idx": int(i)} for c, i in zip(classes, indices)
+            ]
+
+            if is_binary_export(out_path, selected_filter):
+                # one file, written model by model
+                def write_binary():
+                    with ts.ResponseWriter(out_path, psth_bin_ms=self.psth_bin_size) as writer:
+                        return [
+                            (label, self.export_model(label, resp, base_dir, base_name, writer, **a))
+                            for label, resp, a in zip(labels, model_responses, attrs)
+                        ]
+                tasks = [write_binary]
+            else:
+                # separate CSVs, written in parallel
+                tasks = [
+                    (lambda label=label, resp=resp:
+                        [(label, self.export_model(label, resp, base_dir, base_name, None))])
+                    for label, resp in zip(labels, model_responses)
+                ]
+
+            def report(task_results):
+                self.set_busy(False)
+                exported_models = [
+                    label for res in task_results if isinstance(res, list)
+                    for label, ok in res if ok
+                ]
+                if exported_models:
+                    message = f"Multi-model export completed.\nExported {len(exported_models)} models:\n"
+                    message += ", ".join(exported_models)
+                    message += f"\n\nFiles saved to:\n{base_dir}"
+                    QMessageBox.information(self, "Export Complete", message)
+                else:
+                    QMessageBox.warning(self, "Export Failed", "No models were successfully exported.")
+
+            self.log(f"Writing {len(labels)} models")
+            self.set_busy(True)
+            self.cancel_btn.setEnabled(False)
+            self.task_thread = TaskThread(tasks, parent=self)
+            self.task_thread.progress.connect(self.update_progress)
+            self.task_thread.done.connect(report)
+            self.task_thread.start()
+
+        self.log(f"Simulating {len(labels)} models on {len(jobs)} stimuli")
+        self.start_jobs(jobs, store_result, write_all)
     
     # --------------------------------------------------------
     # Export TouchSim Response
     # --------------------------------------------------------
     def export_response(self):
-        try:
-            responses = self.all_responses
-        except Exception as e:
+        responses = self.all_responses
+        if not responses:
             QMessageBox.critical(self, "No Response", f"Generate response results before exporting!")
             return
 
-        out_path, _ = QFileDialog.getSaveFileName(
-            self, "Save Response CSV", "", "CSV Files (*.csv)"
+        out_path, selected_filter = QFileDialog.getSaveFileName(
+            self, "Save Response", "", EXPORT_FILTERS
         )
         if not out_path:
             return
@@ -576,6 +708,18 @@ class TouchSimApp(QWidget):
         base_dir = os.path.dirname(out_path)
         base_name = os.path.splitext(os.path.basename(out_path))[0]
 
+        if is_binary_export(out_path, selected_filter):
+            # Binary export of all responses; PSTHs are computed on loading
+            try:
+                with ts.ResponseWriter(out_path, psth_bin_ms=self.psth_bin_size) as writer:
+                    for name, resp in responses.items():
+                        writer.write(name, resp, stimuli=[name])
+                self.log(f"Response data exported to: {out_path}")
+            except Exception as e:
+                QMessageBox.warning(self, "Export Error", f"Failed to export responses:\n{e}")
+            self.export_graphs(responses, base_dir, base_name)
+            return
+
         # Export spike series data
         try:            
             spike_series_list = [pd.Series(resp.spikes[0], name=name) for name, resp in responses.items()]
@@ -587,31 +731,15 @@ class TouchSimApp(QWidget):
         self.log(f"Spike data exported to: {out_path}")
 
         # Export PSTH data
-        bin_size = self.psth_bin_size
         try:
+            densities, avg_spike_per_bin = psth_densities(
+                responses, self.psth_bin_size
+            )
             psth_list = [
-                pd.Series(
-                    np.sum(resp.psth(bin=self.psth_bin_size), axis=0), 
-                    name=name
-                    ) / bin_size for name, resp in self.all_responses.items()
+                pd.Series(d, name=name) for name, d in densities.items()
                 ]
             psth_df = pd.concat(psth_list, axis=1)
             
-            # Calculate average spikes per ms across all responses
-            all_spike_densities = []
-            for name, response in self.all_responses.items():
-                spike_counts = np.sum(response.psth(bin=bin_size), axis=0)
-                spike_densities = spike_counts / bin_size
-                all_spike_densities.append(spike_densities)
-            
-            # Calculate average for each bin
-            max_bins = max(len(densities) for densities in all_spike_densities)
-            avg_spike_per_bin = []
-            for bin_idx in range(max_bins):
-                bin_values = [densities[bin_idx] for densities in all_spike_densities 
-                             if bin_idx < len(densities)]
-                avg_spike_per_bin.append(np.mean(bin_values))
-            
             # Insert average column at index 0
             psth_df.insert(0, "Average Spikes per ms", avg_spike_per_bin)
         except Exception as e:
@@ -621,6 +749,9 @@ class TouchSimApp(QWidget):
         psth_df.to_csv(psth_path, index=False)
         self.log(f"Spike data exported to: {psth_path}")
 
+        self.export_graphs(responses, base_dir, base_name)
+
+    def export_graphs(self, responses, base_dir, base_name):
         # Export spike graphs and PSTH plots
         timespan = self.calculate_timespan()
         temp_canvas = MplCanvas(timespan)
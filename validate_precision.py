@@ -0,0 +1,107 @@
+"""Validates single precision simulations against double precision.
+
+Simulates the responses of a grid of SA1, RA, and PC afferents to the standard
+stimulus generators (stim_sine, stim_ramp, and stim_noise) in float64 and in
+float32, and reports how far the single precision spike trains deviate: spike
+count differences, the fraction of float64 spikes with a float32 spike within
+the tolerance, and the deviation of matched spike times. Membrane noise is
+seeded identically in both runs, so that differences stem from precision alone.
+
+Usage:
+    python validate_precision.py [--afferents N] [--seed S] [--tolerance T]
+        [--output results.json]
+"""
+import argparse
+import json
+import sys
+
+import numpy as np
+
+import touchsim as ts
+
+def stimuli(seed=0):
+    """The standard stimuli that precision is validated on.
+    """
+    return {
+        'sine 10 Hz': ts.stim_sine(freq=10.,amp=0.5),
+        'sine 250 Hz': ts.stim_sine(freq=250.,amp=0.005),
+        'sine 1 kHz fs': ts.stim_sine(freq=25.,amp=0.5,fs=1000.),
+        'ramp': ts.stim_ramp(pin_radius=1.),
+        'noise': ts.stim_noise(seed=seed),
+        }
+
+def deviation(sp64,sp32,tolerance):
+    """Compares two lists of spike trains.
+
+    Returns:
+        Dict with spike counts, the number of afferents whose counts differ,
+        the fraction of float64 spikes matched by a float32 spike within
+        tolerance, and the mean and maximum deviation of matched spikes.
+    """
+    d = []
+    count_diff = 0
+    for a,b in zip(sp64,sp32):
+        if len(a)!=len(b):
+            count_diff += 1
+        if len(a)==0 or len(b)==0:
+            continue
+        # nearest float32 spike for each float64 spike
+        i = np.clip(np.searchsorted(b,a),1,len(b)-1) if len(b)>1 else\
+            np.zeros(len(a),dtype=int)
+        near = np.minimum(np.abs(a-b[i]),np.abs(a-b[np.maximum(i-1,0)]))
+        d.append(near)
+    d = np.concatenate(d) if len(d)>0 else np.zeros(0)
+    n64 = int(sum(len(a) for a in sp64))
+    matched = d[d<=tolerance]
+    return {'spikes64': n64, 'spikes32': int(sum(len(b) for b in sp32)),
+        'afferents_differing': count_diff,
+        'matched': float(matched.size/n64) if n64>0 else 1.,
+        'mean_dev': float(np.mean(matched)) if matched.size>0 else 0.,
+        'max_dev': float(np.max(matched)) if matched.size>0 else 0.}
+
+def validate(aff,seed=0,tolerance=1e-3):
+    """Runs all stimuli in both precisions.
+
+    Returns:
+        Dict mapping stimulus names to deviation() results.
+    """
+    out = {}
+    for name,s in stimuli(seed).items():
+        r64 = aff.response(s,seed=seed,dtype=np.float64)
+        r32 = aff.response(s,seed=seed,dtype=np.float32)
+        out[name] = deviation(r64.spikes,r32.spikes,tolerance)
+    return out
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='touchsim float32 validation')
+    parser.add_argument('--afferents',type=int,default=300,
+        help='approximate number of afferents (default: 300)')
+    parser.add_argument('--seed',type=int,default=0,
+        help='seed for stimuli and membrane noise (default: 0)')
+    parser.add_argument('--tolerance',type=float,default=1e-3,
+        help='spike time tolerance in s (default: 0.001)')
+    parser.add_argument('--output',help='write results to this JSON file')
+    opts = parser.parse_args(argv)
+
+    # grid of all neuron models around the stimulus location
+    models = len(ts.affpop_grid(max_extent=0.))
+    side = max(int(np.sqrt(opts.afferents/models)),1)
+    aff = ts.affpop_grid(dist=10./side,max_extent=10.-10./side)
+
+    results = validate(aff,opts.seed,opts.tolerance)
+    print('%d afferents, tolerance %g s' % (len(aff),opts.tolerance))
+    print('%-14s %9s %9s %8s %8s %11s %11s' % ('stimulus','spikes64',
+        'spikes32','aff diff','matched','mean dev','max dev'))
+    for name,r in results.items():
+        print('%-14s %9d %9d %8d %7.2f%% %11.3g %11.3g' % (name,r['spikes64'],
+            r['spikes32'],r['afferents_differing'],100.*r['matched'],
+            r['mean_dev'],r['max_dev']))
+
+    if opts.output:
+        with open(opts.output,'w') as f:
+            json.dump(results,f,indent=1)
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())